@@ -0,0 +1,165 @@
+#! python3
+
+## Registo de auditoria (append-only) dos eventos do ciclo de vida dos tokens.
+# Emissão, refresh, validações falhadas e revogações ficam num ficheiro JSONL, uma linha por
+# evento. O pedido apenas acrescenta o evento a uma fila em memória (um deque: o append é atómico
+# e não usa locks); a conversão para JSON, a escrita e o fsync são feitos por uma thread em
+# segundo plano, em lotes de até "batch_size" eventos a cada "flush_interval" segundos. Assim o
+# tempo de resposta não depende do volume de auditoria nem da velocidade do disco.
+#
+# Política de fsync: "always" (depois de cada lote), "interval" (no máximo a cada
+# "fsync_interval" segundos) ou "never" (fica a cargo do sistema operativo).
+#
+# Quando o ficheiro ultrapassa "max_bytes" é renomeado para <path>.<data>-<n> (comprimido com
+# gzip se "compress") e é aberto um novo; só são mantidos os "backups" ficheiros mais recentes.
+# O path pode conter "{pid}", para cada worker escrever no seu ficheiro.
+#
+# Se o disco não acompanhar e a fila chegar a "queue_size" eventos, com overflow="drop" os
+# eventos novos são descartados e contados em "dropped"; com overflow="block" o pedido espera
+# até "block_timeout" segundos por espaço na fila (back-pressure) antes de descartar o evento.
+
+import collections
+import glob
+import gzip
+import json
+import os
+import shutil
+import threading
+import time
+
+FSYNC_POLICIES = ('always', 'interval', 'never')
+OVERFLOW_POLICIES = ('drop', 'block')
+
+
+class AuditLog:
+
+    def __init__(self, path, queue_size=100000, overflow='drop', block_timeout=0.1, batch_size=1000,
+                 flush_interval=1, fsync='interval', fsync_interval=1, max_bytes=64 * 1024 * 1024,
+                 backups=10, compress=False):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy: %s' % fsync)
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy: %s' % overflow)
+        self.path = path.format(pid=os.getpid())
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        # eventos por escrever: (tempo, evento, campos)
+        self.queue = collections.deque()
+        self.wakeup = threading.Event()
+        self.file = None
+        self.size = 0
+        self.synced_at = 0
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.closed = False
+
+    # Acrescenta um evento à fila. Os campos têm de ser serializáveis em JSON (os digests dos
+    # tokens em hexadecimal; os tokens em si nunca são registados).
+    def record(self, event, **fields):
+        if self.thread is None:
+            self.start()
+        if len(self.queue) >= self.queue_size and not self.wait_for_space():
+            self.dropped += 1
+            return
+        self.queue.append((time.time(), event, fields))
+        if len(self.queue) >= self.batch_size:
+            self.wakeup.set()
+
+    def wait_for_space(self):
+        if self.overflow != 'block':
+            return False
+        self.wakeup.set()
+        deadline = time.monotonic() + self.block_timeout
+        while len(self.queue) >= self.queue_size:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.001)
+        return True
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name='audit-log', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # os eventos do lote perdem-se, mas a thread continua
+                print("Audit log error: %s" % e)
+
+    # Escreve todos os eventos na fila, em lotes. Só é chamada pela thread (ou pelo close).
+    def flush(self):
+        with self.lock:
+            while self.queue:
+                lines = []
+                while self.queue and len(lines) < self.batch_size:
+                    ts, event, fields = self.queue.popleft()
+                    lines.append(json.dumps(dict(fields, ts=round(ts, 3), event=event), separators=(',', ':')))
+                self.write(('\n'.join(lines) + '\n').encode('utf-8'), len(lines))
+            if self.file is not None and self.fsync == 'interval' and time.time() - self.synced_at >= self.fsync_interval:
+                self.sync()
+
+    def write(self, data, count):
+        if self.file is not None and self.size and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        if self.file is None:
+            self.file = open(self.path, 'ab')
+            self.size = self.file.tell()
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+        self.written += count
+        if self.fsync == 'always':
+            self.sync()
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        self.synced_at = time.time()
+
+    def rotate(self):
+        if self.fsync != 'never':
+            self.sync()
+        self.file.close()
+        self.file = None
+        self.rotations += 1
+        target = '%s.%s-%d' % (self.path, time.strftime('%Y%m%d%H%M%S'), self.rotations)
+        os.rename(self.path, target)
+        if self.compress:
+            with open(target, 'rb') as source, gzip.open(target + '.gz', 'wb') as dest:
+                shutil.copyfileobj(source, dest)
+            os.remove(target)
+        old = sorted(glob.glob(glob.escape(self.path) + '.*'), key=os.path.getmtime)
+        for name in old[:max(0, len(old) - self.backups)]:
+            os.remove(name)
+
+    # Escreve os eventos que ainda estão na fila (chamada no fim do processo).
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.flush()
+        if self.file is not None:
+            if self.fsync != 'never':
+                self.sync()
+            self.file.close()
+            self.file = None
+
+    def stats(self):
+        return {'file': self.path, 'queued': len(self.queue), 'written': self.written,
+                'dropped': self.dropped, 'rotations': self.rotations}
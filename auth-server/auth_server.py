@@ -1,27 +1,50 @@
 #! python3
 
+import atexit
 import json
-import os
+import re
+import signal
+import sys
 import time
-from urllib.parse import urlencode, urlparse
-#import requests
-import urllib.parse as urlparse
 import jwt
-from cryptography.fernet import Fernet
-from flask import (Flask, make_response, render_template, redirect, request,url_for)
+from flask import (Flask, Response, g, make_response, stream_with_context, render_template, redirect, request,url_for)
 import secrets
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from pymongo import MongoClient
-import bcrypt
-import jsonschema
-from jsonschema import validate
+from pymongo.errors import PyMongoError
+from bulk_register import parse_definitions, register_stream
+from admission import AdaptiveLimit, AdmissionController
+from audit import AuditLog
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from client_registry import ClientRegistry, backfill_service_keys, service_key, service_keys
+from scope_match import compile_scopes, parse_name, parse_version
+from config import Config
+from durability import DurabilityPolicy
+from health import HealthMonitor
+from ratelimit import RateLimiter, MemoryBackend, MongoBackend
+from revocations import RevocationFeed
+from signing_keys import KeyRing, UnknownKeyError
+from token_cache import SharedTokenCache
+from token_epoch import read_epoch, start_epoch_watcher
+from token_reuse import TokenReuseIndex, canonical_scopes
+from token_store import MAIN_SHARD, ShardedTokenStore
+from validation_socket import start_validation_socket
+from tokens import TOKEN_FORMAT_JWT, TOKEN_FORMAT_REFERENCE, TOKEN_FORMATS, new_reference_token, token_digest
 
+## O servidor é criado pelo create_app (no fim deste ficheiro), com um objeto Config (ver config.py).
+## Importar este módulo não lê o ambiente, não abre ligações nem ficheiros: o bcrypt e o jsonschema
+## só são importados no primeiro pedido que os usa, e a base de dados só é contactada no primeiro pedido.
+## Para medir o tempo de arranque: python ../misc/startup_benchmark.py
 app = Flask(__name__)
+config = None
 
-# dados predefinidos no docker compose
-mongodb_addr = os.environ.get("ME_CONFIG_MONGODB_SERVER")
-mongodb_port = int (os.environ.get("ME_CONFIG_MONGODB_PORT"))
-mongodb_username = os.environ.get("ME_CONFIG_MONGODB_ADMINUSERNAME")
-mongodb_password = os.environ.get("ME_CONFIG_MONGODB_ADMINPASSWORD")
+# dados predefinidos no docker compose (ver config.py)
+mongodb_addr = None
+mongodb_port = None
+mongodb_username = None
+mongodb_password = None
 
 # Para testes locais
 #mongodb_addr = "localhost"
@@ -30,12 +53,311 @@ mongodb_password = os.environ.get("ME_CONFIG_MONGODB_ADMINPASSWORD")
 #mongodb_password = ""
 #mongodb_database = os.environ.get("ME_CONFIG_MONGODB_DATABASE")
 
-## Chave usada para cifrar o token de acesso dado ao cliente.
-## nesta ultima versão não está a ser uadada para efeitos de verificação, porque a verificação está a ser feita na base de dados.
-## serve apenas para cifrar o JWT.
-## no futuro porderá vir a ser usada novamente.
+## Chave usada antigamente para cifrar o token de acesso dado ao cliente.
+## agora os JWT são assinados com as chaves do keyring (ver signing_keys.py), que são rodadas periodicamente.
+## esta chave serve apenas para verificar tokens antigos, sem kid.
 SECRET_KEY = 'secret-key-of-the-portuguese-empire'
 
+## Modos de durabilidade (write concern e read preference) por coleção e operação (ver durability.py).
+## Configurados com DURABILITY e DURABILITY_DEFAULT.
+durability = DurabilityPolicy()
+
+## Limite de pedidos ao endpoint /token (RATE_LIMIT_TOKEN), aplicado por client_id e por endereço remoto,
+## antes de qualquer acesso à base de dados ou bcrypt.
+## RATE_LIMIT_BACKEND=mongo partilha os limites entre workers através da coleção oauth.rate_limits.
+token_limiter = None
+
+## Ligação partilhada à base de dados, usada pelas funcionalidades que correm em segundo plano
+## ou em todos os pedidos (limites de pedidos, gerações dos tokens), para não abrir uma ligação de cada vez.
+shared_client = None
+
+def get_shared_db():
+    global shared_client
+    if shared_client is None:
+        shared_client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password, **store_timeouts())
+    return shared_client['oauth']
+
+# timeouts das ligações partilhadas (STORE_TIMEOUT), para um MongoDB lento não bloquear os pedidos
+def store_timeouts():
+    timeout = int(config.store_timeout * 1000)
+    return {'serverSelectionTimeoutMS': timeout, 'connectTimeoutMS': timeout, 'socketTimeoutMS': timeout}
+
+def get_rate_limit_collection():
+    return get_shared_db()['rate_limits']
+
+## Circuit breaker das leituras dos tokens (ver circuit_breaker.py). Com o circuito aberto a validação passa ao
+## modo degradado: os tokens validados recentemente por este processo (known_tokens) ou na cache partilhada continuam
+## aceites até ao seu exp e, com DEGRADED_SIGNATURE_ONLY=1, os restantes JWT são aceites apenas pela assinatura
+## (um token revogado pode então ser aceite até expirar). Os restantes tokens não podem ser validados e a resposta é 503.
+token_store_breaker = None
+
+class TokenStoreUnavailable(Exception):
+    pass
+
+## Últimos tokens válidos vistos por este processo: digest -> (client_id, scope, expires, epoch), os usados há menos
+## tempo no fim. Só são lidos no modo degradado, por isso existem mesmo sem a cache partilhada (TOKEN_CACHE_PATH).
+## KNOWN_TOKENS_SIZE é o número máximo de tokens guardados (0 desativa).
+known_tokens = OrderedDict()
+known_tokens_lock = threading.Lock()
+
+def remember_token(digest, token):
+    if config.known_tokens_size <= 0:
+        return
+    with known_tokens_lock:
+        known_tokens[digest] = (token['client_id'], token.get('scope'), token['expires'], token.get('epoch'))
+        known_tokens.move_to_end(digest)
+        while len(known_tokens) > config.known_tokens_size:
+            known_tokens.popitem(last=False)
+
+def forget_token(digest):
+    with known_tokens_lock:
+        known_tokens.pop(digest, None)
+
+def forget_clients(client_ids):
+    with known_tokens_lock:
+        for digest, entry in list(known_tokens.items()):
+            if entry[0] in client_ids:
+                del known_tokens[digest]
+
+# os tokens revogados por outros processos ou instâncias deixam de ser aceites no modo degradado
+def invalidate_known_tokens(event):
+    if event['type'] == 'token':
+        forget_token(bytes.fromhex(event['token_digest']))
+    elif event['type'] == 'client':
+        forget_clients({event['client_id']})
+    elif event['type'] == 'client_tokens':
+        forget_clients(set(event['client_ids']))
+
+# a sonda do breaker: todos os shards respondem
+def probe_token_store():
+    for name in token_store.shards:
+        get_shard_db(name).command('ping')
+
+def check_token_store():
+    if token_store_breaker.is_open:
+        raise TokenStoreUnavailable('circuit open, degraded validation')
+
+## Registo de auditoria dos eventos dos tokens (ver audit.py), ativo com AUDIT_LOG_PATH.
+## A escrita é feita por uma thread: os pedidos apenas acrescentam o evento a uma fila em memória.
+audit_log = None
+
+def audit_event(event, **fields):
+    if audit_log is not None:
+        audit_log.record(event, **fields)
+
+def check_audit_log():
+    return audit_log.stats()
+
+## Cópia em memória de todos os clientes (ver client_registry.py), usada pelo /token em vez da base de dados.
+## CLIENT_REGISTRY_REFRESH é o atraso máximo (segundos) com que uma alteração feita noutro processo é vista.
+client_registry = None
+
+# os clientes apagados por outros processos saem logo da cópia local, antes da próxima leitura da versão
+def invalidate_client_registry(event):
+    if event['type'] == 'client':
+        client_registry.discard(event['client_id'])
+
+## validade (segundos) dos tokens de acesso
+ACCESS_TOKEN_LIFETIME = 3600
+
+## Tokens repartidos por vários MongoDB com hashing consistente (ver token_store.py).
+## TOKEN_SHARDS tem os shards no formato "nome=uri,..."; o shard "main" (ou um shard sem uri) é a base de dados
+## principal, que é também a única quando TOKEN_SHARDS está vazio. Os clientes ficam sempre na base de dados principal.
+token_store = None
+shard_clients = {}
+
+def get_shard_db(name):
+    uri = config.token_shards.get(name)
+    if not uri:
+        return get_shared_db()
+    if name not in shard_clients:
+        shard_clients[name] = MongoClient(uri, **store_timeouts())
+    return shard_clients[name]['oauth']
+
+def get_token_collection(name, operation):
+    return durability.collection(get_shard_db(name), 'tokens', operation)
+
+## Chaves de assinatura dos JWT: algoritmo (HS256, ES256 ou RS256), período de rotação e tempo (segundos)
+## durante o qual uma chave antiga ainda verifica tokens depois de deixar de assinar.
+access_keys = None
+
+## Geração atual dos tokens (ver token_epoch.py). Os tokens de outras gerações não são válidos.
+## TOKEN_EPOCH_REFRESH é o intervalo (segundos) com que a geração é relida e os tokens antigos apagados.
+token_epoch = 0
+token_epoch_refresh = None
+
+def set_token_epoch(epoch):
+    global token_epoch
+    token_epoch = epoch
+
+# um incremento publicado no feed de revogações chega antes da próxima leitura da geração
+def follow_token_epoch(event):
+    if event['type'] == 'epoch' and event['epoch'] > token_epoch:
+        set_token_epoch(event['epoch'])
+
+## Feed de revogações (ver revocations.py). REVOCATION_BUFFER é o número de eventos mantidos em memória.
+revocation_feed = None
+
+## bits usados para representar o scope dos tokens na resposta do socket de validação (ver validation_socket.py).
+SCOPE_BITS = {'read': 0x1, 'write': 0x2}
+
+def scope_mask(scope):
+    if not isinstance(scope, str):
+        return 0
+    return sum(SCOPE_BITS.get(name, 0) for name in set(scope.split()))
+
+def scope_from_mask(mask):
+    return ' '.join(name for name, bit in SCOPE_BITS.items() if mask & bit)
+
+## Cache de tokens validados partilhada por todos os workers deste host (ver token_cache.py).
+## Só existe com TOKEN_CACHE_PATH definido. TOKEN_CACHE_SLOTS é o número de tokens que cabem na cache.
+token_cache = None
+
+# os tokens revogados por outros processos ou instâncias saem da cache
+def invalidate_token_cache(event):
+    if event['type'] == 'token':
+        token_cache.delete(bytes.fromhex(event['token_digest']))
+    elif event['type'] == 'client':
+        token_cache.delete_client(event['client_id'])
+    elif event['type'] == 'client_tokens':
+        token_cache.delete_clients(set(event['client_ids']))
+
+## Índice dos tokens que podem ser devolvidos de novo ao mesmo cliente para os mesmos scopes (ver token_reuse.py).
+## Só existe com TOKEN_REUSE=1. TOKEN_REUSE_MIN_LIFETIME é o tempo (segundos) que ainda tem de faltar para o token expirar.
+token_reuse = None
+
+def invalidate_token_reuse(event):
+    if event['type'] == 'token':
+        token_reuse.discard_token(bytes.fromhex(event['token_digest']))
+    elif event['type'] == 'client':
+        token_reuse.discard_client(event['client_id'])
+    elif event['type'] == 'client_tokens':
+        token_reuse.discard_clients(set(event['client_ids']))
+
+## Snapshot da cache de tokens para reinícios rápidos (opcional). Com TOKEN_SNAPSHOT_PATH definido, a cache
+## é guardada nesse ficheiro quando o processo termina (SIGTERM) e carregada no arranque, sem os tokens expirados.
+token_snapshot_path = None
+
+def load_token_snapshot():
+    cursor = token_cache.load_snapshot(token_snapshot_path, time.time())
+    if cursor is None:
+        return
+    # retira da cache os tokens revogados enquanto o processo esteve parado
+    while True:
+        events, reset = revocation_feed.since(cursor)
+        if reset:
+            # faltam eventos, por isso não é possível saber que tokens foram revogados
+            token_cache.clear()
+            return
+        if not events:
+            break
+        for event in events:
+            invalidate_token_cache(event)
+        cursor = events[-1]['seq']
+    print("Token cache snapshot loaded")
+
+def save_token_snapshot():
+    if started:
+        count = token_cache.save_snapshot(token_snapshot_path, revocation_feed.cursor(), time.time())
+        print("Token cache snapshot saved (%d tokens)" % count)
+
+## Estado das dependências para as sondas /healthz e /readyz (ver health.py), atualizado em segundo plano.
+## A thread é iniciada pela primeira sonda, e a primeira ronda de verificações prepara o servidor
+## (reset_mongo), para que o processo só entre em rotação com a base de dados, as chaves e a cache prontas.
+health = None
+# ligação usada apenas no ping das sondas, com um timeout curto
+probe_client = None
+
+def check_mongo():
+    global probe_client
+    if probe_client is None:
+        timeout = int(config.health_timeout * 1000)
+        probe_client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password,
+                                   serverSelectionTimeoutMS=timeout, connectTimeoutMS=timeout, socketTimeoutMS=timeout)
+    probe_client['oauth'].command('ping')
+
+def check_startup():
+    reset_mongo()
+    return {'epoch': token_epoch, 'revocation_cursor': revocation_feed.cursor(), 'token_cache': token_cache is not None,
+            'clients': len(client_registry.clients), 'client_registry_version': client_registry.version}
+
+def check_signing_keys():
+    kid, _ = access_keys.signing_key()
+    return {'kid': kid}
+
+# pedidos que não contam para a saturação: as sondas e as ligações longas do feed de revogações
+UNCOUNTED_ENDPOINTS = ('healthz', 'readyz', 'revocations')
+
+@app.before_request
+def count_request():
+    if health is not None and request.endpoint not in UNCOUNTED_ENDPOINTS:
+        health.request_started()
+
+@app.teardown_request
+def uncount_request(exc):
+    if health is not None and request.endpoint not in UNCOUNTED_ENDPOINTS:
+        health.request_finished()
+
+## Controlo de admissão (ver admission.py): limite adaptativo de pedidos em curso por classe de endpoints.
+## As validações são baratas e têm um limite próprio, para continuarem a responder com a emissão saturada.
+## Acima do limite o pedido é rejeitado logo com 503 e Retry-After. Os endpoints fora das classes não são limitados.
+admission = None
+
+ADMISSION_CLASSES = {
+    'validate': 'validate',
+    'ext_authz': 'validate',
+    'token': 'issue',
+    'register': 'issue',
+    # a resposta em streaming dura o tempo da importação toda: não pode ocupar um lugar nem contar para a latência da emissão
+    'register_bulk': 'bulk',
+    'delete': 'issue',
+}
+
+@app.before_request
+def admit_request():
+    name = ADMISSION_CLASSES.get(request.endpoint)
+    if admission is None or name is None:
+        return None
+    if not admission.acquire(name):
+        return overloaded(name)
+    g.admission = (name, time.monotonic())
+
+@app.teardown_request
+def release_request(exc):
+    admitted = g.pop('admission', None)
+    if admitted is not None:
+        admission.release(admitted[0], time.monotonic() - admitted[1])
+
+def check_admission():
+    return admission.stats()
+
+# resposta enviada quando a classe do pedido já tem o limite de pedidos em curso.
+def overloaded(name):
+    response = make_response('Server overloaded', 503)
+    response.headers['Retry-After'] = str(admission.retry_after(name))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+# resposta das sondas: apenas lê o estado já calculado pela thread.
+def probe_response(ok, body):
+    response = make_response(json.dumps(dict(body, status='ok' if ok else 'unavailable')), 200 if ok else 503)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+# resposta enviada quando o token não pode ser validado por a base de dados estar indisponível.
+def store_unavailable():
+    response = make_response('Token store unavailable', 503)
+    response.headers['Retry-After'] = str(int(config.breaker_probe_interval))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+# resposta enviada quando o limite de pedidos é ultrapassado.
+def too_many_requests(retry_after):
+    response = make_response('Too many requests', 429)
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
 
 ## Endpoint onde o cliente faz o pedido de autorização e recebe um token de acesso.
 '''
@@ -61,43 +383,80 @@ client_secret: XXXXXXXX
 def token():
     # 1. é feita a ligação com a base de dados.
     client_id = request.get_json().get('client_id')
-    client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
-    db = client['oauth']
-    clients = db['clients']
-    # 2. verifica se o cliente se encontra na base de dados.
-    # se o cliente não se encontrar na base de dados, então é enviado um erro.
-    if clients.find_one({'client_id': client_id}) == None:
-        client.close()
+    # antes de qualquer trabalho é verificado o limite de pedidos do endereço remoto. O balde do cliente só é
+    # gasto depois de verificado o client_secret, para que pedidos de terceiros não esgotem o balde de um cliente.
+    if token_limiter is not None:
+        retry_after = token_limiter.hit('addr:%s' % request.remote_addr)
+        if retry_after:
+            return too_many_requests(retry_after)
+    import bcrypt
+    # 2. verifica se o cliente se encontra registado (na cópia em memória do registo de clientes).
+    # se o cliente não estiver registado, então é enviado um erro.
+    client_doc = client_registry.get(client_id)
+    if client_doc == None:
+        audit_event('token_denied', client_id=client_id, reason='not_registered', remote_addr=request.remote_addr)
         return make_response('Client not registered', 401)
-    # 3. se o cliente se encontrar na base de dados, então é verificado se o client_secret é válido.
-    # para isto é feito a hash do client_secret recebido no pedido e feita a comparação, com a presente na base de dados.
+    # um cliente sem tokens no balde é rejeitado antes do bcrypt; o balde só é gasto depois de verificado o client_secret.
+    if token_limiter is not None:
+        retry_after = token_limiter.check('client:%s' % client_id)
+        if retry_after:
+            return too_many_requests(retry_after)
+    # 3. se o cliente estiver registado, então é verificado se o client_secret é válido.
+    # para isto é feito a hash do client_secret recebido no pedido e feita a comparação, com a presente no registo.
     # se não não forem iguais é lançado um erro.
-    elif not bcrypt.checkpw(request.get_json().get('client_secret').encode('utf-8') , clients.find_one({'client_id': client_id})['client_secret']):
-            client.close()
+    elif not bcrypt.checkpw(request.get_json().get('client_secret').encode('utf-8') , client_doc['client_secret']):
+            audit_event('token_denied', client_id=client_id, reason='invalid_secret', remote_addr=request.remote_addr)
             return make_response('Invalid client secret', 403)
 
+    if token_limiter is not None:
+        retry_after = token_limiter.hit('client:%s' % client_id)
+        if retry_after:
+            return too_many_requests(retry_after)
+
     # check if client has the requested scopes
     scopes = request.get_json().get('scopes')
     if not validate_scopes(scopes):
         return make_response('Invalid scopes format', 403)
     
-    if not validate_client_scopes(client_id, scopes):
+    if not validate_client_scopes(client_doc, scopes):
+        audit_event('token_denied', client_id=client_id, reason='invalid_scopes', remote_addr=request.remote_addr)
         return make_response('Invalid scopes', 403)
 
-    
-    # 4. se tudo estiver OK, então é criado o token de acesso (JWT). O qual é cifrado com a chave secreta, inicialmente definida.
-    access_token = jwt.encode({'client_id': client_id, 'exp': time.time() + 3600}, SECRET_KEY, algorithm = 'HS256')
+    # 4. com TOKEN_REUSE=1, se o cliente já tiver um token para os mesmos scopes que ainda não está perto
+    # de expirar (e continua válido), é devolvido esse token em vez de criar outro.
+    now = time.time()
+    if token_reuse is not None:
+        scope_key = canonical_scopes(scopes)
+        reused = token_reuse.get(client_id, scope_key, token_epoch, now)
+        if reused is not None and reused_token_valid(reused[0]):
+            audit_event('token_reused', client_id=client_id, token_digest=token_digest(reused[0]).hex(), expires=reused[1])
+            return json.dumps({
+                'access_token': reused[0],
+                'token_type': 'Bearer',
+                'expires': int(reused[1] - now)
+            })
 
-    # 5. O token de acesso é guardado na base de dados.
-    expires = round(time.time() + 3600)
-    add_token(access_token, client_id, 'read', time.time() + 3600)
-    client.close()
+    # 5. se tudo estiver OK, então é criado o token de acesso, no formato escolhido no registo do cliente.
+    # o JWT é cifrado com a chave secreta, inicialmente definida. o reference token é apenas um valor aleatório.
+    expires = now + ACCESS_TOKEN_LIFETIME
+    if client_doc.get('token_format', TOKEN_FORMAT_JWT) == TOKEN_FORMAT_REFERENCE:
+        access_token = new_reference_token()
+    else:
+        # a geração vai no token para os resource servers que o verificam localmente (ver o evento "epoch" do feed)
+        access_token = access_keys.sign({'client_id': client_id, 'iat': now, 'exp': expires, 'epoch': token_epoch})
+
+    # 6. O token de acesso é guardado na base de dados (apenas o seu digest).
+    add_token(access_token, client_id, 'read', expires)
+    audit_event('token_issued', client_id=client_id, token_digest=token_digest(access_token).hex(), expires=expires,
+                remote_addr=request.remote_addr)
+    if token_reuse is not None:
+        token_reuse.put(client_id, scope_key, access_token, token_digest(access_token), expires, token_epoch, now)
 
-    # 5. O token de acesso é enviado ao cliente.
+    # 7. O token de acesso é enviado ao cliente.
     return json.dumps({
         'access_token': access_token,
         'token_type': 'Bearer',
-        'expires': 3600
+        'expires': ACCESS_TOKEN_LIFETIME
     })
 
 
@@ -132,16 +491,55 @@ def register():
     if not validate_scopes(scopes):
         return make_response('Invalid scopes format', 403)
 
+    # formato dos tokens de acesso emitidos para este cliente: "jwt" (por omissão) ou "reference".
+    token_format = request.get_json().get('token_format', TOKEN_FORMAT_JWT)
+    if token_format not in TOKEN_FORMATS:
+        return make_response('Invalid token format', 400)
+
     # Se válido, então a informação do cliente é guardada na base de dados.
-    add_client(client_id, client_secret, scopes)
+    add_client(client_id, client_secret, scopes, token_format)
 
     # finalmente é enviado ao cliente o client_id e o client_secret.
     return json.dumps({
         'client_id': client_id,
         'client_secret': client_secret,
+        'token_format': token_format,
         "message": "Client registered successfully"
     })
 
+# Registo de clientes em massa (ver bulk_register.py).
+# O body do pedido é um ficheiro JSONL (por omissão) ou CSV (?format=csv) com uma aplicação por linha.
+# A resposta é um stream JSONL com as credenciais geradas (ou o erro) de cada linha.
+@app.route('/register/bulk', methods = ['POST'])
+def register_bulk():
+    fmt = request.args.get('format', 'jsonl')
+    if fmt not in ('jsonl', 'csv'):
+        return make_response('Invalid format', 400)
+
+    def validate_definition(definition):
+        error = scopes_error(definition.get('scopes'))
+        if error is not None:
+            return 'Invalid scopes format: %s' % error
+        if definition.get('token_format', TOKEN_FORMAT_JWT) not in TOKEN_FORMATS:
+            return 'Invalid token format'
+        return None
+
+    def make_document(client_id, hashed_client_secret, definition):
+        return client_document(client_id, hashed_client_secret, definition['scopes'], definition.get('token_format', TOKEN_FORMAT_JWT))
+
+    def generate():
+        try:
+            results = register_stream(parse_definitions(request.stream, fmt), validate_definition, make_document,
+                                      durability.collection(get_shared_db(), 'clients', 'write'), get_hash_pool())
+            for result in results:
+                yield json.dumps(result) + '\n'
+        finally:
+            # os processos voltam a carregar o registo de clientes, também quando a importação falha a meio
+            # ou o cliente fecha a ligação (os clientes já inseridos ficam registados)
+            client_registry.bump()
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 ## Endpoint onde é feito o pedido para apagar o cliente da "base de dados".
 '''
 Para testar este endpoint, pode-se enviar o seguinte pedido POST:
@@ -152,10 +550,11 @@ client_secret: XXXXXXXX
 @app.route('/delete', methods = ['POST'])
 def delete():
     # 1. Verifica-se se o cliente se encontra registado no servidor de autorização.
+    import bcrypt
     client_id = request.get_json().get('client_id')
     client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
     db = client['oauth']
-    clients = db['clients']
+    clients = durability.collection(db, 'clients', 'read')
     # se o cliente não se encontrar na base de dados, então é enviado um erro.
     if clients.find_one({'client_id': client_id}) == None:
         client.close()
@@ -170,10 +569,19 @@ def delete():
     # 2. Se o cliente se encontra registado, então é apagado da base de dados.
     delete_client(client_id)
 
-    # 3. todos os tokens de acesso associados ao cliente são apagados da base de dados.
+    # 3. todos os tokens de acesso associados ao cliente são apagados da base de dados (e da cache).
     delete_tokens(client_id)
+    forget_clients({client_id})
+    if token_cache is not None:
+        token_cache.delete_client(client_id)
+    if token_reuse is not None:
+        token_reuse.discard_client(client_id)
     client.close()
 
+    # 4. os resource servers são avisados de que os tokens do cliente foram revogados.
+    revocation_feed.revoke_client(client_id, 'deleted')
+    audit_event('client_revoked', client_id=client_id, reason='deleted', remote_addr=request.remote_addr)
+
     return make_response('Client and associated tokens deleted successfully', 200)
 
 
@@ -206,36 +614,224 @@ def validate():
         return make_response('No token provided correctly', 401)
     
     # responde de acordo com o resultado da validação.
-    if validate_token(access_token):
+    try:
+        valid = validate_token(access_token, request.remote_addr)
+    except TokenStoreUnavailable:
+        return store_unavailable()
+    if valid:
         return make_response('Valid access token', 200)
     else:    
         return make_response('Invalid access token', 402)
 
 
+# Endpoint de autorização compatível com o ext_authz (serviço HTTP) do Envoy.
+# O proxy envia para /ext_authz/<caminho original> o método e os cabeçalhos do pedido original.
+# Se o token for válido a resposta é 200 com os cabeçalhos de identidade (x-client-id, x-scopes),
+# que o proxy deve copiar para o pedido enviado ao serviço (allowed_upstream_headers).
+# Caso contrário a resposta é 401, que o proxy devolve diretamente ao cliente.
+# O Cache-Control permite ao proxy guardar o veredito até ao fim da validade do token.
+@app.route('/ext_authz', defaults={'path': ''}, methods = ['GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'HEAD', 'OPTIONS'])
+@app.route('/ext_authz/<path:path>', methods = ['GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'HEAD', 'OPTIONS'])
+def ext_authz(path):
+    data = request.headers.get('Authorization', '')
+    parts = data.split(" ")
+    info = None
+    if len(parts) == 2 and parts[0].lower() == 'bearer':
+        try:
+            info = checked_token_info(parts[1], 'ext_authz', request.remote_addr)
+        except TokenStoreUnavailable:
+            return store_unavailable()
+    if info is None:
+        response = make_response('Invalid access token', 401)
+        response.headers['WWW-Authenticate'] = 'Bearer error="invalid_token"'
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    response = make_response('', 200)
+    response.headers['x-client-id'] = info['client_id']
+    response.headers['x-scopes'] = info.get('scope') or ''
+    response.headers['Cache-Control'] = 'private, max-age=%d' % max(0, min(60, int(info['expires'] - time.time())))
+    return response
+
+
+# Liveness: o processo responde e a thread de verificações não está bloqueada.
+@app.route('/healthz', methods = ['GET'])
+def healthz():
+    health.start()
+    now = time.time()
+    return probe_response(health.alive(now), {'age': health.report(now)['age']})
+
+
+# Readiness: todas as dependências estavam disponíveis na última verificação e o processo não está saturado.
+@app.route('/readyz', methods = ['GET'])
+def readyz():
+    health.start()
+    now = time.time()
+    return probe_response(health.ready(now), health.report(now))
+
+
+# Chaves públicas usadas para assinar os JWT (apenas com SIGNING_ALGORITHM ES256 ou RS256),
+# para os resource servers validarem os tokens localmente.
+@app.route('/jwks', methods = ['GET'])
+def jwks():
+    response = make_response(json.dumps({'keys': access_keys.public_jwks()}), 200)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Cache-Control'] = 'max-age=300'
+    return response
+
+
+# Feed de revogações para os resource servers manterem uma denylist local.
+# O parâmetro cursor (ou o cabeçalho Last-Event-ID) indica o último evento recebido.
+# Com "Accept: text/event-stream" a resposta é um stream de server-sent events,
+# caso contrário é devolvido um JSON, esperando até "wait" segundos por novos eventos (long-poll).
+@app.route('/revocations', methods = ['GET'])
+def revocations():
+    try:
+        cursor = int(request.headers.get('Last-Event-ID') or request.args.get('cursor', 0))
+        wait = min(float(request.args.get('wait', 0)), 60)
+    except ValueError:
+        return make_response('Invalid cursor', 400)
+
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        return Response(revocation_feed.stream(cursor), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    if wait > 0:
+        events, reset = revocation_feed.wait(cursor, wait)
+    else:
+        events, reset = revocation_feed.since(cursor)
+    return json.dumps({
+        'events': events,
+        'reset': reset,
+        'cursor': events[-1]['seq'] if events else cursor
+    })
+
+
+# Endpoints de administração dos serviços (ADMIN_TOKEN no cabeçalho Authorization: Bearer).
+# GET devolve os clientes registados para um serviço (em qualquer versão, se a versão não for dada),
+# pelo índice dos serviços da cópia em memória do registo de clientes.
+# POST .../revoke revoga todos os tokens desses clientes, por exemplo quando o serviço é retirado
+# ou comprometido. Os clientes são procurados na base de dados (índice multikey em service_keys),
+# para incluir os registados noutros processos há menos tempo do que o intervalo do registo.
+@app.route('/admin/services/<name>', methods = ['GET'])
+@app.route('/admin/services/<name>/<version>', methods = ['GET'])
+def service_clients(name, version=None):
+    if not admin_authorized():
+        return admin_unauthorized()
+    error = service_error(name, version)
+    if error is not None:
+        return make_response(error, 400)
+    client_ids = client_registry.clients_for_service(name, version)
+    clients = []
+    for client_id in sorted(client_ids):
+        doc = client_registry.clients.get(client_id)
+        if doc is None:
+            continue
+        # listas de scopes em que o serviço aparece (também por padrões)
+        lists = sorted(list_name for list_name, trie in doc['scope_tries'].items() if trie.includes_service(name, version))
+        clients.append({'client_id': client_id, 'scopes': lists})
+    return json.dumps({'service': name, 'version': version, 'clients': clients})
+
+@app.route('/admin/services/<name>/revoke', methods = ['POST'])
+@app.route('/admin/services/<name>/<version>/revoke', methods = ['POST'])
+def revoke_service(name, version=None):
+    if not admin_authorized():
+        return admin_unauthorized()
+    error = service_error(name, version)
+    if error is not None:
+        return make_response(error, 400)
+    clients = durability.collection(get_shared_db(), 'clients', 'read')
+    if version is not None:
+        # igualdade sobre service_keys: com um padrão de versão (por exemplo 1.x) só encontra os clientes que
+        # registaram esse mesmo padrão; os clientes das versões que o padrão inclui vêm do registo em memória
+        query = {'service_keys': service_key(name, version)}
+    else:
+        # prefixo âncorado: usa o índice
+        query = {'service_keys': {'$regex': '^%s' % re.escape(service_key(name))}}
+    client_ids = {doc['client_id'] for doc in clients.find(query, {'_id': 0, 'client_id': 1})}
+    # clientes registados para versões que o padrão inclui e clientes com padrões nos scopes (ver clients_for_service)
+    client_ids |= client_registry.clients_for_service(name, version)
+    deleted = 0
+    if client_ids:
+        # os clientes continuam registados: só os tokens emitidos até agora deixam de ser válidos
+        now = time.time()
+        deleted = token_store.delete_many({'client_id': {'$in': sorted(client_ids)}}).deleted_count
+        forget_clients(client_ids)
+        if token_cache is not None:
+            token_cache.delete_clients(client_ids)
+        if token_reuse is not None:
+            token_reuse.discard_clients(client_ids)
+        revocation_feed.revoke_client_tokens(client_ids, now, now + ACCESS_TOKEN_LIFETIME, 'service_revoked')
+    target = service_key(name, version) if version is not None else name
+    for client_id in client_ids:
+        audit_event('client_tokens_revoked', client_id=client_id, reason='service_revoked', service=target,
+                    remote_addr=request.remote_addr)
+    return json.dumps({'service': name, 'version': version, 'clients': sorted(client_ids), 'tokens_deleted': deleted})
+
+def service_error(name, version):
+    try:
+        parse_name(name)
+        if version is not None:
+            parse_version(version)
+    except ValueError as e:
+        return str(e)
+    return None
+
+# os endpoints de administração só existem com ADMIN_TOKEN definido
+def admin_authorized():
+    parts = request.headers.get('Authorization', '').split(" ")
+    return bool(config.admin_token) and len(parts) == 2 and parts[0].lower() == 'bearer' \
+        and secrets.compare_digest(parts[1].encode('utf-8'), config.admin_token.encode('utf-8'))
+
+def admin_unauthorized():
+    response = make_response('Admin token required', 401)
+    response.headers['WWW-Authenticate'] = 'Bearer'
+    return response
+
+
 # função auxiliar para validar formatacao dos scopes
+# o schema.json é lido e compilado apenas uma vez.
+scopes_validator = None
+
+def get_scopes_validator():
+    global scopes_validator
+    if scopes_validator is None:
+        import jsonschema
+        #load schema from schema.json
+        with open('schema.json') as f:
+            schemaa = json.load(f)
+        scopes_validator = jsonschema.validators.validator_for(schemaa)(schemaa)
+    return scopes_validator
+
 def validate_scopes(scopes):
-    #load schema from schema.json
-    with open('schema.json') as f:
-        schemaa = json.load(f)
     #validate scopes
-    try:
-        jsonschema.validate(instance=scopes, schema=schemaa)
-    except jsonschema.exceptions.ValidationError as err:
+    error = scopes_error(scopes)
+    if error is not None:
         print("DEU FALSE")
-        print(err)
+        print(error)
         return False
     print("DEU TRUE")
     return True
 
-# Função que valida os campos dos scopes, verifica os que estão na base de dados e certifica, que no pedido não ha
+# devolve a mensagem do erro de formatação dos scopes, ou None se forem válidos.
+def scopes_error(scopes):
+    from jsonschema.exceptions import best_match
+    err = best_match(get_scopes_validator().iter_errors(scopes))
+    if err is not None:
+        return err.message
+    # padrões de nomes e versões (ver scope_match.py)
+    try:
+        compile_scopes(scopes)
+    except ValueError as e:
+        return str(e)
+    return None
+
+# Função que valida os campos dos scopes, verifica os que estão no registo do cliente e certifica, que no pedido não ha
 # scopes diferentes dos que foram registados inicialmente com o client.
-def validate_client_scopes(client_id, scopes):
-    client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
-    db = client['oauth']
-    clients = db['clients']
-    client_scopes = clients.find_one({'client_id': client_id})['scopes']
-    client.close()
-    print("client_scopes: ", client_scopes, type(client_scopes))
+# client_doc é o documento do cliente no registo em memória, com os scopes já em conjuntos (scope_sets)
+# e compilados em tries (scope_tries), para os scopes registados com padrões (ver scope_match.py).
+def validate_client_scopes(client_doc, scopes):
+    client_scopes = client_doc['scope_sets']
+    print("client_scopes: ", client_doc['scopes'], type(client_doc['scopes']))
     print("scopes: ", scopes, type(scopes))
     print("APP SERVICE REQUIRED: ", scopes['appServiceRequired'], type(scopes['appServiceRequired']))
 
@@ -245,10 +841,13 @@ def validate_client_scopes(client_id, scopes):
     
 
     # verificar se os scopes são válidos
+    client_tries = client_doc['scope_tries']
     for scope in scopes:
         print("SCOPE: ", scope, type(scope))
         for app in scopes[scope]:
-            if app not in client_scopes[scope]:
+            if json.dumps(app, sort_keys=True) in client_scopes.get(scope, ()):
+                continue
+            if scope not in client_tries or not client_tries[scope].covers(app):
                 return False
     
     return True
@@ -258,84 +857,204 @@ def validate_client_scopes(client_id, scopes):
 
 ################# chamadas a base de dados #####################
 
-# Se o servidor for reiniciado, então todos os tokens são apagados da base de dados.
+# Os tokens deixam de ser válidos quando a geração é incrementada no deploy (python token_epoch.py),
+# em vez de a coleção ser apagada aqui, o que bloqueava o primeiro pedido e apagava tokens de outros workers.
+# Aqui apenas é lida a geração atual e iniciada a thread que apaga os tokens antigos em segundo plano.
 # Deverá apagar também todos os clientes registados? penso que não.
+# Pode ser chamada também pelo socket de validação, por isso só é executada uma vez.
+startup_lock = threading.Lock()
+started = False
+
 @app.before_first_request
 def reset_mongo():
-    client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
-    print("Connected to database successfully!")
-    # delete token collection
-    db = client['oauth']
-    tokens = db['tokens']
-    tokens.delete_many({})
-    #client.drop_database('oauth')
-    #print("Database dropped successfully!")
-    # create the database and collections
-    #db = client.oauth
-    #db.create_collection('clients')
-    #db.create_collection('tokens')
-    # close connection
-    client.close()
+    global started
+    with startup_lock:
+        if started:
+            return
+        client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
+        print("Connected to database successfully!")
+        db = client['oauth']
+        set_token_epoch(read_epoch(db))
+        print("Token epoch: %d" % token_epoch)
+        # índices (em todos os shards) para a pesquisa dos tokens pelo digest e para a limpeza das gerações antigas.
+        # o índice único é sparse: os documentos antigos, ainda sem token_digest (ver migrate_tokens.py), não entram
+        # no índice, em vez de colidirem todos no valor nulo e a criação falhar com E11000.
+        token_store.create_index('token_digest', unique=True, sparse=True)
+        token_store.create_index('epoch')
+        db['clients'].create_index('client_id', unique=True)
+        # índice multikey das chaves "nome@versão" dos serviços de cada cliente (ver client_registry.py)
+        db['clients'].create_index('service_keys')
+        backfilled = backfill_service_keys(durability.collection(db, 'clients', 'write'))
+        if backfilled:
+            print("Service keys added to %d clients" % backfilled)
+        print("Client registry: %d clients" % client_registry.load())
+        client_registry.start()
+        start_epoch_watcher(get_shared_db, set_token_epoch, token_epoch_refresh, lambda: token_store)
+        # depois de uma alteração dos shards, apenas uma instância (TOKEN_SHARD_REBALANCE=1) move os tokens
+        if token_store.previous_ring is not None and config.token_shard_rebalance:
+            token_store.start_rebalance()
+        revocation_feed.start()
+        if token_cache is not None and token_snapshot_path:
+            load_token_snapshot()
+        #client.drop_database('oauth')
+        #print("Database dropped successfully!")
+        # create the database and collections
+        #db = client.oauth
+        #db.create_collection('clients')
+        #db.create_collection('tokens')
+        # close connection
+        client.close()
+        started = True
 
 # Função que adiciona clientes a base de dados
-def add_client(client_id, client_secret, scopes):
+def add_client(client_id, client_secret, scopes, token_format=TOKEN_FORMAT_JWT):
+    import bcrypt
     client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
     # É usado a biblioteca BCrypt para criar a hash do client_secret.
     hashed_client_secret = bcrypt.hashpw(client_secret.encode('utf-8'), bcrypt.gensalt())
     db = client['oauth']
-    clients = db['clients']
-    clients.insert_one({'client_id': client_id, 'client_secret': hashed_client_secret, 'scopes': scopes})
+    clients = durability.collection(db, 'clients', 'write')
+    document = client_document(client_id, hashed_client_secret, scopes, token_format)
+    clients.insert_one(document)
     client.close()
+    # os outros processos voltam a carregar o registo de clientes
+    client_registry.added([document])
+
+# documento guardado na coleção clients
+def client_document(client_id, hashed_client_secret, scopes, token_format):
+    return {'client_id': client_id, 'client_secret': hashed_client_secret, 'scopes': scopes, 'token_format': token_format,
+            'service_keys': service_keys(scopes)}
 
-# Função que adiciona tokens a base de dados
+## Process pool usado para calcular as hashes bcrypt no registo em massa.
+## BCRYPT_WORKERS é o número de processos (por omissão o número de CPUs), criados apenas no primeiro registo em massa.
+hash_pool = None
+
+def get_hash_pool():
+    global hash_pool
+    if hash_pool is None:
+        hash_pool = ProcessPoolExecutor(max_workers=config.bcrypt_workers)
+    return hash_pool
+
+# Função que adiciona tokens a base de dados.
+# O token nunca é guardado, apenas o seu digest SHA-256, que é a chave de todas as pesquisas.
 def add_token(access_token, client_id, scope, expires):
-    client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
-    db = client['oauth']
-    tokens = db['tokens']
-    tokens.insert_one({'access_token': access_token, 'client_id': client_id, 'scope': scope, 'expires': expires})
-    client.close()
+    token_store.insert_one({'token_digest': token_digest(access_token), 'client_id': client_id, 'scope': scope, 'expires': expires, 'epoch': token_epoch})
 
 # Função que elimina clietes da base de dados
 def delete_client(client_id):
     client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
     db = client['oauth']
-    clients = db['clients']
+    clients = durability.collection(db, 'clients', 'write')
     clients.delete_one({'client_id': client_id})
     client.close()
+    client_registry.removed(client_id)
 
 # Função que elimina um token da base de dados
 def delete_token(access_token):
-    client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
-    db = client['oauth']
-    tokens = db['tokens']
-    tokens.delete_one({'access_token': access_token})
-    client.close()
+    token_store.delete_one(token_digest(access_token))
+    forget_token(token_digest(access_token))
+    if token_cache is not None:
+        token_cache.delete(token_digest(access_token))
+    if token_reuse is not None:
+        token_reuse.discard_token(token_digest(access_token))
+
+# um token só é reutilizado se estiver confirmado como válido
+def reused_token_valid(access_token):
+    try:
+        return token_info(access_token) is not None
+    except TokenStoreUnavailable:
+        return False
 
 # Função que valida um token da base de dados
-def validate_token(access_token):
-    client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
-    db = client['oauth']
-    tokens = db['tokens']
-    token = tokens.find_one({'access_token': access_token})
+def validate_token(access_token, remote_addr=None):
+    return checked_token_info(access_token, 'validate', remote_addr) is not None
+
+# token_info dos pedidos de validação (/validate, /ext_authz e socket), com as falhas no registo de auditoria
+def checked_token_info(access_token, source, remote_addr=None):
+    info = token_info(access_token)
+    if info is None:
+        audit_event('validation_failed', source=source, token_digest=token_digest(access_token).hex(), remote_addr=remote_addr)
+    return info
+
+# Função que devolve o documento de um token válido (client_id, scope, expires), ou None.
+# É usada pelo /validate e pelo socket de validação. Usa a ligação partilhada à base de dados.
+# Lança TokenStoreUnavailable se a base de dados estiver indisponível e o token não puder ser validado sem ela.
+def token_info(access_token):
+    digest = token_digest(access_token)
+    # os tokens já validados por qualquer worker estão na cache partilhada
+    if token_cache is not None:
+        cached = token_cache.get(digest, token_epoch, time.time())
+        if cached is not None:
+            return {'client_id': cached[0], 'expires': cached[1], 'scope': scope_from_mask(cached[2])}
+        # lida antes da base de dados: se o token for revogado entretanto, o put não o guarda
+        cache_generation = token_cache.generation()
+
+    # os JWT com assinatura inválida (ou expirados) são rejeitados sem ir à base de dados.
+    if '.' in access_token:
+        try:
+            access_keys.decode(access_token)
+        except jwt.ExpiredSignatureError:
+            # os tokens expirados seguem para a base de dados, onde são apagados.
+            pass
+        except jwt.InvalidTokenError:
+            return None
+    try:
+        token = token_store_breaker.call(token_store.find_one, digest)
+    except (PyMongoError, CircuitOpenError) as e:
+        return degraded_token_info(access_token, digest, e)
+    # tokens de uma geração anterior já não são válidos (serão apagados em segundo plano).
+    if token is not None and token.get('epoch') != token_epoch:
+        token = None
     if token is None:
-        client.close()
-        return False
+        forget_token(digest)
+        return None
     
     # verifica-se se o token expirou
     else:
         if token['expires'] < time.time():
         # como já expirou, então é apagado da base de dados.
-            delete_token(access_token)
-            client.close()
-            return False
-    client.close()
-    return True
+            forget_token(digest)
+            try:
+                if token_store.delete_one(digest):
+                    revocation_feed.revoke_token(digest, token['expires'], 'expired')
+                    audit_event('token_revoked', client_id=token['client_id'], token_digest=digest.hex(), reason='expired')
+            except PyMongoError as e:
+                # será apagado na próxima validação ou com a sua geração
+                print("Could not delete expired token: %s" % e)
+            return None
+    remember_token(digest, token)
+    if token_cache is not None:
+        token_cache.put(digest, token_epoch, token['expires'], scope_mask(token.get('scope')), token['client_id'], cache_generation)
+    return token
+
+# Validação sem a base de dados (modo degradado): os tokens da cache partilhada já foram verificados
+# antes; aqui os tokens validados recentemente por este processo e, se DEGRADED_SIGNATURE_ONLY=1,
+# os JWT com assinatura válida.
+def degraded_token_info(access_token, digest, error):
+    known = known_tokens.get(digest)
+    if known is not None:
+        # expirado ou de uma geração anterior
+        if known[2] < time.time() or known[3] != token_epoch:
+            forget_token(digest)
+            return None
+        return {'client_id': known[0], 'scope': known[1], 'expires': known[2], 'degraded': True}
+    if config.degraded_signature_only and '.' in access_token:
+        # apenas chaves já em memória: os tokens sem kid (chave antiga, pública) nunca são aceites sem a base de dados
+        try:
+            claims = access_keys.decode(access_token, require_kid=True, reload=False)
+        except UnknownKeyError as e:
+            # chave que teria de ser lida da base de dados
+            raise TokenStoreUnavailable(str(e))
+        except jwt.InvalidTokenError:
+            return None
+        return {'client_id': claims['client_id'], 'expires': claims['exp'], 'scope': None, 'degraded': True}
+    raise TokenStoreUnavailable(str(error))
 
 # Função que devolve todos os clientes registados na base de dados
 def get_clients():
     client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
     db = client['oauth']
-    clients = db['clients']
+    clients = durability.collection(db, 'clients', 'read')
     resultado = []
     for client in clients.find():
         print(client)
@@ -344,13 +1063,109 @@ def get_clients():
 
 # Função que elimina todos os tokens associados a um cliente, presentes na base de dados
 def delete_tokens(client_id):
-    client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
-    db = client['oauth']
-    tokens = db['tokens']
-    tokens.delete_many({'client id': client_id})
-    client.close()
+    token_store.delete_many({'client_id': client_id})
+
+
+
+################# arranque #####################
+
+# Cria o servidor com a configuração dada (por omissão lida das variáveis de ambiente).
+# Apenas são criados os objetos: as ligações à base de dados, as chaves e as threads em segundo
+# plano são iniciadas no primeiro pedido (reset_mongo) ou quando são precisas.
+def create_app(app_config=None):
+    global config, mongodb_addr, mongodb_port, mongodb_username, mongodb_password, shared_client
+    global token_limiter, access_keys, token_epoch_refresh, revocation_feed, token_cache, token_snapshot_path, health, probe_client
+    global token_reuse, durability, token_store, shard_clients, client_registry, token_store_breaker, audit_log
+    global admission
+    config = app_config if app_config is not None else Config()
+    mongodb_addr = config.mongodb_addr
+    mongodb_port = config.mongodb_port
+    mongodb_username = config.mongodb_username
+    mongodb_password = config.mongodb_password
+    shared_client = None
+    durability = DurabilityPolicy(config.durability, config.durability_default)
+    shard_clients = {}
+    client_registry = ClientRegistry(lambda: durability.collection(get_shared_db(), 'clients', 'read'),
+                                     lambda: get_shared_db()['settings'],
+                                     interval=config.client_registry_refresh,
+                                     change_streams=config.client_registry_change_streams)
+    token_store = ShardedTokenStore(list(config.token_shards) or [MAIN_SHARD], get_token_collection,
+                                    ring=config.token_shard_ring, previous_ring=config.token_shard_previous_ring)
+    token_store_breaker = CircuitBreaker('token-store', probe_token_store, failure_threshold=config.breaker_failures,
+                                         slow_call=config.breaker_slow_call, probe_interval=config.breaker_probe_interval)
+
+    token_limiter = None
+    if config.token_limit is not None:
+        if config.rate_limit_backend == 'mongo':
+            token_limiter = RateLimiter(*config.token_limit, backend=MongoBackend(get_rate_limit_collection), prefix='token:')
+        else:
+            token_limiter = RateLimiter(*config.token_limit, backend=MemoryBackend(), prefix='token:')
+
+    access_keys = KeyRing(lambda: get_shared_db()['signing_keys'], 'access',
+                          algorithm=config.signing_algorithm,
+                          rotation_interval=config.key_rotation_interval,
+                          grace=config.key_grace,
+                          legacy_secret=SECRET_KEY, legacy_until=config.legacy_secret_until)
+
+    token_epoch_refresh = config.token_epoch_refresh
+    revocation_feed = RevocationFeed(get_shared_db, capacity=config.revocation_buffer)
+    revocation_feed.add_listener(invalidate_client_registry)
+    revocation_feed.add_listener(follow_token_epoch)
+
+    revocation_feed.add_listener(invalidate_known_tokens)
+    known_tokens.clear()
+
+    token_cache = None
+    if config.token_cache_path:
+        token_cache = SharedTokenCache(config.token_cache_path, config.token_cache_slots)
+        revocation_feed.add_listener(invalidate_token_cache)
+
+    token_reuse = None
+    if config.token_reuse:
+        token_reuse = TokenReuseIndex(config.token_reuse_min_lifetime)
+        revocation_feed.add_listener(invalidate_token_reuse)
+
+    audit_log = None
+    if config.audit_log_path:
+        audit_log = AuditLog(config.audit_log_path, queue_size=config.audit_queue_size, overflow=config.audit_overflow,
+                             block_timeout=config.audit_block_timeout, batch_size=config.audit_batch_size,
+                             flush_interval=config.audit_flush_interval, fsync=config.audit_fsync, fsync_interval=config.audit_fsync_interval,
+                             max_bytes=config.audit_max_bytes, backups=config.audit_backups, compress=config.audit_compress)
+        atexit.register(audit_log.close)
+
+    token_snapshot_path = config.token_snapshot_path
+    if token_cache is not None and token_snapshot_path:
+        atexit.register(save_token_snapshot)
+    if audit_log is not None or (token_cache is not None and token_snapshot_path):
+        # o SIGTERM (docker stop) termina o processo normalmente, para o snapshot e os eventos por escrever serem guardados
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
+    admission = None
+    if config.admission:
+        admission = AdmissionController({
+            'validate': AdaptiveLimit(*config.admission_validate),
+            'issue': AdaptiveLimit(*config.admission_issue),
+            'bulk': AdaptiveLimit(*config.admission_bulk),
+        })
 
+    probe_client = None
+    health = HealthMonitor(config.health_interval, config.ready_max_in_flight)
+    health.add_check('mongo', check_mongo)
+    health.add_check('startup', check_startup)
+    health.add_check('signing_keys', check_signing_keys)
+    # com o circuito aberto o processo continua em rotação, em modo degradado
+    health.add_check('token_store', check_token_store, required=False)
+    if audit_log is not None:
+        health.add_check('audit_log', check_audit_log, required=False)
+    if admission is not None:
+        health.add_check('admission', check_admission, required=False)
+    return app
 
 
-app.run(host='0.0.0.0', port = 5001, debug = True)
\ No newline at end of file
+if __name__ == '__main__':
+    create_app()
+    if config.validation_socket_path:
+        reset_mongo()
+        start_validation_socket(config.validation_socket_path, lambda token: checked_token_info(token, 'socket'),
+                                scope_mask, config.validation_socket_mode)
+    app.run(host=config.host, port=config.port, debug=config.debug, use_reloader=config.reloader)
@@ -0,0 +1,146 @@
+#! python3
+
+## Registo de clientes em massa.
+# Lê as definições das aplicações em JSONL (um objeto JSON por linha) ou CSV, valida os scopes,
+# cria o client_id e o client_secret de cada uma, calcula as hashes bcrypt em paralelo num
+# process pool e guarda os clientes com insert_many em lotes ordenados. O resultado de cada
+# linha (credenciais ou erro) é devolvido à medida que cada lote fica concluído, e um erro
+# numa linha não impede o registo das restantes.
+#
+# Formato das definições:
+#   JSONL: {"scopes": {...}, "token_format": "jwt"}
+#   CSV:   colunas "scopes" (JSON) e, opcionalmente, "token_format"
+#
+# Uso da linha de comandos (envia o ficheiro ao endpoint /register/bulk e escreve as credenciais
+# no stdout, uma por linha em JSONL):
+#   python bulk_register.py apps.jsonl [http://localhost:5001]
+#   python bulk_register.py apps.csv [http://localhost:5001]
+
+import csv
+import io
+import json
+import secrets
+import sys
+
+from pymongo.errors import BulkWriteError
+
+BATCH_SIZE = 100
+
+
+# corre nos processos do pool; o bcrypt só é importado no primeiro registo
+def hash_secret(client_secret):
+    import bcrypt
+    return bcrypt.hashpw(client_secret.encode('utf-8'), bcrypt.gensalt())
+
+
+# Gerador de (número da linha, definição ou None, erro ou None) a partir das linhas do ficheiro.
+def parse_definitions(lines, fmt):
+    if fmt == 'csv':
+        reader = csv.DictReader(io.TextIOWrapper(lines, encoding='utf-8') if hasattr(lines, 'read') else lines)
+        for number, row in enumerate(reader, start=2):
+            try:
+                definition = {'scopes': json.loads(row.get('scopes') or 'null')}
+            except ValueError as e:
+                yield number, None, 'Invalid scopes JSON: %s' % e
+                continue
+            if row.get('token_format'):
+                definition['token_format'] = row['token_format']
+            yield number, definition, None
+    else:
+        for number, line in enumerate(lines, start=1):
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if not line.strip():
+                continue
+            try:
+                definition = json.loads(line)
+            except ValueError as e:
+                yield number, None, 'Invalid JSON: %s' % e
+                continue
+            if not isinstance(definition, dict):
+                yield number, None, 'Definition must be a JSON object'
+                continue
+            yield number, definition, None
+
+
+# Regista os clientes e devolve um gerador com o resultado de cada linha.
+#  validate(definition) devolve uma mensagem de erro ou None
+#  make_document(client_id, hashed_secret, definition) devolve o documento a guardar
+#  collection é a coleção dos clientes e pool um executor (por exemplo ProcessPoolExecutor)
+def register_stream(definitions, validate, make_document, collection, pool, batch_size=BATCH_SIZE):
+    batch = []
+    for number, definition, error in definitions:
+        if error is None:
+            error = validate(definition)
+        if error is not None:
+            yield {'line': number, 'error': error}
+            continue
+        batch.append((number, definition))
+        if len(batch) >= batch_size:
+            yield from register_batch(batch, make_document, collection, pool)
+            batch = []
+    if batch:
+        yield from register_batch(batch, make_document, collection, pool)
+
+
+def register_batch(batch, make_document, collection, pool):
+    client_ids = [secrets.token_urlsafe(16) for _ in batch]
+    client_secrets = [secrets.token_urlsafe(32) for _ in batch]
+    hashes = list(pool.map(hash_secret, client_secrets))
+    documents = [make_document(client_id, hashed, definition) for client_id, hashed, (_, definition) in zip(client_ids, hashes, batch)]
+
+    # insert_many ordenado pára no primeiro erro: a linha com erro é reportada e os restantes
+    # documentos do lote são inseridos de novo.
+    errors = {}
+    start = 0
+    while start < len(documents):
+        try:
+            collection.insert_many(documents[start:], ordered=True)
+            break
+        except BulkWriteError as e:
+            write_errors = e.details.get('writeErrors') or []
+            concern_errors = e.details.get('writeConcernErrors') or []
+            if write_errors:
+                failed = start + write_errors[0]['index']
+                errors[failed] = write_errors[0]['errmsg']
+            if write_errors and not concern_errors:
+                start = failed + 1
+                continue
+            # write concern não cumprido: não se sabe se os documentos ficaram gravados, por isso o resto
+            # do lote é reportado como falhado (as definições podem ser enviadas de novo)
+            message = 'Write concern error: %s' % concern_errors[0]['errmsg'] if concern_errors else str(e)
+            for index in range(start, len(documents)):
+                errors.setdefault(index, message)
+            break
+
+    for index, (number, definition) in enumerate(batch):
+        if index in errors:
+            yield {'line': number, 'error': errors[index]}
+        else:
+            yield {'line': number, 'client_id': client_ids[index], 'client_secret': client_secrets[index],
+                   'token_format': documents[index].get('token_format')}
+
+
+def main(path, server):
+    import requests
+    fmt = 'csv' if path.endswith('.csv') else 'jsonl'
+    with open(path, 'rb') as f:
+        response = requests.post(server.rstrip('/') + '/register/bulk', params={'format': fmt}, data=f, stream=True)
+    if response.status_code != 200:
+        print(response.text, file=sys.stderr)
+        sys.exit(1)
+    failed = 0
+    for line in response.iter_lines():
+        if line:
+            print(line.decode('utf-8'))
+            failed += 'error' in json.loads(line)
+    if failed:
+        print("%d definitions failed" % failed, file=sys.stderr)
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("usage: python bulk_register.py <apps.jsonl|apps.csv> [server url]", file=sys.stderr)
+        sys.exit(1)
+    main(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else 'http://localhost:5001')
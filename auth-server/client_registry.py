@@ -0,0 +1,251 @@
+#! python3
+
+## Cópia em memória do registo de clientes.
+# Os clientes quase nunca mudam, por isso cada processo mantém todos em memória (hash do
+# client_secret, formato dos tokens e os scopes já convertidos em conjuntos) e o /token resolve
+# o cliente com uma pesquisa num dicionário, sem ir à base de dados.
+#
+# Para os processos se manterem atualizados existe um documento de versão (settings, _id
+# "client_registry") que é incrementado sempre que um cliente é registado ou apagado. Uma thread
+# acompanha a versão (por change stream, quando a base de dados é um replica set, ou lendo o
+# documento a cada "interval" segundos) e volta a carregar os clientes quando a versão muda.
+# Assim, uma alteração feita noutro processo chega a todos em no máximo "interval" segundos.
+#
+# Um client_id que não está na cópia (registado há menos tempo do que o intervalo) é procurado
+# na base de dados, para um cliente acabado de registar não ser rejeitado.
+#
+# Índice dos serviços: cada cliente guarda em "service_keys" as chaves "nome@versão" de todos os
+# serviços das suas listas de scopes (índice multikey na base de dados) e a cópia em memória
+# mantém o índice inverso nome -> versão -> client_ids, para encontrar sem percorrer os clientes
+# todos os que estão registados para um serviço (por exemplo para revogar os seus tokens).
+# Os clientes com padrões nos scopes (ver scope_match.py) ficam num conjunto à parte e são
+# verificados pelas suas tries.
+
+import json
+import threading
+import time
+
+from scope_match import VersionSet, check_scopes, compile_scopes, has_wildcards, parse_version
+
+VERSION_ID = 'client_registry'
+
+
+# chave canónica de um serviço {name, version}
+def service_key(name, version=''):
+    return '%s@%s' % (name, version or '')
+
+
+# chaves de todos os serviços das listas de scopes de um cliente, sem repetições
+def service_keys(scopes):
+    keys = set()
+    for apps in (scopes or {}).values():
+        for app in apps or []:
+            if isinstance(app, dict) and 'name' in app:
+                keys.add(service_key(app['name'], app.get('version')))
+    return sorted(keys)
+
+
+# acrescenta service_keys aos clientes registados antes do índice dos serviços. Devolve o número de clientes atualizados.
+def backfill_service_keys(clients):
+    updated = 0
+    for doc in clients.find({'service_keys': {'$exists': False}}, {'_id': 1, 'scopes': 1}):
+        clients.update_one({'_id': doc['_id']}, {'$set': {'service_keys': service_keys(doc.get('scopes'))}})
+        updated += 1
+    return updated
+
+
+# conjunto das aplicações de uma lista de scopes, para verificar se uma aplicação pertence à lista
+# sem a percorrer (a ordem dos campos de cada aplicação não conta).
+def scope_set(apps):
+    return frozenset(json.dumps(app, sort_keys=True) for app in apps or [])
+
+
+class ClientRegistry:
+
+    # get_clients() devolve a coleção dos clientes e get_settings() a coleção settings
+    def __init__(self, get_clients, get_settings, interval=1, change_streams=True):
+        self.get_clients = get_clients
+        self.get_settings = get_settings
+        self.interval = interval
+        self.change_streams = change_streams
+        # client_id -> documento do cliente, com os conjuntos de scopes em 'scope_sets'
+        self.clients = {}
+        # nome do serviço -> versão -> client_ids
+        self.services = {}
+        # client_id -> documento dos clientes com padrões nos scopes
+        self.wildcard_clients = {}
+        self.version = None
+        self.loaded_at = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    # Lança ValueError se os scopes do documento estiverem mal formados (ver scope_match.check_scopes).
+    @staticmethod
+    def prepare(doc):
+        check_scopes(doc.get('scopes'))
+        doc = dict(doc)
+        doc['scope_sets'] = {name: scope_set(apps) for name, apps in (doc.get('scopes') or {}).items()}
+        doc['service_keys'] = service_keys(doc.get('scopes'))
+        # scopes compilados (padrões de nomes e versões), refeitos sempre que o cliente é recarregado
+        try:
+            doc['scope_tries'] = compile_scopes(doc.get('scopes'))
+            doc['wildcards'] = has_wildcards(doc.get('scopes'))
+        except ValueError as e:
+            # registado antes dos padrões: apenas as comparações exatas
+            print("Client %s scopes not compiled: %s" % (doc.get('client_id'), e))
+            doc['scope_tries'] = {}
+            doc['wildcards'] = False
+        return doc
+
+    @staticmethod
+    def index(services, wildcard_clients, doc):
+        if doc['wildcards']:
+            wildcard_clients[doc['client_id']] = doc
+        for key in doc['service_keys']:
+            name, _, version = key.rpartition('@')
+            services.setdefault(name, {}).setdefault(version, set()).add(doc['client_id'])
+
+    @staticmethod
+    def unindex(services, wildcard_clients, doc):
+        wildcard_clients.pop(doc['client_id'], None)
+        for key in doc['service_keys']:
+            name, _, version = key.rpartition('@')
+            versions = services.get(name, {})
+            ids = versions.get(version, set())
+            ids.discard(doc['client_id'])
+            if not ids:
+                versions.pop(version, None)
+            if not versions:
+                services.pop(name, None)
+
+    def read_version(self):
+        doc = self.get_settings().find_one({'_id': VERSION_ID})
+        return doc['version'] if doc is not None else 0
+
+    # Carrega todos os clientes. A versão é lida antes dos clientes: uma alteração feita durante
+    # a leitura tem uma versão maior e provoca outra leitura.
+    def load(self):
+        version = self.read_version()
+        clients = {}
+        services = {}
+        wildcard_clients = {}
+        for doc in self.get_clients().find({}, {'_id': 0}):
+            try:
+                doc = self.prepare(doc)
+            except ValueError as e:
+                # um documento mal formado não impede o carregamento dos restantes clientes
+                print("Client %s skipped: %s" % (doc.get('client_id'), e))
+                continue
+            clients[doc['client_id']] = doc
+            self.index(services, wildcard_clients, doc)
+        with self.lock:
+            self.clients = clients
+            self.services = services
+            self.wildcard_clients = wildcard_clients
+            self.version = version
+            self.loaded_at = time.time()
+        return len(clients)
+
+    # Documento do cliente (com 'scope_sets'), ou None se não existir.
+    def get(self, client_id):
+        doc = self.clients.get(client_id)
+        if doc is None and client_id is not None:
+            doc = self.get_clients().find_one({'client_id': client_id}, {'_id': 0})
+            if doc is None:
+                return None
+            try:
+                doc = self.prepare(doc)
+            except ValueError as e:
+                print("Client %s skipped: %s" % (client_id, e))
+                return None
+            with self.lock:
+                self.put(doc)
+        return doc
+
+    # client_ids registados para o serviço (em qualquer versão, se version for None), também por padrões
+    def clients_for_service(self, name, version=None):
+        versions = self.services.get(name, {})
+        if version is not None and parse_version(version)[0] != 'exact':
+            # padrão de versão: as versões registadas que o padrão inclui
+            query = VersionSet()
+            query.add(parse_version(version))
+            query.compile()
+            client_ids = set()
+            for registered, ids in versions.items():
+                try:
+                    included = query.covers(parse_version(registered))
+                except ValueError:
+                    included = False
+                if included:
+                    client_ids |= ids
+        elif version is not None:
+            client_ids = set(versions.get(version, ()))
+        else:
+            client_ids = set().union(*versions.values()) if versions else set()
+        for client_id, doc in list(self.wildcard_clients.items()):
+            if any(trie.includes_service(name, version) for trie in doc['scope_tries'].values()):
+                client_ids.add(client_id)
+        return client_ids
+
+    # substitui o documento de um cliente na cópia (chamada com o lock)
+    def put(self, doc):
+        old = self.clients.get(doc['client_id'])
+        if old is not None:
+            self.unindex(self.services, self.wildcard_clients, old)
+        self.clients[doc['client_id']] = doc
+        self.index(self.services, self.wildcard_clients, doc)
+
+    # alterações feitas neste processo: aplicadas logo na cópia local e anunciadas aos outros
+    def added(self, docs):
+        with self.lock:
+            for doc in docs:
+                self.put(self.prepare(doc))
+        self.bump()
+
+    def removed(self, client_id):
+        self.discard(client_id)
+        self.bump()
+
+    def discard(self, client_id):
+        with self.lock:
+            doc = self.clients.pop(client_id, None)
+            if doc is not None:
+                self.unindex(self.services, self.wildcard_clients, doc)
+
+    def bump(self):
+        self.get_settings().update_one({'_id': VERSION_ID}, {'$inc': {'version': 1}}, upsert=True)
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name='client-registry', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        if self.change_streams:
+            try:
+                self.watch()
+            except Exception as e:
+                # sem replica set não há change streams: a versão passa a ser lida periodicamente
+                print("Client registry change stream unavailable (%s), polling every %ss" % (e, self.interval))
+        while True:
+            self.poll()
+            time.sleep(self.interval)
+
+    def poll(self):
+        try:
+            if self.read_version() != self.version:
+                count = self.load()
+                print("Client registry reloaded (%d clients, version %d)" % (count, self.version))
+        except Exception as e:
+            print("Client registry error: %s" % e)
+
+    def watch(self):
+        pipeline = [{'$match': {'documentKey._id': VERSION_ID}}]
+        with self.get_settings().watch(pipeline, max_await_time_ms=int(self.interval * 1000)) as stream:
+            # alterações entre o load e o início do stream
+            self.poll()
+            while stream.alive:
+                if stream.try_next() is not None:
+                    self.poll()
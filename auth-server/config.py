@@ -0,0 +1,128 @@
+#! python3
+
+## Configuração do servidor de autorização.
+# Todas as variáveis de ambiente (ver docker compose e README) são lidas aqui, de uma só vez,
+# para um objeto Config que é passado ao create_app do auth_server.py. Os testes e os scripts
+# podem criar um Config com outros valores sem alterar o ambiente:
+#   app = create_app(Config(mongodb_addr='localhost', token_cache_path=''))
+
+import os
+
+from admission import parse_admission
+from ratelimit import parse_limit
+from token_store import parse_ring, parse_shards
+
+
+class Config:
+
+    def __init__(self, environ=None, **overrides):
+        env = os.environ if environ is None else environ
+
+        # dados predefinidos no docker compose
+        self.mongodb_addr = env.get("ME_CONFIG_MONGODB_SERVER")
+        self.mongodb_port = int(env.get("ME_CONFIG_MONGODB_PORT", "27017"))
+        self.mongodb_username = env.get("ME_CONFIG_MONGODB_ADMINUSERNAME")
+        self.mongodb_password = env.get("ME_CONFIG_MONGODB_ADMINPASSWORD")
+
+        # endereço e modo do servidor HTTP. O reloader do modo debug arranca um segundo processo
+        # que volta a importar tudo, o que num container só atrasa o arranque.
+        self.host = env.get("HOST", "0.0.0.0")
+        self.port = int(env.get("PORT", "5001"))
+        self.debug = env.get("DEBUG", "1") == "1"
+        self.reloader = env.get("RELOADER", "0") == "1"
+
+        # modos de durabilidade por coleção e operação (ver durability.py)
+        self.durability = env.get("DURABILITY", "")
+        self.durability_default = env.get("DURABILITY_DEFAULT", "default")
+
+        # limites de pedidos (ver ratelimit.py)
+        self.token_limit = parse_limit(env.get("RATE_LIMIT_TOKEN", "20/2"))
+        self.rate_limit_backend = env.get("RATE_LIMIT_BACKEND", "memory")
+
+        # chaves de assinatura (ver signing_keys.py)
+        self.signing_algorithm = env.get("SIGNING_ALGORITHM", "HS256")
+        self.key_rotation_interval = int(env.get("KEY_ROTATION_INTERVAL", "86400"))
+        self.key_grace = int(env.get("KEY_GRACE", "7200"))
+        # tokens antigos, sem kid (assinados com a chave constante do código), aceites até este timestamp (0 = nunca)
+        self.legacy_secret_until = float(env.get("LEGACY_SECRET_UNTIL", "0"))
+
+        # gerações dos tokens (ver token_epoch.py) e feed de revogações (ver revocations.py)
+        self.token_epoch_refresh = float(env.get("TOKEN_EPOCH_REFRESH", "30"))
+        self.revocation_buffer = int(env.get("REVOCATION_BUFFER", "10000"))
+
+        # timeout (segundos) das ligações partilhadas ao MongoDB e circuit breaker das leituras dos tokens
+        # (ver circuit_breaker.py): falhas seguidas até abrir, duração a partir da qual uma leitura conta como
+        # falha, intervalo das sondas e se os JWT podem ser aceites apenas pela assinatura com o circuito aberto
+        self.store_timeout = float(env.get("STORE_TIMEOUT", "10"))
+        self.breaker_failures = int(env.get("BREAKER_FAILURES", "5"))
+        slow_call = env.get("BREAKER_SLOW_CALL", "1")
+        self.breaker_slow_call = float(slow_call) if slow_call else None
+        self.breaker_probe_interval = float(env.get("BREAKER_PROBE_INTERVAL", "2"))
+        self.degraded_signature_only = env.get("DEGRADED_SIGNATURE_ONLY", "0") == "1"
+        # número de tokens validados recentemente que este processo aceita com o circuito aberto
+        self.known_tokens_size = int(env.get("KNOWN_TOKENS_SIZE", "10000"))
+
+        # registo de clientes em memória (ver client_registry.py): intervalo de leitura da versão e uso de change streams
+        self.client_registry_refresh = float(env.get("CLIENT_REGISTRY_REFRESH", "1"))
+        self.client_registry_change_streams = env.get("CLIENT_REGISTRY_CHANGE_STREAMS", "1") == "1"
+
+        # shards dos tokens (ver token_store.py): "nome=uri,..." com todos os shards, nomes dos shards no anel
+        # atual e no anterior (durante um rebalanceamento), e se esta instância move os tokens para o shard novo
+        self.token_shards = parse_shards(env.get("TOKEN_SHARDS"))
+        self.token_shard_ring = parse_ring(env.get("TOKEN_SHARD_RING"))
+        self.token_shard_previous_ring = parse_ring(env.get("TOKEN_SHARD_PREVIOUS_RING"))
+        self.token_shard_rebalance = env.get("TOKEN_SHARD_REBALANCE", "0") == "1"
+
+        # reutilização dos tokens em pedidos repetidos ao /token (ver token_reuse.py)
+        self.token_reuse = env.get("TOKEN_REUSE", "0") == "1"
+        self.token_reuse_min_lifetime = float(env.get("TOKEN_REUSE_MIN_LIFETIME", "600"))
+
+        # socket de validação (ver validation_socket.py)
+        self.validation_socket_path = env.get("VALIDATION_SOCKET")
+        self.validation_socket_mode = int(env.get("VALIDATION_SOCKET_MODE", "660"), 8)
+
+        # cache de tokens partilhada e snapshot (ver token_cache.py); só existe com TOKEN_CACHE_PATH definido,
+        # por exemplo /dev/shm/oauth-token-cache
+        self.token_cache_path = env.get("TOKEN_CACHE_PATH", "")
+        self.token_cache_slots = int(env.get("TOKEN_CACHE_SLOTS", "65536"))
+        self.token_snapshot_path = env.get("TOKEN_SNAPSHOT_PATH")
+
+        # sondas /healthz e /readyz (ver health.py): intervalo das verificações, tempo máximo do ping
+        # ao MongoDB e número de pedidos em curso a partir do qual o processo deixa de estar pronto (0 = sem limite)
+        self.health_interval = float(env.get("HEALTH_INTERVAL", "2"))
+        self.health_timeout = float(env.get("HEALTH_TIMEOUT", "2"))
+        self.ready_max_in_flight = int(env.get("READY_MAX_IN_FLIGHT", "64"))
+
+        # controlo de admissão (ver admission.py), por classe: "inicial/mínimo/máximo/latência alvo"
+        self.admission = env.get("ADMISSION", "1") == "1"
+        self.admission_validate = parse_admission(env.get("ADMISSION_VALIDATE", "32/4/256/0.05"))
+        self.admission_issue = parse_admission(env.get("ADMISSION_ISSUE", "8/2/64/2"))
+        # o /register/bulk é uma resposta em streaming, que dura o tempo da importação: classe própria, com limite fixo
+        self.admission_bulk = parse_admission(env.get("ADMISSION_BULK", "2/2/2/600"))
+
+        # token dos endpoints de administração (/admin/...), desligados se vazio
+        self.admin_token = env.get("ADMIN_TOKEN", "")
+
+        # registo de auditoria (ver audit.py), desligado com AUDIT_LOG_PATH vazio. O path pode conter {pid}.
+        # AUDIT_OVERFLOW: "drop" (descarta e conta os eventos com a fila cheia) ou "block" (espera até
+        # AUDIT_BLOCK_TIMEOUT segundos por espaço); AUDIT_FSYNC: "always", "interval" ou "never"
+        self.audit_log_path = env.get("AUDIT_LOG_PATH", "")
+        self.audit_queue_size = int(env.get("AUDIT_QUEUE_SIZE", "100000"))
+        self.audit_overflow = env.get("AUDIT_OVERFLOW", "drop")
+        self.audit_block_timeout = float(env.get("AUDIT_BLOCK_TIMEOUT", "0.1"))
+        self.audit_batch_size = int(env.get("AUDIT_BATCH_SIZE", "1000"))
+        self.audit_flush_interval = float(env.get("AUDIT_FLUSH_INTERVAL", "1"))
+        self.audit_fsync = env.get("AUDIT_FSYNC", "interval")
+        self.audit_fsync_interval = float(env.get("AUDIT_FSYNC_INTERVAL", "1"))
+        self.audit_max_bytes = int(env.get("AUDIT_MAX_BYTES", str(64 * 1024 * 1024)))
+        self.audit_backups = int(env.get("AUDIT_BACKUPS", "10"))
+        self.audit_compress = env.get("AUDIT_COMPRESS", "0") == "1"
+
+        # processos usados para as hashes bcrypt do registo em massa (None = número de CPUs)
+        workers = env.get("BCRYPT_WORKERS")
+        self.bcrypt_workers = int(workers) if workers else None
+
+        for name, value in overrides.items():
+            if not hasattr(self, name):
+                raise TypeError('Unknown setting: %s' % name)
+            setattr(self, name, value)
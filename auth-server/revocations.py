@@ -0,0 +1,182 @@
+#! python3
+
+## Feed de revogações para os resource servers.
+# Sempre que um token (ou todos os tokens de um cliente) deixa de ser válido é publicado um
+# evento com um número de sequência crescente. Os resource servers leem o feed a partir do
+# último número que receberam (cursor) e mantêm uma denylist local exata, podendo validar
+# os tokens sem perguntar ao servidor de autorização em cada pedido.
+#
+# Os eventos são guardados na coleção "revocations" (com o número de sequência como _id,
+# obtido de um contador atómico em "settings"), para que todos os workers e instâncias
+# partilhem a mesma sequência. Cada processo tem uma thread que vai lendo os novos eventos para
+# um ring buffer em memória, de onde são servidos os pedidos; só os subscritores muito
+# atrasados (cursor anterior ao início do buffer) é que leem da base de dados.
+#
+# Formato dos eventos:
+#   {'seq': 12, 'type': 'token', 'token_digest': '<sha256 em hex>', 'expires': ..., 'reason': 'logout'}
+#   {'seq': 13, 'type': 'client', 'client_id': '...', 'reason': 'deleted'}
+#   {'seq': 14, 'type': 'epoch', 'epoch': 3, 'reason': 'deploy'}  (invalida os tokens das gerações anteriores)
+#   {'seq': 15, 'type': 'client_tokens', 'client_ids': [...], 'issued_before': ..., 'expires': ..., 'reason': 'service_revoked'}
+#
+# Um evento "client" nega o cliente para sempre (o cliente foi apagado). Um evento "client_tokens"
+# só invalida os tokens dos clientes emitidos antes de "issued_before" (claim iat); os clientes
+# continuam registados e os tokens novos são válidos. O evento deixa de ter efeito em "expires",
+# quando já expiraram todos os tokens a que se aplica.
+
+import collections
+import datetime
+import json
+import threading
+import time
+
+from pymongo import ReturnDocument
+
+SEQUENCE_ID = 'revocation_seq'
+
+# tempo máximo que a thread espera por um número de sequência em falta (reservado por outro
+# processo mas ainda não inserido) antes de o ignorar
+GAP_TIMEOUT = 5
+
+
+class RevocationFeed:
+
+    def __init__(self, get_db, capacity=10000, poll_interval=1, retention=86400):
+        self.get_db = get_db
+        self.buffer = collections.deque(maxlen=capacity)
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.last_seq = None
+        # o buffer tem todos os eventos com seq > buffer_start (os anteriores saíram do buffer ou já existiam no arranque)
+        self.buffer_start = None
+        self.gap_since = None
+        self.condition = threading.Condition()
+        self.thread = None
+        self.listeners = []
+
+    # Publica um evento de revogação. Devolve o número de sequência atribuído.
+    def publish(self, event):
+        db = self.get_db()
+        seq = db['settings'].find_one_and_update({'_id': SEQUENCE_ID}, {'$inc': {'seq': 1}}, upsert=True, return_document=ReturnDocument.AFTER)['seq']
+        doc = dict(event, _id=seq, time=time.time())
+        # a coleção tem um índice TTL em expire_at, os eventos antigos são apagados pelo MongoDB
+        doc['expire_at'] = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.retention)
+        db['revocations'].insert_one(doc)
+        return seq
+
+    def revoke_token(self, digest, expires, reason):
+        return self.publish({'type': 'token', 'token_digest': digest.hex(), 'expires': expires, 'reason': reason})
+
+    def revoke_client(self, client_id, reason):
+        return self.publish({'type': 'client', 'client_id': client_id, 'reason': reason})
+
+    def revoke_client_tokens(self, client_ids, issued_before, expires, reason):
+        return self.publish({'type': 'client_tokens', 'client_ids': sorted(client_ids), 'issued_before': issued_before,
+                             'expires': expires, 'reason': reason})
+
+    def revoke_epoch(self, epoch, reason):
+        return self.publish({'type': 'epoch', 'epoch': epoch, 'reason': reason})
+
+    # Regista uma função chamada com cada novo evento lido pela thread (por exemplo para
+    # retirar das caches locais os tokens revogados noutros processos).
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # Inicia a thread que lê os novos eventos da base de dados para o buffer.
+    def start(self):
+        if self.thread is not None:
+            return
+        db = self.get_db()
+        db['revocations'].create_index('expire_at', expireAfterSeconds=0)
+        doc = db['settings'].find_one({'_id': SEQUENCE_ID})
+        self.last_seq = doc['seq'] if doc else 0
+        self.buffer_start = self.last_seq
+        self.thread = threading.Thread(target=self.run, name='revocation-feed', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                print("Revocation feed error: %s" % e)
+            time.sleep(self.poll_interval)
+
+    def poll(self):
+        events = []
+        last_seq = self.last_seq
+        for doc in self.get_db()['revocations'].find({'_id': {'$gt': last_seq}}).sort('_id', 1):
+            if doc['_id'] != last_seq + 1:
+                # falta um número de sequência: espera um pouco que o evento seja inserido
+                if self.gap_since is None:
+                    self.gap_since = time.time()
+                if time.time() - self.gap_since < GAP_TIMEOUT:
+                    break
+            self.gap_since = None
+            events.append(self.to_event(doc))
+            last_seq = doc['_id']
+        if not events:
+            return
+        for event in events:
+            for listener in self.listeners:
+                try:
+                    listener(event)
+                except Exception as e:
+                    print("Revocation listener error: %s" % e)
+        # o last_seq só avança com os eventos já no buffer, para quem acorda no wait os encontrar
+        with self.condition:
+            if len(self.buffer) + len(events) > self.buffer.maxlen:
+                self.buffer.extend(events)
+                self.buffer_start = self.buffer[0]['seq'] - 1
+            else:
+                self.buffer.extend(events)
+            self.last_seq = last_seq
+            self.condition.notify_all()
+
+    @staticmethod
+    def to_event(doc):
+        event = {k: v for k, v in doc.items() if k not in ('_id', 'expire_at')}
+        event['seq'] = doc['_id']
+        return event
+
+    # Devolve (eventos com seq > cursor, reset). reset é True quando há eventos que já não
+    # existem (o subscritor deve limpar a sua denylist e voltar a validar os tokens).
+    # Os números de sequência podem ter falhas legítimas (ver GAP_TIMEOUT), por isso o reset só é
+    # indicado quando o cursor é anterior ao evento mais antigo ainda guardado.
+    def since(self, cursor, limit=1000):
+        with self.condition:
+            if self.last_seq is not None and cursor >= self.last_seq:
+                return [], False
+            if self.buffer_start is not None and cursor >= self.buffer_start:
+                return [e for e in self.buffer if e['seq'] > cursor][:limit], False
+        # subscritor atrasado: os eventos já saíram do buffer, lê da base de dados
+        revocations = self.get_db()['revocations']
+        docs = list(revocations.find({'_id': {'$gt': cursor}}).sort('_id', 1).limit(limit))
+        events = [self.to_event(doc) for doc in docs]
+        reset = False
+        if cursor > 0:
+            oldest = next(iter(revocations.find({}, {'_id': 1}).sort('_id', 1).limit(1)), None)
+            reset = oldest is None or oldest['_id'] > cursor + 1
+        return events, reset
+
+    # Espera (até timeout segundos) que existam eventos depois do cursor (long-poll).
+    def wait(self, cursor, timeout, limit=1000):
+        with self.condition:
+            self.condition.wait_for(lambda: self.last_seq is not None and self.last_seq > cursor, timeout=timeout)
+        return self.since(cursor, limit)
+
+    # Gerador de server-sent events a partir do cursor. Envia um comentário a cada
+    # "heartbeat" segundos sem eventos, para a ligação não ser fechada por proxies.
+    def stream(self, cursor, heartbeat=15):
+        while True:
+            events, reset = self.wait(cursor, heartbeat)
+            if reset:
+                yield 'event: reset\ndata: {}\n\n'
+            for event in events:
+                yield 'id: %d\ndata: %s\n\n' % (event['seq'], json.dumps(event))
+                cursor = event['seq']
+            if not events:
+                yield ': keepalive\n\n'
+
+    # último número de sequência conhecido por este processo
+    def cursor(self):
+        return self.last_seq or 0
@@ -0,0 +1,261 @@
+#! python3
+
+## Scopes com padrões (wildcards) para nomes e versões de serviços.
+# Nos scopes registados (e nos pedidos ao /token) o nome e a versão de cada aplicação podem ser
+# expressões:
+#
+#   nome:    "appx"              apenas o serviço appx
+#            "mec.location.*"    toda a família: mec.location.zone, mec.location.zone.v2, ...
+#            "*"                 qualquer serviço
+#   versão:  "1.0"               apenas a versão "1.0" (comparação exata do texto)
+#            "1.x" ou "1.*"      qualquer versão 1.*  (intervalo [1, 2))
+#            "1.2.x"             qualquer versão 1.2.* (intervalo [1.2, 1.3))
+#            ">=1.2,<2"          intervalo [1.2, 2); também só ">=1.2" ou só "<2"
+#            "*"                 qualquer versão
+#
+# Os restantes campos (type, protocol, security do appServiceProduced) têm de ser iguais, ou
+# "*" no scope registado. Um pedido é aceite se cada aplicação pedida estiver contida num scope
+# registado da mesma lista: um nome exato na família, um intervalo dentro de outro, etc.
+#
+# Os scopes de cada cliente são compilados uma vez (ClientRegistry.prepare, no registo ou quando
+# o registo de clientes é recarregado) numa trie por lista, indexada pelos segmentos do nome. Cada
+# nó guarda, por combinação dos restantes campos, as versões exatas num conjunto e os intervalos
+# já unidos e ordenados, pesquisados com bisect. A verificação de uma aplicação percorre apenas os
+# segmentos do seu nome e faz uma pesquisa binária nos intervalos de cada nó encontrado.
+
+import bisect
+import re
+
+ANY = '*'
+INFINITY = (float('inf'),)
+NAME_FIELDS = ('name', 'version')
+
+NUMERIC_VERSION = re.compile(r'^\d+(\.\d+)*$')
+PREFIX_VERSION = re.compile(r'^(\d+(?:\.\d+)*)\.[x*]$')
+COMPARATOR = re.compile(r'^(>=|<)\s*(\d+(?:\.\d+)*)$')
+
+
+def version_tuple(text):
+    return tuple(int(part) for part in text.split('.'))
+
+
+# Converte uma expressão de versão em ('any',), ('exact', texto) ou ('range', início, fim).
+# Lança ValueError se a expressão não for válida.
+def parse_version(text):
+    if text is not None and not isinstance(text, str):
+        raise ValueError('Invalid version expression: %r' % (text,))
+    text = (text or '').strip()
+    if text in (ANY, 'x'):
+        return ('any',)
+    match = PREFIX_VERSION.match(text)
+    if match:
+        prefix = version_tuple(match.group(1))
+        return ('range', prefix, prefix[:-1] + (prefix[-1] + 1,))
+    if text[:1] in ('>', '<'):
+        start, end = (), INFINITY
+        for part in text.split(','):
+            match = COMPARATOR.match(part.strip())
+            if match is None:
+                raise ValueError('Invalid version expression: %s' % text)
+            if match.group(1) == '>=':
+                start = version_tuple(match.group(2))
+            else:
+                end = version_tuple(match.group(2))
+        if start >= end:
+            raise ValueError('Empty version range: %s' % text)
+        return ('range', start, end)
+    if not text or ANY in text:
+        raise ValueError('Invalid version expression: %s' % text)
+    return ('exact', text)
+
+
+# Converte um nome em (segmentos, família). "a.b.*" -> (['a', 'b'], True); "*" -> ([], True).
+def parse_name(text):
+    if text is not None and not isinstance(text, str):
+        raise ValueError('Invalid service name: %r' % (text,))
+    text = (text or '').strip()
+    if text == ANY:
+        return [], True
+    family = text.endswith('.' + ANY)
+    segments = (text[:-2] if family else text).split('.')
+    if not text or any(not segment or ANY in segment for segment in segments):
+        raise ValueError('Invalid service name: %s' % text)
+    return segments, family
+
+
+# Versões de um grupo de scopes registados: exatas, intervalos unidos e ordenados, ou qualquer.
+class VersionSet:
+
+    def __init__(self):
+        self.any = False
+        self.exact = set()
+        self.ranges = []
+        self.starts = []
+        self.ends = []
+
+    def add(self, version):
+        if version[0] == 'any':
+            self.any = True
+        elif version[0] == 'exact':
+            self.exact.add(version[1])
+        else:
+            self.ranges.append(version[1:])
+
+    # une os intervalos que se sobrepõem ou tocam, para cada pesquisa ser uma só bisect
+    def compile(self):
+        merged = []
+        for start, end in sorted(self.ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self.starts = [start for start, _ in merged]
+        self.ends = [end for _, end in merged]
+
+    # o intervalo [start, end) está contido num dos intervalos
+    def contains_range(self, start, end):
+        index = bisect.bisect_right(self.starts, start) - 1
+        return index >= 0 and end <= self.ends[index]
+
+    def covers(self, version):
+        if self.any:
+            return True
+        if version[0] == 'exact':
+            if version[1] in self.exact:
+                return True
+            if NUMERIC_VERSION.match(version[1]):
+                point = version_tuple(version[1])
+                return self.contains_range(point, point + (0,))
+            return False
+        if version[0] == 'range':
+            return self.contains_range(version[1], version[2])
+        return False
+
+
+class TrieNode:
+
+    def __init__(self):
+        self.children = {}
+        # restantes campos (tuplo ordenado de (campo, valor)) -> VersionSet
+        self.exact = {}
+        # scopes "<nome deste nó>.*": cobrem os nomes abaixo deste nó
+        self.family = {}
+
+
+# Trie dos scopes registados numa lista (por exemplo appServiceRequired) de um cliente.
+class ScopeTrie:
+
+    def __init__(self, apps=()):
+        self.root = TrieNode()
+        for app in apps:
+            self.add(app)
+        self.compile()
+
+    @staticmethod
+    def rest_key(app):
+        return tuple(sorted((field, value) for field, value in app.items() if field not in NAME_FIELDS))
+
+    def add(self, app):
+        check_app(app)
+        segments, family = parse_name(app.get('name'))
+        version = parse_version(app.get('version', ANY))
+        node = self.root
+        for segment in segments:
+            node = node.children.setdefault(segment, TrieNode())
+        groups = node.family if family else node.exact
+        groups.setdefault(self.rest_key(app), VersionSet()).add(version)
+
+    def compile(self):
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            for versions in list(node.exact.values()) + list(node.family.values()):
+                versions.compile()
+            nodes.extend(node.children.values())
+
+    # grupos (exatos e famílias) cujo nome cobre o nome pedido
+    def candidate_groups(self, name):
+        segments, family = parse_name(name)
+        node = self.root
+        groups = []
+        for segment in segments:
+            # as famílias dos nós acima cobrem qualquer nome mais abaixo (exato ou família)
+            groups.append(node.family)
+            node = node.children.get(segment)
+            if node is None:
+                return groups
+        groups.append(node.family if family else node.exact)
+        return groups
+
+    # a aplicação pedida (nome, versão e restantes campos) está contida num dos scopes registados
+    def covers(self, app):
+        check_app(app)
+        version = parse_version(app.get('version', ANY))
+        rest = self.rest_key(app)
+        for groups in self.candidate_groups(app.get('name')):
+            versions = groups.get(rest)
+            if versions is not None and versions.covers(version):
+                return True
+            for key, versions in groups.items():
+                if key != rest and rest_matches(key, rest) and versions.covers(version):
+                    return True
+        return False
+
+    # algum scope registado inclui o serviço (em alguma versão, se version for None), sem olhar aos restantes campos
+    def includes_service(self, name, version=None):
+        parsed = parse_version(version) if version is not None else None
+        for groups in self.candidate_groups(name):
+            for versions in groups.values():
+                if parsed is None or versions.covers(parsed):
+                    return True
+        return False
+
+
+# os campos registados (com "*" para qualquer valor) cobrem os campos pedidos
+def rest_matches(registered, requested):
+    if len(registered) != len(requested):
+        return False
+    for (field, value), (requested_field, requested_value) in zip(registered, requested):
+        if field != requested_field or (value != ANY and value != requested_value):
+            return False
+    return True
+
+
+# Uma aplicação é um dicionário com todos os valores em texto. Lança ValueError em vez de deixar
+# um AttributeError ou TypeError (por exemplo de um "foo" ou {"name": 5}) chegar ao pedido.
+def check_app(app):
+    if not isinstance(app, dict):
+        raise ValueError('Invalid app service: %r' % (app,))
+    for field, value in app.items():
+        if not isinstance(value, str):
+            raise ValueError('Invalid %s in app service: %r' % (field, value))
+
+
+# Os scopes são um dicionário de listas de aplicações. Lança ValueError se a estrutura não for válida.
+def check_scopes(scopes):
+    if scopes is None:
+        return
+    if not isinstance(scopes, dict):
+        raise ValueError('Invalid scopes: %r' % (scopes,))
+    for name, apps in scopes.items():
+        if apps is not None and not isinstance(apps, list):
+            raise ValueError('Invalid scope list %s: %r' % (name, apps))
+        for app in apps or []:
+            check_app(app)
+
+
+# tem algum padrão (para o índice dos serviços, que só conhece nomes e versões exatos)
+def has_wildcards(scopes):
+    for apps in (scopes or {}).values():
+        for app in apps or []:
+            if parse_name(app.get('name'))[1] or parse_version(app.get('version', ANY))[0] != 'exact':
+                return True
+            if any(value == ANY for field, value in app.items() if field not in NAME_FIELDS):
+                return True
+    return False
+
+
+# Compila os scopes de um cliente: lista -> ScopeTrie. Lança ValueError com a primeira expressão inválida.
+def compile_scopes(scopes):
+    check_scopes(scopes)
+    return {name: ScopeTrie(apps or []) for name, apps in (scopes or {}).items()}
@@ -0,0 +1,174 @@
+#! python3
+
+## Chaves de assinatura dos JWT com rotação (keyring).
+# As chaves são guardadas numa coleção do MongoDB (signing_keys), partilhada por todas as
+# instâncias do servidor, e identificadas por um "kid" que vai no cabeçalho de cada JWT.
+#
+# A rotação é feita por períodos fixos de "rotation_interval" segundos: o kid da chave de um
+# período é sempre "<prefixo>-<número do período>", por isso quando várias instâncias mudam de
+# período ao mesmo tempo todas tentam inserir o mesmo kid e apenas uma inserção é aceite
+# (índice único no _id). Uma chave assina durante o seu período e continua a verificar tokens
+# durante mais "grace" segundos, o que deve ser pelo menos a duração dos tokens que assina.
+#
+# As chaves já carregadas (bytes no HS256, objetos do cryptography no ES256/RS256) ficam em
+# memória por kid, para que nenhum pedido tenha de ler ou interpretar material de chaves.
+
+import json
+import secrets
+import threading
+import time
+
+import jwt
+from pymongo.errors import DuplicateKeyError
+
+ASYMMETRIC_ALGORITHMS = ('ES256', 'RS256')
+
+# tempo mínimo entre duas leituras da coleção causadas por um kid desconhecido
+RELOAD_INTERVAL = 5
+
+
+# token assinado com um kid que não está nas chaves em memória (e que não foi possível ler da base de dados)
+class UnknownKeyError(jwt.InvalidTokenError):
+    pass
+
+
+class KeyRing:
+
+    def __init__(self, get_collection, prefix, algorithm='HS256', rotation_interval=86400, grace=86400, legacy_secret=None,
+                 legacy_until=0):
+        self.get_collection = get_collection
+        self.prefix = prefix
+        self.algorithm = algorithm
+        self.rotation_interval = rotation_interval
+        self.grace = grace
+        # chave antiga (constante no código) usada apenas para verificar tokens sem kid, e só até
+        # legacy_until (timestamp; 0 = nunca). Como a chave é pública, deve ser pouco depois do
+        # primeiro deploy com rotação de chaves (mais a duração dos tokens antigos).
+        self.legacy_secret = legacy_secret
+        self.legacy_until = legacy_until
+        self.keys = {}
+        self.loaded_at = 0
+        self.lock = threading.Lock()
+
+    # kid da chave que assina no instante "now".
+    def current_kid(self, now):
+        return '%s-%d' % (self.prefix, int(now // self.rotation_interval))
+
+    # Assina as claims com a chave do período atual (criando-a se for preciso).
+    def sign(self, claims):
+        kid, key = self.signing_key()
+        # o algoritmo é o da chave (pode ter sido criada antes de uma mudança de SIGNING_ALGORITHM)
+        return jwt.encode(claims, key['signing_key'], algorithm=key['alg'], headers={'kid': kid})
+
+    # Verifica a assinatura (e o exp) de um token e devolve as claims.
+    # Lança jwt.InvalidTokenError se o token não for válido.
+    # Com require_kid os tokens sem kid (chave antiga) são sempre rejeitados; com reload=False um kid
+    # desconhecido não é procurado na base de dados e lança UnknownKeyError (por exemplo sem base de dados).
+    def decode(self, token, require_kid=False, reload=True, **kwargs):
+        kid = jwt.get_unverified_header(token).get('kid')
+        if kid is None:
+            if require_kid or self.legacy_secret is None or time.time() >= self.legacy_until:
+                raise jwt.InvalidTokenError('Token without kid')
+            return jwt.decode(token, self.legacy_secret, algorithms=['HS256'], **kwargs)
+        key = self.verifying_entry(kid, reload)
+        if key is None:
+            raise UnknownKeyError('Unknown signing key')
+        # cada chave verifica com o seu próprio algoritmo, para as chaves ainda no período de graça
+        # depois de uma mudança de SIGNING_ALGORITHM
+        return jwt.decode(token, key['verifying_key'], algorithms=[key['alg']], **kwargs)
+
+    def signing_key(self):
+        now = time.time()
+        kid = self.current_kid(now)
+        if kid not in self.keys:
+            self.rotate(kid, now)
+        return kid, self.keys[kid]
+
+    # devolve a chave já preparada para verificar tokens com este kid, ou None.
+    def verifying_key(self, kid, reload=True):
+        key = self.verifying_entry(kid, reload)
+        return key['verifying_key'] if key is not None else None
+
+    # entrada da chave (alg, verifying_key, ...) que verifica tokens com este kid, ou None.
+    def verifying_entry(self, kid, reload=True):
+        key = self.keys.get(kid)
+        if key is None and reload and kid is not None and kid.startswith(self.prefix + '-') and time.time() - self.loaded_at > RELOAD_INTERVAL:
+            # pode ser uma chave criada por outra instância
+            self.load()
+            key = self.keys.get(kid)
+        if key is None or key['verify_until'] < time.time():
+            return None
+        return key
+
+    # Cria (se ainda não existir) a chave do novo período e volta a carregar as chaves.
+    def rotate(self, kid, now):
+        with self.lock:
+            if kid in self.keys:
+                return
+            self.load()
+            if kid in self.keys:
+                return
+            period = int(now // self.rotation_interval)
+            sign_until = (period + 1) * self.rotation_interval
+            try:
+                self.get_collection().insert_one({
+                    '_id': kid,
+                    'alg': self.algorithm,
+                    'key': self.generate_key(),
+                    'sign_until': sign_until,
+                    'verify_until': sign_until + self.grace,
+                })
+                print("New signing key: %s" % kid)
+            except DuplicateKeyError:
+                # outra instância criou a chave ao mesmo tempo
+                pass
+            self.load()
+
+    # Lê da base de dados todas as chaves que ainda verificam e prepara as que ainda não estão em memória.
+    def load(self):
+        now = time.time()
+        keys = {}
+        for doc in self.get_collection().find({'_id': {'$regex': '^%s-' % self.prefix}, 'verify_until': {'$gt': now}}):
+            key = self.keys.get(doc['_id'])
+            if key is None:
+                key = self.prepare_key(doc)
+            keys[doc['_id']] = key
+        self.keys = keys
+        self.loaded_at = now
+
+    def prepare_key(self, doc):
+        if doc['alg'] in ASYMMETRIC_ALGORITHMS:
+            from cryptography.hazmat.primitives.serialization import load_pem_private_key
+            signing_key = load_pem_private_key(doc['key'], password=None)
+            verifying_key = signing_key.public_key()
+        else:
+            signing_key = verifying_key = doc['key']
+        return {'alg': doc['alg'], 'signing_key': signing_key, 'verifying_key': verifying_key, 'verify_until': doc['verify_until']}
+
+    # Chaves públicas (formato JWKS) que ainda verificam tokens, para os resource servers
+    # validarem os JWT localmente. Com HS256 a chave é secreta e a lista fica vazia.
+    def public_jwks(self):
+        if self.algorithm not in ASYMMETRIC_ALGORITHMS:
+            return []
+        self.signing_key()
+        jwks = []
+        for kid, key in self.keys.items():
+            if key['alg'] == 'ES256':
+                jwk = json.loads(jwt.algorithms.ECAlgorithm.to_jwk(key['verifying_key']))
+            else:
+                jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(key['verifying_key']))
+            jwk.update({'kid': kid, 'alg': key['alg'], 'use': 'sig'})
+            jwks.append(jwk)
+        return jwks
+
+    # gera o material de uma nova chave: 256 bits aleatórios no HS256, ou a chave privada em PEM.
+    def generate_key(self):
+        if self.algorithm not in ASYMMETRIC_ALGORITHMS:
+            return secrets.token_bytes(32)
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import ec, rsa
+        if self.algorithm == 'ES256':
+            private_key = ec.generate_private_key(ec.SECP256R1())
+        else:
+            private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        return private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
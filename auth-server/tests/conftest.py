@@ -0,0 +1,194 @@
+import itertools
+import os
+import re
+import sys
+import threading
+
+# os módulos do servidor são importados pelo nome, como no auth_server.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from token_store import DeleteResult
+
+
+################# substitutos em memória do MongoDB #####################
+# Também usados pelo misc/capacity_simulator.py; por isso este módulo não importa o pytest.
+
+# _id únicos entre coleções, como os ObjectId
+document_ids = itertools.count(1)
+
+class MemoryDatabase:
+
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection()
+        return self.collections[name]
+
+
+class MemoryCollection:
+
+    def __init__(self):
+        self.docs = {}
+        # índices de igualdade criados com create_index: campo -> valor -> _ids
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    # _ids dos documentos que podem corresponder ao filtro (por um índice, se houver)
+    def candidates(self, query):
+        for field, condition in query.items():
+            if field in self.indexes and not isinstance(condition, dict):
+                return list(self.indexes[field].get(condition, ()))
+        return list(self.docs)
+
+    def add(self, doc):
+        self.docs[doc['_id']] = doc
+        for field, index in self.indexes.items():
+            index.setdefault(doc.get(field), set()).add(doc['_id'])
+
+    def remove(self, key):
+        doc = self.docs.pop(key)
+        for field, index in self.indexes.items():
+            ids = index.get(doc.get(field))
+            ids.discard(key)
+            if not ids:
+                del index[doc.get(field)]
+
+    def insert_one(self, doc):
+        with self.lock:
+            doc.setdefault('_id', next(document_ids))
+            self.add(dict(doc))
+
+    def replace_one(self, query, doc, upsert=False):
+        with self.lock:
+            for key in self.candidates(query):
+                if matches(self.docs[key], query):
+                    self.remove(key)
+                    self.add(dict(doc, _id=key))
+                    return
+            if upsert:
+                doc.setdefault('_id', next(document_ids))
+                self.add(dict(doc))
+
+    def find_one(self, query, projection=None):
+        for key in self.candidates(query):
+            doc = self.docs.get(key)
+            if doc is not None and matches(doc, query):
+                return project(doc, projection)
+        return None
+
+    def find(self, query=None, projection=None):
+        query = query or {}
+        return MemoryCursor(project(doc, projection) for doc in (self.docs.get(key) for key in self.candidates(query))
+                            if doc is not None and matches(doc, query))
+
+    # apenas $set e $inc
+    def update_one(self, query, update, upsert=False):
+        with self.lock:
+            self.update(query, update, upsert)
+
+    def find_one_and_update(self, query, update, upsert=False, return_document=False, projection=None):
+        with self.lock:
+            before, after = self.update(query, update, upsert)
+        # ReturnDocument.AFTER é True
+        return project(after if return_document else before, projection)
+
+    def update(self, query, update, upsert):
+        key = next((key for key in self.candidates(query) if matches(self.docs[key], query)), None)
+        if key is None and not upsert:
+            return None, None
+        before = self.docs.get(key)
+        doc = dict(before) if before is not None else {k: v for k, v in query.items() if not isinstance(v, dict)}
+        for field, value in update.get('$set', {}).items():
+            doc[field] = value
+        for field, value in update.get('$inc', {}).items():
+            doc[field] = doc.get(field, 0) + value
+        if key is not None:
+            self.remove(key)
+        doc.setdefault('_id', next(document_ids))
+        self.add(doc)
+        return before, doc
+
+    def delete_one(self, query):
+        with self.lock:
+            for key in self.candidates(query):
+                if matches(self.docs[key], query):
+                    self.remove(key)
+                    return DeleteResult(1)
+        return DeleteResult(0)
+
+    def delete_many(self, query):
+        with self.lock:
+            keys = [key for key in self.candidates(query) if matches(self.docs[key], query)]
+            for key in keys:
+                self.remove(key)
+        return DeleteResult(len(keys))
+
+    def count_documents(self, query):
+        return len(self.find(query))
+
+    # apenas índices simples (um campo); os únicos não são verificados
+    def create_index(self, key, **kwargs):
+        if not isinstance(key, str):
+            return
+        with self.lock:
+            if key not in self.indexes:
+                self.indexes[key] = {}
+                for doc in self.docs.values():
+                    self.indexes[key].setdefault(doc.get(key), set()).add(doc['_id'])
+
+
+class MemoryCursor(list):
+
+    def sort(self, field, direction=1):
+        super().sort(key=lambda doc: doc[field], reverse=direction < 0)
+        return self
+
+    def limit(self, count):
+        return MemoryCursor(self[:count]) if count else self
+
+
+# projeções só com inclusões ou só com exclusões, como no MongoDB (o _id pode ser excluído nas duas)
+def project(doc, projection):
+    if doc is None:
+        return None
+    if not projection:
+        return dict(doc)
+    if any(value for value in projection.values()):
+        fields = {field for field, value in projection.items() if value}
+        if projection.get('_id', 1):
+            fields.add('_id')
+        return {field: value for field, value in doc.items() if field in fields}
+    return {field: value for field, value in doc.items() if field not in projection}
+
+
+# filtros suportados: igualdade, $or, $lt, $gt, $ne, $in, $exists e $regex
+def matches(doc, query):
+    for field, condition in query.items():
+        if field == '$or':
+            if not any(matches(doc, option) for option in condition):
+                return False
+        elif isinstance(condition, dict):
+            for op, value in condition.items():
+                if op == '$exists':
+                    ok = (field in doc) == value
+                elif field not in doc:
+                    ok = op == '$ne'
+                elif op == '$lt':
+                    ok = doc[field] < value
+                elif op == '$gt':
+                    ok = doc[field] > value
+                elif op == '$ne':
+                    ok = doc[field] != value
+                elif op == '$in':
+                    ok = doc[field] in value
+                elif op == '$regex':
+                    ok = re.search(value, doc[field]) is not None
+                else:
+                    raise ValueError('Unsupported operator: %s' % op)
+                if not ok:
+                    return False
+        elif doc.get(field) != condition:
+            return False
+    return True
@@ -0,0 +1,75 @@
+import pytest
+
+from admission import AdaptiveLimit, AdmissionController, parse_admission
+
+
+def test_parse_admission():
+    assert parse_admission('32/4/256/0.05') == (32, 4, 256, 0.05)
+    with pytest.raises(ValueError):
+        parse_admission('32/4/256')
+
+
+def test_rejects_over_the_limit_and_counts():
+    limit = AdaptiveLimit(2, 1, 10, target_latency=1)
+    assert limit.acquire() and limit.acquire()
+    assert not limit.acquire()
+    assert limit.stats()['in_flight'] == 2
+    assert limit.stats()['admitted'] == 2
+    assert limit.stats()['rejected'] == 1
+    limit.release(0.1, now=0)
+    assert limit.acquire()
+
+
+def test_every_admitted_request_is_released_once():
+    controller = AdmissionController({'issue': AdaptiveLimit(4, 1, 10, target_latency=1)})
+    admitted = sum(controller.acquire('issue') for _ in range(10))
+    assert admitted == 4
+    for _ in range(admitted):
+        controller.release('issue', 0.1, now=0)
+    stats = controller.stats()['issue']
+    assert stats['in_flight'] == 0
+    assert stats['rejected'] == 6
+
+
+def test_classes_have_separate_limits():
+    controller = AdmissionController({'validate': AdaptiveLimit(1, 1, 1, 1), 'issue': AdaptiveLimit(1, 1, 1, 1)})
+    assert controller.acquire('issue')
+    assert not controller.acquire('issue')
+    assert controller.acquire('validate')
+    # classes sem limite são sempre aceites
+    assert controller.acquire('other')
+    controller.release('other', 1)
+
+
+def test_limit_grows_while_fast_and_busy():
+    limit = AdaptiveLimit(4, 1, 8, target_latency=1)
+    for _ in range(100):
+        for _ in range(int(limit.limit)):
+            limit.acquire()
+        while limit.in_flight:
+            limit.release(0.1, now=0)
+    assert limit.limit == 8
+
+
+def test_limit_shrinks_once_per_target_latency_when_slow():
+    limit = AdaptiveLimit(10, 2, 20, target_latency=1)
+    for _ in range(5):
+        limit.acquire()
+    for _ in range(5):
+        limit.release(5, now=100)
+    assert limit.limit == pytest.approx(9)
+    limit.acquire()
+    limit.release(5, now=101)
+    assert limit.limit == pytest.approx(8.1)
+    for now in range(102, 150):
+        limit.acquire()
+        limit.release(5, now=now)
+    assert limit.limit == 2
+
+
+def test_retry_after_follows_latency():
+    limit = AdaptiveLimit(1, 1, 1, target_latency=10)
+    assert limit.retry_after() == 1
+    limit.acquire()
+    limit.release(3.2, now=0)
+    assert limit.retry_after() == 4
@@ -0,0 +1,64 @@
+import glob
+import gzip
+import json
+
+import pytest
+
+from audit import AuditLog
+
+
+def read_events(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_events_are_written_as_json_lines(tmp_path):
+    log = AuditLog(str(tmp_path / 'audit-{pid}.jsonl'), flush_interval=60, fsync='always')
+    log.record('token_issued', client_id='app', token_digest='ab')
+    log.record('token_revoked', client_id='app', reason='logout')
+    log.close()
+    events = read_events(log.path)
+    assert [(e['event'], e['client_id']) for e in events] == [('token_issued', 'app'), ('token_revoked', 'app')]
+    assert 'ts' in events[0] and '{pid}' not in log.path
+    assert log.stats()['written'] == 2
+
+
+def test_full_queue_drops_new_events(tmp_path):
+    log = AuditLog(str(tmp_path / 'audit.jsonl'), queue_size=2, batch_size=100, flush_interval=60)
+    for i in range(3):
+        log.record('validation_failed', n=i)
+    assert log.stats()['dropped'] == 1
+    log.close()
+    assert [e['n'] for e in read_events(log.path)] == [0, 1]
+
+
+def test_block_overflow_waits_for_the_writer(tmp_path):
+    log = AuditLog(str(tmp_path / 'audit.jsonl'), queue_size=1, batch_size=100, flush_interval=60, overflow='block',
+                   block_timeout=5)
+    for i in range(3):
+        log.record('validation_failed', n=i)
+    log.close()
+    assert log.stats()['dropped'] == 0
+    assert [e['n'] for e in read_events(log.path)] == [0, 1, 2]
+
+
+def test_rotation_keeps_the_newest_backups(tmp_path):
+    path = str(tmp_path / 'audit.jsonl')
+    log = AuditLog(path, batch_size=1, flush_interval=60, max_bytes=100, backups=2, compress=True, fsync='never')
+    for i in range(6):
+        log.record('token_issued', client_id='app-%d' % i, padding='x' * 40)
+        log.flush()
+    log.close()
+    backups = sorted(glob.glob(path + '.*'))
+    assert len(backups) == 2 and all(name.endswith('.gz') for name in backups)
+    assert log.stats()['rotations'] == 5
+    with gzip.open(backups[-1], 'rt') as f:
+        assert json.loads(f.read())['client_id'] == 'app-4'
+    assert read_events(path)[0]['client_id'] == 'app-5'
+
+
+def test_invalid_policies_are_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        AuditLog(str(tmp_path / 'audit.jsonl'), fsync='sometimes')
+    with pytest.raises(ValueError):
+        AuditLog(str(tmp_path / 'audit.jsonl'), overflow='wait')
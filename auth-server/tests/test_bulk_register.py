@@ -0,0 +1,94 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip('pymongo')
+from pymongo.errors import BulkWriteError
+
+import bulk_register
+from bulk_register import parse_definitions, register_stream
+
+
+# o bcrypt é lento e não interessa aqui
+@pytest.fixture(autouse=True)
+def fast_hash(monkeypatch):
+    monkeypatch.setattr(bulk_register, 'hash_secret', lambda client_secret: b'hash:' + client_secret.encode('utf-8'))
+
+
+class Collection:
+
+    # errors: detalhes do BulkWriteError de cada chamada ao insert_many (None = sem erro)
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.docs = []
+
+    def insert_many(self, documents, ordered=True):
+        details = self.errors.pop(0) if self.errors else None
+        if details is None:
+            self.docs.extend(documents)
+            return
+        failed = details['writeErrors'][0]['index'] if details.get('writeErrors') else len(documents)
+        self.docs.extend(documents[:failed])
+        if not details.get('writeErrors'):
+            # com um writeConcernError os documentos podem ter sido gravados
+            self.docs.extend(documents)
+        raise BulkWriteError(details)
+
+
+def register(lines, collection, fmt='jsonl', validate=lambda definition: None, batch_size=10):
+    make_document = lambda client_id, hashed, definition: {'client_id': client_id, 'client_secret': hashed}
+    with ThreadPoolExecutor(2) as pool:
+        return list(register_stream(parse_definitions(lines, fmt), validate, make_document, collection, pool, batch_size))
+
+
+def jsonl(count):
+    return [b'{"scopes": {}}\n'] * count
+
+
+def test_parse_definitions_reports_bad_lines():
+    lines = [b'{"scopes": {}}\n', b'\n', b'not json\n', b'[1]\n']
+    results = list(parse_definitions(lines, 'jsonl'))
+    assert [(number, error is None) for number, _, error in results] == [(1, True), (3, False), (4, False)]
+    csv = io.BytesIO(b'scopes,token_format\n"{}",reference\n{bad,\n')
+    results = list(parse_definitions(csv, 'csv'))
+    assert results[0] == (2, {'scopes': {}, 'token_format': 'reference'}, None)
+    assert results[1][0] == 3 and results[1][2].startswith('Invalid scopes JSON')
+
+
+def test_clients_are_registered_in_batches():
+    collection = Collection()
+    results = register(jsonl(5), collection, batch_size=2)
+    assert [result['line'] for result in results] == [1, 2, 3, 4, 5]
+    assert [doc['client_id'] for doc in collection.docs] == [result['client_id'] for result in results]
+    assert all(result['client_secret'] for result in results)
+
+
+def test_invalid_definitions_do_not_stop_the_batch():
+    collection = Collection()
+    lines = [b'{"scopes": {}}\n', b'{"scopes": {}, "bad": 1}\n', b'{"scopes": {}}\n']
+    results = register(lines, collection, validate=lambda definition: 'bad' if 'bad' in definition else None)
+    assert [result.get('error') for result in results] == ['bad', None, None]
+    assert len(collection.docs) == 2
+
+
+def test_a_write_error_fails_only_its_line():
+    collection = Collection({'writeErrors': [{'index': 1, 'errmsg': 'duplicate key'}]})
+    results = register(jsonl(4), collection)
+    assert [result.get('error') for result in results] == [None, 'duplicate key', None, None]
+    assert len(collection.docs) == 3
+
+
+def test_a_write_concern_error_fails_the_rest_of_the_batch():
+    collection = Collection(None, {'writeErrors': [], 'writeConcernErrors': [{'code': 64, 'errmsg': 'waiting for replication timed out'}]})
+    results = register(jsonl(4), collection, batch_size=2)
+    assert [result.get('error') for result in results] == [
+        None, None, 'Write concern error: waiting for replication timed out', 'Write concern error: waiting for replication timed out']
+
+
+def test_write_and_write_concern_errors_together():
+    collection = Collection({'writeErrors': [{'index': 1, 'errmsg': 'duplicate key'}],
+                             'writeConcernErrors': [{'code': 64, 'errmsg': 'timeout'}]})
+    results = register(jsonl(3), collection)
+    assert [result.get('error') for result in results] == [
+        'Write concern error: timeout', 'duplicate key', 'Write concern error: timeout']
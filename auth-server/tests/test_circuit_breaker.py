@@ -0,0 +1,64 @@
+import time
+
+import pytest
+
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+
+
+class FailingProbe:
+
+    def __init__(self):
+        self.ok = False
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if not self.ok:
+            raise ConnectionError('down')
+
+
+def fail():
+    raise ConnectionError('down')
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker('test', FailingProbe(), failure_threshold=2, probe_interval=3600)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            breaker.call(fail)
+    assert breaker.is_open
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: 'ok')
+
+
+def test_breaker_success_resets_the_failure_count():
+    breaker = CircuitBreaker('test', FailingProbe(), failure_threshold=2, probe_interval=3600)
+    with pytest.raises(ConnectionError):
+        breaker.call(fail)
+    assert breaker.call(lambda: 'ok') == 'ok'
+    with pytest.raises(ConnectionError):
+        breaker.call(fail)
+    assert not breaker.is_open
+
+
+def test_breaker_counts_slow_calls():
+    breaker = CircuitBreaker('test', FailingProbe(), failure_threshold=1, slow_call=0.01, probe_interval=3600)
+    assert breaker.call(time.sleep, 0.05) is None
+    assert breaker.is_open
+
+
+def test_breaker_closes_when_the_probe_succeeds():
+    probe = FailingProbe()
+    breaker = CircuitBreaker('test', probe, failure_threshold=1, probe_interval=0.01)
+    with pytest.raises(ConnectionError):
+        breaker.call(fail)
+    assert breaker.is_open
+    while probe.calls < 2:
+        time.sleep(0.01)
+    assert breaker.is_open
+    probe.ok = True
+    deadline = time.time() + 5
+    while breaker.is_open and time.time() < deadline:
+        time.sleep(0.01)
+    assert not breaker.is_open
+    assert breaker.call(lambda: 'ok') == 'ok'
@@ -0,0 +1,82 @@
+from client_registry import VERSION_ID, ClientRegistry, backfill_service_keys, service_keys
+from conftest import MemoryDatabase
+
+
+def client(client_id, *apps):
+    return {'client_id': client_id, 'client_secret': b'hash', 'scopes': {'read': list(apps)}}
+
+
+def make_registry(db):
+    return ClientRegistry(lambda: db['clients'], lambda: db['settings'], interval=0)
+
+
+def test_registry_reloads_when_the_version_changes():
+    db = MemoryDatabase()
+    db['clients'].insert_one(client('app-1', {'name': 'appx', 'version': '1.0'}))
+    registry = make_registry(db)
+    other = make_registry(db)
+    assert registry.load() == 1 and other.load() == 1
+
+    # outro processo regista um cliente: só é visto depois de a versão mudar
+    db['clients'].insert_one(client('app-2', {'name': 'appx', 'version': '2.0'}))
+    registry.poll()
+    assert set(registry.clients) == {'app-1'}
+    other.bump()
+    registry.poll()
+    assert set(registry.clients) == {'app-1', 'app-2'}
+    assert registry.version == db['settings'].find_one({'_id': VERSION_ID})['version']
+
+
+def test_unknown_clients_are_read_from_the_database():
+    db = MemoryDatabase()
+    registry = make_registry(db)
+    registry.load()
+    db['clients'].insert_one(client('app-1', {'name': 'appx', 'version': '1.0'}))
+    assert registry.get('app-1')['scope_sets']['read']
+    assert 'app-1' in registry.clients
+    assert registry.get('missing') is None
+    assert registry.get(None) is None
+
+
+def test_local_changes_update_the_copy_and_the_version():
+    db = MemoryDatabase()
+    registry = make_registry(db)
+    registry.load()
+    registry.added([client('app-1', {'name': 'appx', 'version': '1.0'})])
+    assert registry.clients_for_service('appx', '1.0') == {'app-1'}
+    registry.removed('app-1')
+    assert registry.clients_for_service('appx') == set()
+    assert db['settings'].find_one({'_id': VERSION_ID})['version'] == 2
+
+
+def test_malformed_clients_are_skipped():
+    db = MemoryDatabase()
+    db['clients'].insert_one(client('app-1', {'name': 'appx', 'version': '1.0'}))
+    db['clients'].insert_one({'client_id': 'bad', 'scopes': {'read': 'appx'}})
+    registry = make_registry(db)
+    assert registry.load() == 1
+    assert registry.get('bad') is None
+
+
+def test_clients_for_service_by_version_and_pattern():
+    db = MemoryDatabase()
+    registry = make_registry(db)
+    registry.added([
+        client('v1', {'name': 'mec.appx', 'version': '1.0'}),
+        client('v2', {'name': 'mec.appx', 'version': '2.0'}),
+        client('family', {'name': 'mec.*', 'version': '*'}),
+        client('other', {'name': 'other', 'version': '1.0'}),
+    ])
+    assert registry.clients_for_service('mec.appx') == {'v1', 'v2', 'family'}
+    assert registry.clients_for_service('mec.appx', '2.0') == {'v2', 'family'}
+    assert registry.clients_for_service('mec.appx', '1.x') == {'v1', 'family'}
+    assert registry.clients_for_service('other') == {'other'}
+
+
+def test_backfill_service_keys():
+    db = MemoryDatabase()
+    db['clients'].insert_one(client('app-1', {'name': 'appx', 'version': '1.0'}, {'name': 'appy'}))
+    assert backfill_service_keys(db['clients']) == 1
+    assert db['clients'].find_one({'client_id': 'app-1'})['service_keys'] == ['appx@1.0', 'appy@']
+    assert backfill_service_keys(db['clients']) == 0
+    assert service_keys(None) == []
@@ -0,0 +1,85 @@
+import time
+
+import pytest
+
+from circuit_breaker import CircuitBreaker
+from conftest import MemoryDatabase
+from token_store import ShardedTokenStore
+
+pytest.importorskip('flask')
+pytest.importorskip('pymongo')
+pytest.importorskip('jwt')
+
+import auth_server
+from config import Config
+from pymongo.errors import PyMongoError
+from tokens import new_reference_token, token_digest
+
+
+class FailingProbe:
+
+    def __call__(self):
+        raise PyMongoError('down')
+
+
+@pytest.fixture
+def server(monkeypatch):
+    # sem cache partilhada (TOKEN_CACHE_PATH vazio, o valor por omissão) e sem a base de dados
+    auth_server.create_app(Config({}, token_cache_path=''))
+    db = MemoryDatabase()
+    store = ShardedTokenStore(['main'], lambda name, operation: db['tokens'])
+    breaker = CircuitBreaker('token-store', FailingProbe(), failure_threshold=1, slow_call=None, probe_interval=3600)
+    monkeypatch.setattr(auth_server, 'token_store', store)
+    monkeypatch.setattr(auth_server, 'token_store_breaker', breaker)
+    monkeypatch.setattr(auth_server, 'started', True)
+    return auth_server.app.test_client(), store, breaker
+
+
+def add_token(store, client_id, expires):
+    access_token = new_reference_token()
+    store.insert_one({'token_digest': token_digest(access_token), 'client_id': client_id, 'scope': 'read',
+                      'expires': expires, 'epoch': auth_server.token_epoch})
+    return access_token
+
+
+def validate(client, access_token):
+    return client.post('/validate', headers={'Authorization': 'Bearer %s' % access_token}).status_code
+
+
+def test_degraded_mode_accepts_recently_validated_tokens(server):
+    client, store, breaker = server
+    seen = add_token(store, 'app-1', time.time() + 3600)
+    unseen = add_token(store, 'app-1', time.time() + 3600)
+    assert auth_server.token_cache is None
+    assert validate(client, seen) == 200
+
+    breaker.record_failure()
+    assert breaker.is_open
+    assert validate(client, seen) == 200
+    assert validate(client, unseen) == 503
+
+
+def test_degraded_mode_drops_revoked_and_expired_tokens(server):
+    client, store, breaker = server
+    revoked = add_token(store, 'app-1', time.time() + 3600)
+    other = add_token(store, 'app-2', time.time() + 3600)
+    expiring = add_token(store, 'app-2', time.time() + 0.2)
+    for access_token in (revoked, other, expiring):
+        assert validate(client, access_token) == 200
+
+    breaker.record_failure()
+    auth_server.invalidate_known_tokens({'type': 'client_tokens', 'client_ids': ['app-1'],
+                                         'issued_before': time.time(), 'expires': time.time() + 3600})
+    time.sleep(0.3)
+    assert validate(client, revoked) == 503
+    assert validate(client, other) == 200
+    assert validate(client, expiring) == 402
+
+
+def test_known_tokens_are_bounded(server, monkeypatch):
+    client, store, breaker = server
+    monkeypatch.setattr(auth_server.config, 'known_tokens_size', 2)
+    access_tokens = [add_token(store, 'app-1', time.time() + 3600) for _ in range(3)]
+    for access_token in access_tokens:
+        assert validate(client, access_token) == 200
+    assert list(auth_server.known_tokens) == [token_digest(t) for t in access_tokens[1:]]
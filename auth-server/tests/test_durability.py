@@ -0,0 +1,43 @@
+import pytest
+
+pytest.importorskip('pymongo')
+
+from pymongo import ReadPreference
+from pymongo.write_concern import WriteConcern
+
+from durability import DurabilityPolicy
+
+
+class Database:
+
+    def __getitem__(self, name):
+        return ('default', name)
+
+    def get_collection(self, name, read_preference=None, write_concern=None):
+        return (read_preference or write_concern, name)
+
+
+def test_most_specific_rule_wins():
+    policy = DurabilityPolicy('*=safe, tokens=fast, tokens.write=default, *.read=fast')
+    assert policy.mode('tokens', 'write') == 'default'
+    assert policy.mode('tokens', 'read') == 'fast'
+    assert policy.mode('clients', 'read') == 'fast'
+    assert policy.mode('clients', 'write') == 'safe'
+    assert DurabilityPolicy('', 'safe').mode('clients', 'write') == 'safe'
+
+
+def test_collection_options():
+    policy = DurabilityPolicy('tokens=fast,clients=safe')
+    db = Database()
+    assert policy.collection(db, 'tokens', 'read') == (ReadPreference.NEAREST, 'tokens')
+    assert policy.collection(db, 'tokens', 'write') == (WriteConcern(w=1, j=False), 'tokens')
+    assert policy.collection(db, 'clients', 'write') == (WriteConcern(w='majority', j=True), 'clients')
+    assert policy.collection(db, 'settings', 'write') == ('default', 'settings')
+
+
+@pytest.mark.parametrize('spec', ['tokens=slow', 'tokens.delete=fast'])
+def test_invalid_rules_are_rejected(spec):
+    with pytest.raises(ValueError):
+        DurabilityPolicy(spec)
+    with pytest.raises(ValueError):
+        DurabilityPolicy('', 'slow')
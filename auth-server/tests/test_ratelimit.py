@@ -0,0 +1,76 @@
+import pytest
+
+pytest.importorskip('pymongo')
+
+import ratelimit
+from ratelimit import MemoryBackend, RateLimiter, parse_limit
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, 'time', clock.time)
+    return clock
+
+
+def test_bucket_allows_a_burst_then_refills(clock):
+    limiter = RateLimiter(3, 0.5)
+    assert [limiter.hit('a') for _ in range(3)] == [0, 0, 0]
+    assert limiter.hit('a') == 2
+    clock.now += 1
+    assert limiter.hit('a') == 1
+    clock.now += 1
+    assert limiter.hit('a') == 0
+    assert limiter.hit('a') == 2
+
+
+def test_bucket_never_holds_more_than_its_capacity(clock):
+    limiter = RateLimiter(2, 1)
+    clock.now += 3600
+    assert [limiter.hit('a') for _ in range(3)] == [0, 0, 1]
+
+
+def test_rejected_request_does_not_spend_the_other_buckets(clock):
+    limiter = RateLimiter(1, 0.1)
+    assert limiter.hit('addr', 'user') == 0
+    assert limiter.hit('other', 'user') == 10
+    assert limiter.hit('other') == 0
+
+
+def test_check_does_not_consume(clock):
+    limiter = RateLimiter(1, 0.1)
+    assert limiter.check('a') == 0
+    assert limiter.check('a') == 0
+    assert limiter.hit('a') == 0
+    assert limiter.check('a') == 10
+
+
+def test_keys_are_prefixed_and_none_is_ignored(clock):
+    backend = MemoryBackend()
+    limiter = RateLimiter(5, 1, backend=backend, prefix='token:')
+    assert limiter.hit('a', None) == 0
+    assert list(backend.buckets) == ['token:a']
+
+
+def test_memory_backend_prunes_full_buckets(clock):
+    backend = MemoryBackend(max_keys=2)
+    limiter = RateLimiter(1, 1, backend=backend)
+    limiter.hit('a')
+    limiter.hit('b')
+    clock.now += 10
+    limiter.hit('c')
+    assert list(backend.buckets) == ['c']
+
+
+def test_parse_limit():
+    assert parse_limit('10/0.5') == (10.0, 0.5)
+    assert parse_limit('') is None
@@ -0,0 +1,114 @@
+import pytest
+
+pytest.importorskip('pymongo')
+
+import revocations
+from conftest import MemoryDatabase
+from revocations import GAP_TIMEOUT, SEQUENCE_ID, RevocationFeed
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(revocations.time, 'time', clock.time)
+    return clock
+
+
+@pytest.fixture
+def db():
+    return MemoryDatabase()
+
+
+def started_feed(db, capacity=10):
+    feed = RevocationFeed(lambda: db, capacity=capacity)
+    # sem a thread: os testes chamam poll()
+    feed.start = lambda: None
+    doc = db['settings'].find_one({'_id': SEQUENCE_ID})
+    feed.last_seq = feed.buffer_start = doc['seq'] if doc else 0
+    return feed
+
+
+def reserve_seq(db):
+    # número de sequência reservado por outro processo que ainda não inseriu o evento
+    return db['settings'].find_one_and_update({'_id': SEQUENCE_ID}, {'$inc': {'seq': 1}}, upsert=True, return_document=True)['seq']
+
+
+def test_events_reach_the_buffer_and_the_listeners(clock, db):
+    feed = started_feed(db)
+    received = []
+    feed.add_listener(received.append)
+    assert feed.revoke_client('app-1', 'deleted') == 1
+    assert feed.revoke_epoch(2, 'deploy') == 2
+    feed.poll()
+    assert [(e['seq'], e['type']) for e in received] == [(1, 'client'), (2, 'epoch')]
+    assert feed.cursor() == 2
+    events, reset = feed.since(0)
+    assert [e['seq'] for e in events] == [1, 2] and not reset
+    assert feed.since(1)[0][0]['epoch'] == 2
+    assert feed.since(2) == ([], False)
+
+
+def test_poll_waits_for_a_missing_seq_then_skips_it(clock, db):
+    feed = started_feed(db)
+    feed.revoke_client('app-1', 'deleted')
+    missing = reserve_seq(db)
+    feed.revoke_client('app-2', 'deleted')
+    feed.poll()
+    assert feed.cursor() == 1
+    clock.now += GAP_TIMEOUT / 2
+    feed.poll()
+    assert feed.cursor() == 1
+    # o evento em falta chega a tempo
+    db['revocations'].insert_one({'_id': missing, 'type': 'client', 'client_id': 'app-3', 'reason': 'deleted'})
+    feed.poll()
+    assert [e['client_id'] for e in feed.since(0)[0]] == ['app-1', 'app-3', 'app-2']
+
+    reserve_seq(db)
+    feed.revoke_client('app-4', 'deleted')
+    feed.poll()
+    assert feed.cursor() == 3
+    clock.now += GAP_TIMEOUT
+    feed.poll()
+    assert feed.cursor() == 5
+
+
+def test_late_subscribers_read_from_the_database(clock, db):
+    feed = started_feed(db, capacity=2)
+    for i in range(4):
+        feed.revoke_client('app-%d' % i, 'deleted')
+    feed.poll()
+    assert feed.buffer_start == 2
+    events, reset = feed.since(0)
+    assert [e['seq'] for e in events] == [1, 2, 3, 4] and not reset
+    events, reset = feed.since(2)
+    assert [e['seq'] for e in events] == [3, 4] and not reset
+
+
+def test_since_resets_only_when_events_were_lost(clock, db):
+    feed = started_feed(db, capacity=1)
+    for i in range(3):
+        feed.revoke_client('app-%d' % i, 'deleted')
+    reserve_seq(db)
+    feed.revoke_client('app-4', 'deleted')
+    feed.poll()
+    clock.now += GAP_TIMEOUT
+    feed.poll()
+    assert feed.cursor() == 5
+    # uma falha legítima na sequência não é um reset
+    assert feed.since(3) == ([e for e in feed.since(0)[0] if e['seq'] == 5], False)
+
+    # os eventos mais antigos expiraram (índice TTL)
+    db['revocations'].delete_many({'_id': {'$lt': 3}})
+    events, reset = feed.since(1)
+    assert [e['seq'] for e in events] == [3, 5] and reset
+    events, reset = feed.since(2)
+    assert not reset
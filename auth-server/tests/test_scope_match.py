@@ -0,0 +1,91 @@
+import pytest
+
+from scope_match import ScopeTrie, compile_scopes, has_wildcards, parse_name, parse_version
+
+
+def trie(*apps):
+    return ScopeTrie(apps)
+
+
+def test_parse_version():
+    assert parse_version('*') == ('any',)
+    assert parse_version('1.x') == ('range', (1,), (2,))
+    assert parse_version('1.2.*') == ('range', (1, 2), (1, 3))
+    assert parse_version('>=1.2,<2') == ('range', (1, 2), (2,))
+    assert parse_version('1.0') == ('exact', '1.0')
+    for invalid in ('', '1.*.2', '>=2,<1', '>1', 5):
+        with pytest.raises(ValueError):
+            parse_version(invalid)
+
+
+def test_parse_name():
+    assert parse_name('a.b.*') == (['a', 'b'], True)
+    assert parse_name('*') == ([], True)
+    assert parse_name('appx') == (['appx'], False)
+    for invalid in ('', 'a..b', 'a.*.b', None, 5):
+        with pytest.raises(ValueError):
+            parse_name(invalid)
+
+
+def test_exact_names_and_versions():
+    registered = trie({'name': 'appx', 'version': '1.0'})
+    assert registered.covers({'name': 'appx', 'version': '1.0'})
+    assert not registered.covers({'name': 'appx', 'version': '1.1'})
+    assert not registered.covers({'name': 'appy', 'version': '1.0'})
+
+
+def test_families():
+    registered = trie({'name': 'mec.location.*', 'version': '*'})
+    assert registered.covers({'name': 'mec.location.zone', 'version': '2'})
+    assert registered.covers({'name': 'mec.location.zone.v2', 'version': '2'})
+    assert registered.covers({'name': 'mec.location.zone.*', 'version': '2'})
+    assert not registered.covers({'name': 'mec.location', 'version': '2'})
+    assert not registered.covers({'name': 'mec.other', 'version': '2'})
+    assert trie({'name': '*', 'version': '*'}).covers({'name': 'anything', 'version': '9'})
+
+
+def test_version_ranges():
+    registered = trie({'name': 'appx', 'version': '1.x'}, {'name': 'appx', 'version': '>=2,<2.5'})
+    assert registered.covers({'name': 'appx', 'version': '1.4'})
+    assert registered.covers({'name': 'appx', 'version': '1.2.x'})
+    assert registered.covers({'name': 'appx', 'version': '2.4'})
+    assert not registered.covers({'name': 'appx', 'version': '2.5'})
+    assert not registered.covers({'name': 'appx', 'version': '1.x-beta'})
+
+
+def test_touching_ranges_are_merged():
+    registered = trie({'name': 'appx', 'version': '1.x'}, {'name': 'appx', 'version': '2.x'})
+    assert registered.covers({'name': 'appx', 'version': '>=1.5,<2.5'})
+
+
+def test_other_fields_must_match_or_be_any():
+    registered = trie({'name': 'napp', 'type': 'n', 'protocol': '*', 'version': '4.0', 'security': 'alpha'})
+    assert registered.covers({'name': 'napp', 'type': 'n', 'protocol': 'http', 'version': '4.0', 'security': 'alpha'})
+    assert not registered.covers({'name': 'napp', 'type': 'm', 'protocol': 'http', 'version': '4.0', 'security': 'alpha'})
+    assert not registered.covers({'name': 'napp', 'version': '4.0'})
+
+
+def test_includes_service():
+    registered = trie({'name': 'mec.*', 'version': '1.x'})
+    assert registered.includes_service('mec.zone')
+    assert registered.includes_service('mec.zone', '1.3')
+    assert not registered.includes_service('mec.zone', '2.0')
+    assert not registered.includes_service('other')
+
+
+def test_malformed_scopes_raise_value_error():
+    for scopes in ({'appServiceRequired': [{'name': 'a', 'version': '1'}, 'foo']},
+                   {'appServiceRequired': [{'name': 5, 'version': '1'}]},
+                   {'appServiceRequired': 'a'},
+                   ['a']):
+        with pytest.raises(ValueError):
+            compile_scopes(scopes)
+    with pytest.raises(ValueError):
+        trie({'name': 'a', 'version': '1'}).covers('foo')
+
+
+def test_has_wildcards():
+    assert not has_wildcards({'appServiceRequired': [{'name': 'a', 'version': '1'}]})
+    assert has_wildcards({'appServiceRequired': [{'name': 'a.*', 'version': '1'}]})
+    assert has_wildcards({'appServiceOptional': [{'name': 'a', 'version': '1.x'}]})
+    assert has_wildcards({'appServiceProduced': [{'name': 'a', 'version': '1', 'type': '*'}]})
@@ -0,0 +1,18 @@
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# módulos copiados sem alterações para o openid-server (ver "Shared modules" no README)
+SHARED_MODULES = ('admission', 'audit', 'circuit_breaker', 'durability', 'health', 'ratelimit', 'revocations',
+                  'signing_keys')
+
+
+@pytest.mark.parametrize('name', SHARED_MODULES)
+def test_shared_modules_are_identical(name):
+    with open(os.path.join(ROOT, 'auth-server', name + '.py'), 'rb') as f:
+        auth = f.read()
+    with open(os.path.join(ROOT, 'openid-server', name + '.py'), 'rb') as f:
+        openid = f.read()
+    assert auth == openid, '%s.py differs between auth-server and openid-server' % name
@@ -0,0 +1,112 @@
+import time
+
+import pytest
+
+pytest.importorskip('pymongo')
+jwt = pytest.importorskip('jwt')
+
+import signing_keys
+from conftest import MemoryDatabase
+from signing_keys import KeyRing, UnknownKeyError
+
+DAY = 86400
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(signing_keys.time, 'time', clock.time)
+    return clock
+
+
+@pytest.fixture
+def collection():
+    return MemoryDatabase()['signing_keys']
+
+
+def claims():
+    # o exp é verificado pelo pyjwt com a hora real
+    return {'client_id': 'app', 'exp': time.time() + 30 * DAY}
+
+
+def kid_of(token):
+    return jwt.get_unverified_header(token)['kid']
+
+
+def test_tokens_are_signed_with_the_key_of_the_current_period(clock, collection):
+    ring = KeyRing(lambda: collection, 'access', rotation_interval=DAY, grace=DAY)
+    token = ring.sign(claims())
+    assert kid_of(token) == 'access-%d' % (clock.now // DAY)
+    assert ring.decode(token)['client_id'] == 'app'
+    assert collection.count_documents({}) == 1
+
+
+def test_rotation_keeps_old_keys_during_the_grace_period(clock, collection):
+    ring = KeyRing(lambda: collection, 'access', rotation_interval=DAY, grace=DAY)
+    old = ring.sign(claims())
+    clock.now += DAY
+    new = ring.sign(claims())
+    assert kid_of(new) != kid_of(old)
+    assert ring.decode(old)['client_id'] == 'app'
+    assert ring.decode(new)['client_id'] == 'app'
+
+    # passado o período de graça a chave antiga deixa de verificar e deixa de ser carregada
+    clock.now += 2 * DAY
+    with pytest.raises(UnknownKeyError):
+        ring.decode(old, reload=False)
+    ring.sign(claims())
+    assert kid_of(old) not in ring.keys
+
+
+def test_keys_created_by_another_instance_are_loaded(clock, collection):
+    first = KeyRing(lambda: collection, 'access', rotation_interval=DAY, grace=DAY)
+    second = KeyRing(lambda: collection, 'access', rotation_interval=DAY, grace=DAY)
+    token = first.sign(claims())
+    with pytest.raises(UnknownKeyError):
+        second.decode(token, reload=False)
+    assert second.decode(token)['client_id'] == 'app'
+    assert second.signing_key()[0] == kid_of(token)
+
+
+def test_unknown_kids_do_not_reload_more_than_once_per_interval(clock, collection):
+    ring = KeyRing(lambda: collection, 'access', rotation_interval=DAY, grace=DAY)
+    ring.sign(claims())
+    loaded_at = ring.loaded_at
+    assert ring.verifying_key('access-1') is None
+    assert ring.loaded_at == loaded_at
+    clock.now += signing_keys.RELOAD_INTERVAL + 1
+    assert ring.verifying_key('access-1') is None
+    assert ring.loaded_at == clock.now
+    # kids de outro keyring nunca são procurados
+    assert ring.verifying_key('refresh-1') is None
+    assert ring.loaded_at == clock.now
+
+
+def test_legacy_tokens_are_accepted_only_until_legacy_until(clock, collection):
+    ring = KeyRing(lambda: collection, 'access', legacy_secret='old', legacy_until=clock.now + 60)
+    token = jwt.encode(claims(), 'old', algorithm='HS256')
+    assert ring.decode(token)['client_id'] == 'app'
+    with pytest.raises(jwt.InvalidTokenError):
+        ring.decode(token, require_kid=True)
+    clock.now += 60
+    with pytest.raises(jwt.InvalidTokenError):
+        ring.decode(token)
+
+
+def test_asymmetric_keys_are_published(clock, collection):
+    pytest.importorskip('cryptography')
+    ring = KeyRing(lambda: collection, 'access', algorithm='ES256', rotation_interval=DAY, grace=DAY)
+    token = ring.sign(claims())
+    jwks = ring.public_jwks()
+    assert [(jwk['kid'], jwk['alg']) for jwk in jwks] == [(kid_of(token), 'ES256')]
+    public_key = jwt.algorithms.ECAlgorithm.from_jwk(jwks[0])
+    assert jwt.decode(token, public_key, algorithms=['ES256'])['client_id'] == 'app'
@@ -0,0 +1,132 @@
+import hashlib
+import threading
+import time
+
+import pytest
+
+from token_cache import SEQ, SharedTokenCache, TOMBSTONES
+
+
+def digest(i):
+    return hashlib.sha256(b'token-%d' % i).digest()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return SharedTokenCache(str(tmp_path / 'cache'), slots=1024)
+
+
+def test_put_and_get(cache):
+    expires = time.time() + 60
+    cache.put(digest(1), 3, expires, 0x1, 'client')
+    assert cache.get(digest(1), 3, time.time()) == ('client', expires, 0x1)
+    assert cache.get(digest(2), 3, time.time()) is None
+
+
+def test_other_epoch_or_expired_is_a_miss(cache):
+    cache.put(digest(1), 3, time.time() + 60, 0x1, 'client')
+    assert cache.get(digest(1), 4, time.time()) is None
+    assert cache.get(digest(1), 3, time.time() + 120) is None
+
+
+def test_processes_share_the_file(tmp_path):
+    first = SharedTokenCache(str(tmp_path / 'cache'), slots=1024)
+    # o número de slots é o do ficheiro já criado
+    second = SharedTokenCache(str(tmp_path / 'cache'), slots=64)
+    assert second.slots == 1024
+    first.put(digest(1), 0, time.time() + 60, 0, 'client')
+    assert second.get(digest(1), 0, time.time())[0] == 'client'
+
+
+def test_slot_being_written_reads_as_empty(cache):
+    cache.put(digest(1), 0, time.time() + 60, 0, 'client')
+    offset = next(o for o in cache.positions(digest(1)) if cache.read_slot(o) is not None)
+    seq = SEQ.unpack_from(cache.mm, offset)[0]
+    # um escritor que morreu a meio deixa o seq ímpar
+    SEQ.pack_into(cache.mm, offset, seq + 1)
+    assert cache.get(digest(1), 0, time.time()) is None
+    # a escrita seguinte volta a deixar o seq par
+    cache.put(digest(1), 0, time.time() + 60, 0, 'client')
+    assert SEQ.unpack_from(cache.mm, offset)[0] % 2 == 0
+    assert cache.get(digest(1), 0, time.time())[0] == 'client'
+
+
+def test_concurrent_reads_never_see_torn_slots(cache):
+    stop = threading.Event()
+    errors = []
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            i += 1
+            cache.put(digest(1), i % 2, time.time() + 60, i % 2, 'client-%d' % (i % 2))
+
+    def reader():
+        while not stop.is_set():
+            for epoch in (0, 1):
+                found = cache.get(digest(1), epoch, time.time())
+                # epoch, scope mask e client_id são escritos juntos: uma leitura nunca os mistura
+                if found is not None and (found[2] != epoch or found[0] != 'client-%d' % epoch):
+                    errors.append(found)
+
+    threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.5)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def test_delete(cache):
+    cache.put(digest(1), 0, time.time() + 60, 0, 'client')
+    cache.delete(digest(1))
+    assert cache.get(digest(1), 0, time.time()) is None
+
+
+def test_put_after_revocation_is_discarded(cache):
+    generation = cache.generation()
+    # o token é revogado entre a leitura da base de dados e o put
+    cache.delete(digest(1))
+    cache.put(digest(1), 0, time.time() + 60, 0, 'client', generation)
+    assert cache.get(digest(1), 0, time.time()) is None
+    cache.put(digest(1), 0, time.time() + 60, 0, 'client', cache.generation())
+    assert cache.get(digest(1), 0, time.time()) is not None
+
+
+def test_delete_client_hides_only_older_tokens(cache):
+    for i in range(10):
+        cache.put(digest(i), 0, time.time() + 60, 0, 'a' if i % 2 else 'b')
+    cache.delete_client('a')
+    assert [i for i in range(10) if cache.get(digest(i), 0, time.time()) is not None] == [0, 2, 4, 6, 8]
+    assert {entry[4] for entry in cache.entries()} == {'b'}
+    time.sleep(0.01)
+    cache.put(digest(1), 0, time.time() + 60, 0, 'a')
+    assert cache.get(digest(1), 0, time.time())[0] == 'a'
+
+
+def test_evicted_tombstones_still_remove_tokens(cache):
+    cache.put(digest(1), 0, time.time() + 60, 0, 'a')
+    cache.delete_client('a')
+    for i in range(TOMBSTONES * 2):
+        cache.delete_client('other-%d' % i)
+    assert cache.get(digest(1), 0, time.time()) is None
+
+
+def test_delete_clients_in_bulk(cache):
+    for i in range(20):
+        cache.put(digest(i), 0, time.time() + 60, 0, 'c%d' % (i % 4))
+    cache.delete_clients({'c%d' % i for i in range(0, 2000, 2)})
+    assert {entry[4] for entry in cache.entries()} == {'c1', 'c3'}
+
+
+def test_snapshot_round_trip(cache, tmp_path):
+    now = time.time()
+    cache.put(digest(1), 0, now + 60, 0x3, 'client')
+    cache.put(digest(2), 0, now - 1, 0x1, 'client')
+    assert cache.save_snapshot(str(tmp_path / 'snapshot'), 42, now) == 1
+    other = SharedTokenCache(str(tmp_path / 'other'), slots=1024)
+    assert other.load_snapshot(str(tmp_path / 'snapshot'), now) == 42
+    assert other.get(digest(1), 0, now) == ('client', now + 60, 0x3)
+    assert other.get(digest(2), 0, now - 2) is None
@@ -0,0 +1,50 @@
+from token_reuse import PRUNE_INTERVAL, TokenReuseIndex, canonical_scopes
+
+NOW = 1000.0
+
+
+def test_canonical_scopes_ignore_order_and_empty_lists():
+    a = canonical_scopes({'read': [{'name': 'x', 'version': '1'}, {'name': 'y'}], 'write': []})
+    b = canonical_scopes({'read': [{'name': 'y'}, {'version': '1', 'name': 'x'}]})
+    assert a == b
+    assert a != canonical_scopes({'write': [{'name': 'y'}, {'name': 'x', 'version': '1'}]})
+
+
+def test_tokens_are_reused_until_close_to_expiry():
+    index = TokenReuseIndex(min_lifetime=600)
+    index.put('app', 'scopes', 'token', b'digest', NOW + 3600, 1, NOW)
+    assert index.get('app', 'scopes', 1, NOW) == ('token', NOW + 3600)
+    assert index.get('app', 'other', 1, NOW) is None
+    # de outra geração ou a menos de min_lifetime de expirar
+    assert index.get('app', 'scopes', 2, NOW) is None
+    assert index.get('app', 'scopes', 1, NOW + 3000) is None
+
+
+def test_newer_tokens_replace_older_ones():
+    index = TokenReuseIndex()
+    index.put('app', 'scopes', 'old', b'old', NOW + 3600, 1, NOW)
+    index.put('app', 'scopes', 'new', b'new', NOW + 3600, 1, NOW)
+    assert index.get('app', 'scopes', 1, NOW)[0] == 'new'
+    assert set(index.by_digest) == {b'new'}
+
+
+def test_revoked_tokens_are_not_reused():
+    index = TokenReuseIndex()
+    index.put('app-1', 'a', 'token-1', b'd1', NOW + 3600, 1, NOW)
+    index.put('app-1', 'b', 'token-2', b'd2', NOW + 3600, 1, NOW)
+    index.put('app-2', 'a', 'token-3', b'd3', NOW + 3600, 1, NOW)
+    index.put('app-3', 'a', 'token-4', b'd4', NOW + 3600, 1, NOW)
+    index.discard_token(b'd1')
+    assert index.get('app-1', 'a', 1, NOW) is None
+    assert index.get('app-1', 'b', 1, NOW) is not None
+    index.discard_clients({'app-1', 'app-2'})
+    assert set(index.by_digest) == {b'd4'}
+    index.discard_client('app-3')
+    assert index.entries == {} and index.by_digest == {}
+
+
+def test_expired_entries_are_pruned():
+    index = TokenReuseIndex(min_lifetime=600)
+    index.put('app-1', 'a', 'token-1', b'd1', NOW + 650, 1, NOW)
+    index.put('app-2', 'a', 'token-2', b'd2', NOW + 700 + PRUNE_INTERVAL * 2, 1, NOW + PRUNE_INTERVAL + 1)
+    assert list(index.by_digest) == [b'd2']
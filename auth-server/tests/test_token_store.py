@@ -0,0 +1,90 @@
+import collections
+import hashlib
+
+import pytest
+
+from conftest import MemoryDatabase
+from token_store import HashRing, ShardedTokenStore
+
+
+def digest(i):
+    return hashlib.sha256(b'token-%d' % i).digest()
+
+
+def make_store(shards, ring=None, previous_ring=None):
+    dbs = {name: MemoryDatabase() for name in shards}
+    store = ShardedTokenStore(list(dbs), lambda name, operation: dbs[name]['tokens'], ring=ring, previous_ring=previous_ring)
+    return store, dbs
+
+
+def test_ring_distribution_is_balanced():
+    ring = HashRing(['a', 'b', 'c', 'd'])
+    counts = collections.Counter(ring.node(digest(i)) for i in range(20000))
+    assert set(counts) == {'a', 'b', 'c', 'd'}
+    for count in counts.values():
+        assert abs(count - 5000) < 5000 * 0.2
+
+
+def test_ring_is_deterministic():
+    assert [HashRing(['a', 'b']).node(digest(i)) for i in range(100)] == [HashRing(['b', 'a']).node(digest(i)) for i in range(100)]
+
+
+def test_adding_a_node_only_moves_its_share():
+    before = HashRing(['a', 'b', 'c'])
+    after = HashRing(['a', 'b', 'c', 'd'])
+    moved = [i for i in range(20000) if before.node(digest(i)) != after.node(digest(i))]
+    # só mudam os tokens que passam para o shard novo, cerca de 1/4
+    assert all(after.node(digest(i)) == 'd' for i in moved)
+    assert abs(len(moved) - 5000) < 5000 * 0.2
+
+
+def test_empty_ring_is_rejected():
+    with pytest.raises(ValueError):
+        HashRing([])
+
+
+def test_unknown_shard_in_ring_is_rejected():
+    with pytest.raises(ValueError):
+        make_store(['a'], ring=['a', 'b'])
+
+
+def test_rebalance_moves_tokens_to_the_new_owner():
+    old_store, dbs = make_store(['a', 'b'])
+    for i in range(500):
+        old_store.insert_one({'token_digest': digest(i), 'client_id': 'c'})
+    dbs['c'] = MemoryDatabase()
+    store = ShardedTokenStore(list(dbs), lambda name, operation: dbs[name]['tokens'], previous_ring=['a', 'b'])
+
+    # durante o rebalanceamento os tokens são encontrados no shard anterior
+    assert all(store.find_one(digest(i)) is not None for i in range(500))
+
+    moved = store.rebalance()
+    assert moved == sum(1 for i in range(500) if store.ring.node(digest(i)) == 'c')
+    assert moved > 0
+    for i in range(500):
+        owner = store.ring.node(digest(i))
+        for name, db in dbs.items():
+            assert (db['tokens'].find_one({'token_digest': digest(i)}) is not None) == (name == owner)
+    store.previous_ring = None
+    assert all(store.find_one(digest(i)) is not None for i in range(500))
+
+
+def test_delete_during_rebalance_checks_both_owners():
+    old_store, dbs = make_store(['a'])
+    old_store.insert_one({'token_digest': digest(1), 'client_id': 'c'})
+    dbs['b'] = MemoryDatabase()
+    store = ShardedTokenStore(list(dbs), lambda name, operation: dbs[name]['tokens'], ring=['b'], previous_ring=['a'])
+    assert store.delete_one(digest(1)) == 1
+    assert store.find_one(digest(1)) is None
+    assert store.rebalance() == 0
+
+
+def test_memory_collection_index_follows_changes():
+    collection = MemoryDatabase()['tokens']
+    collection.create_index('client_id')
+    collection.insert_one({'token_digest': digest(1), 'client_id': 'x'})
+    collection.insert_one({'token_digest': digest(2), 'client_id': 'y'})
+    assert len(collection.find({'client_id': 'x'})) == 1
+    assert collection.delete_many({'client_id': 'x'}).deleted_count == 1
+    assert collection.find({'client_id': 'x'}) == []
+    assert collection.count_documents({}) == 1
@@ -0,0 +1,58 @@
+import os
+import socket
+import stat
+
+import pytest
+
+from validation_socket import (LENGTH, STATUS_ERROR, STATUS_INVALID, STATUS_VALID, start_validation_socket,
+                               validate_tokens)
+
+TOKENS = {'good': {'client_id': 'app-1', 'scope': 'read', 'expires': 1700000000.5}}
+
+
+def token_info(token):
+    if token == 'broken':
+        raise RuntimeError('store unavailable')
+    return TOKENS.get(token)
+
+
+@pytest.fixture
+def path(tmp_path):
+    # os caminhos dos sockets Unix têm um limite de tamanho
+    path = os.path.join(str(tmp_path), 'v.sock')
+    server = start_validation_socket(path, token_info, lambda scope: 0x1 if scope == 'read' else 0)
+    yield path
+    server.shutdown()
+    server.server_close()
+
+
+def test_pipelined_requests_are_answered_in_order(path):
+    assert validate_tokens(path, ['good', 'unknown', 'broken', 'good']) == [
+        (STATUS_VALID, 1700000000, 0x1, 'app-1'),
+        (STATUS_INVALID, 0, 0, ''),
+        (STATUS_ERROR, 0, 0, ''),
+        (STATUS_VALID, 1700000000, 0x1, 'app-1'),
+    ]
+
+
+def test_requests_split_across_packets(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        message = LENGTH.pack(4) + b'good'
+        sock.sendall(message[:3])
+        sock.sendall(message[3:])
+        reader = sock.makefile('rb')
+        (length,) = LENGTH.unpack(reader.read(LENGTH.size))
+        assert reader.read(length)[0] == STATUS_VALID
+
+
+def test_socket_file_is_recreated_with_the_given_mode(tmp_path):
+    path = os.path.join(str(tmp_path), 'v.sock')
+    open(path, 'w').close()
+    server = start_validation_socket(path, token_info, lambda scope: 0, mode=0o600)
+    try:
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+        assert validate_tokens(path, ['good'])[0][0] == STATUS_VALID
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,332 @@
+#! python3
+
+## Cache de tokens validados partilhada entre processos (workers) do mesmo host.
+# A cache é um ficheiro mapeado em memória (por exemplo em /dev/shm) com uma tabela de tamanho
+# fixo, reservada no arranque, de "slots" de 128 bytes:
+#
+#   seq u32 | epoch u32 | digest 32 bytes | expires f64 | scope mask u32 | tamanho do client_id u8 | client_id (até 64 bytes) | stored_at f64
+#
+# A posição de um token é dada pelos primeiros bytes do seu digest SHA-256 (open addressing):
+# o token pode estar em qualquer um dos PROBES slots seguintes, e quando estão todos ocupados é
+# substituído o que expira primeiro. Como a pesquisa percorre sempre os PROBES slots, apagar um
+# token é só limpar o seu slot.
+#
+# As leituras não usam locks (seqlock): o escritor torna o seq ímpar antes de alterar o slot e
+# par no fim, e o leitor repete a leitura se o seq mudou ou era ímpar. As escritas são raras
+# (só depois de uma validação na base de dados) e usam um lock por grupo de slots, entre
+# processos (fcntl.lockf sobre um byte do header) e entre threads do mesmo processo
+# (threading.Lock). Se dois escritores escolherem o mesmo slot vazio para tokens diferentes,
+# o segundo substitui o primeiro, o que numa cache não tem problema.
+#
+# Revogações:
+#  - o header tem um contador de gerações, incrementado em cada remoção. Quem vai guardar um token
+#    lê a geração antes de o procurar na base de dados e passa-a ao put; depois de escrever o slot,
+#    o put desfaz a escrita se a geração mudou entretanto. Assim um token revogado entre a leitura da
+#    base de dados e o put nunca fica na cache.
+#  - remover os tokens de um cliente não percorre a tabela: é escrita uma lápide (tombstone) com o
+#    instante da revogação numa tabela de TOMBSTONES entradas, indexada por um hash do client_id, e
+#    os tokens desse cliente guardados antes desse instante deixam de ser devolvidos pelo get. Só
+#    quando as TOMBSTONE_PROBES posições de uma lápide nova estão ocupadas é que a lápide mais
+#    antiga é substituída e os tokens a que se aplicava são apagados numa passagem pela tabela.
+#
+# Para os reinícios não começarem com a cache vazia, o conteúdo da cache pode ser guardado num
+# snapshot em disco (save_snapshot) e carregado no arranque (load_snapshot). O snapshot tem um
+# header e registos de tamanho fixo, só com os tokens que ainda não expiraram, e é lido com mmap.
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'OATC0002'
+HEADER = struct.Struct('<8sI')
+HEADER_SIZE = 64
+SLOT = struct.Struct('<II32sdIB3x64sd')
+SEQ = struct.Struct('<I')
+PROBES = 8
+STRIPES = 32
+# os locks dos grupos são feitos nos bytes STRIPE_LOCK_BASE .. STRIPE_LOCK_BASE + STRIPES do header;
+# o byte seguinte é o lock da geração e das lápides
+STRIPE_LOCK_BASE = 16
+META_LOCK = STRIPES
+GENERATION = struct.Struct('<Q')
+GENERATION_OFFSET = 56
+# seq u32 | hash do client_id u64 (0 se vazia) | instante da revogação f64
+TOMBSTONE = struct.Struct('<I4xQd')
+TOMBSTONES = 4096
+TOMBSTONE_PROBES = 8
+# acima deste número de clientes, delete_clients percorre a tabela uma vez em vez de escrever lápides
+BULK_DELETE = TOMBSTONES // 8
+MAX_CLIENT_ID = 64
+# número de tentativas de leitura de um slot a ser escrito (um escritor que morreu a meio
+# deixa o seq ímpar para sempre, e o slot passa a ser considerado vazio)
+READ_RETRIES = 100
+
+SNAPSHOT_MAGIC = b'OATS0001'
+# magic | cursor do feed de revogações u64 | número de registos u32 | instante em que foi guardado f64
+SNAPSHOT_HEADER = struct.Struct('<8sQId')
+# epoch u32 | digest 32 bytes | expires f64 | scope mask u32 | tamanho do client_id u8 | client_id
+SNAPSHOT_RECORD = struct.Struct('<I32sdIB3x64s')
+
+
+class SharedTokenCache:
+
+    def __init__(self, path, slots=65536):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, HEADER.size, 0)
+        try:
+            header = os.pread(self.fd, HEADER.size, 0)
+            if len(header) == HEADER.size and HEADER.unpack(header)[0] == MAGIC:
+                # ficheiro já criado por outro processo: usa o mesmo número de slots
+                slots = HEADER.unpack(header)[1]
+            else:
+                # ficheiro novo ou de outra versão: começa vazio
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, HEADER_SIZE + slots * SLOT.size + TOMBSTONES * TOMBSTONE.size)
+                os.pwrite(self.fd, HEADER.pack(MAGIC, slots), 0)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, HEADER.size, 0)
+        self.slots = slots
+        self.tombstones_base = HEADER_SIZE + slots * SLOT.size
+        self.mm = mmap.mmap(self.fd, self.tombstones_base + TOMBSTONES * TOMBSTONE.size)
+        self.locks = [threading.Lock() for _ in range(STRIPES + 1)]
+
+    def offset(self, index):
+        return HEADER_SIZE + (index % self.slots) * SLOT.size
+
+    # geração atual: lida antes da pesquisa na base de dados e passada ao put
+    def generation(self):
+        return GENERATION.unpack_from(self.mm, GENERATION_OFFSET)[0]
+
+    # incrementa a geração antes de uma remoção (chamada com o lock da geração)
+    def next_generation(self):
+        GENERATION.pack_into(self.mm, GENERATION_OFFSET, (self.generation() + 1) & 0xffffffffffffffff)
+
+    def positions(self, digest):
+        start = int.from_bytes(digest[:8], 'little') % self.slots
+        return [self.offset(start + i) for i in range(PROBES)]
+
+    # leitura sem locks (seqlock) de um registo com o seq no início; devolve None se estiver a ser escrito
+    def read_locked(self, record, offset):
+        for _ in range(READ_RETRIES):
+            seq = SEQ.unpack_from(self.mm, offset)[0]
+            if seq & 1:
+                continue
+            values = record.unpack_from(self.mm, offset)
+            if SEQ.unpack_from(self.mm, offset)[0] == seq:
+                return values
+        return None
+
+    # leitura de um slot sem locks; devolve None se estiver vazio
+    def read_slot(self, offset):
+        slot = self.read_locked(SLOT, offset)
+        if slot is None:
+            return None
+        _, epoch, digest, expires, mask, length, client_id, stored_at = slot
+        if expires == 0:
+            return None
+        return digest, epoch, expires, mask, client_id[:length].decode('utf-8'), stored_at
+
+    # Devolve (client_id, expires, scope mask) de um token em cache e ainda não expirado, ou None.
+    def get(self, digest, epoch, now):
+        for offset in self.positions(digest):
+            slot = self.read_slot(offset)
+            if slot is not None and slot[0] == digest:
+                if slot[1] != epoch or slot[2] < now or self.revoked(slot):
+                    return None
+                return slot[4], slot[2], slot[3]
+        return None
+
+    # generation: valor de generation() lido antes de o token ser procurado na base de dados. Se a geração
+    # mudou entretanto (alguma remoção), o token pode ter sido revogado e não é guardado.
+    def put(self, digest, epoch, expires, mask, client_id, generation=None):
+        client_id = client_id.encode('utf-8')
+        if len(client_id) > MAX_CLIENT_ID:
+            return
+        # escolhe o slot: o do próprio token, um vazio, ou o que expira primeiro
+        target = None
+        oldest = None
+        for offset in self.positions(digest):
+            slot = self.read_slot(offset)
+            if slot is None or slot[0] == digest:
+                target = offset
+                break
+            if oldest is None or slot[2] < oldest[1]:
+                oldest = (offset, slot[2])
+        if target is None:
+            target = oldest[0]
+        with self.stripe(target):
+            self.write_slot(target, epoch, digest, expires, mask, client_id, time.time())
+            # a remoção incrementa a geração antes de limpar os slots: se mudou, a escrita é desfeita
+            if generation is not None and self.generation() != generation:
+                self.write_slot(target, 0, b'', 0, 0, b'', 0)
+
+    def delete(self, digest):
+        with self.meta_lock():
+            self.next_generation()
+        for offset in self.positions(digest):
+            slot = self.read_slot(offset)
+            if slot is not None and slot[0] == digest:
+                self.clear_slot(offset)
+
+    # remove todos os tokens de um cliente (com uma lápide, sem percorrer a tabela)
+    def delete_client(self, client_id):
+        with self.meta_lock():
+            self.next_generation()
+            self.write_tombstone(client_key(client_id), time.time())
+
+    # remove todos os tokens de um conjunto de clientes; muitos clientes de uma vez numa só passagem pela tabela
+    def delete_clients(self, client_ids):
+        if len(client_ids) <= BULK_DELETE:
+            for client_id in client_ids:
+                self.delete_client(client_id)
+            return
+        with self.meta_lock():
+            self.next_generation()
+        self.purge(lambda slot: slot[4] in client_ids)
+
+    # apaga numa passagem pela tabela os tokens para os quais matches(slot) é verdadeiro
+    def purge(self, matches):
+        for index in range(self.slots):
+            offset = self.offset(index)
+            slot = self.read_slot(offset)
+            if slot is not None and matches(slot):
+                self.clear_slot(offset)
+
+    def clear_slot(self, offset):
+        with self.stripe(offset):
+            self.write_slot(offset, 0, b'', 0, 0, b'', 0)
+
+    def write_slot(self, offset, epoch, digest, expires, mask, client_id, stored_at):
+        # o seq fica ímpar durante a escrita (mesmo que tenha ficado ímpar de um escritor que morreu)
+        seq = ((SEQ.unpack_from(self.mm, offset)[0] + 1) | 1) & 0xffffffff
+        SEQ.pack_into(self.mm, offset, seq)
+        SLOT.pack_into(self.mm, offset, seq, epoch, digest, expires, mask, len(client_id), client_id, stored_at)
+        SEQ.pack_into(self.mm, offset, (seq + 1) & 0xffffffff)
+
+    def tombstone_offsets(self, key):
+        return [self.tombstones_base + ((key + i) % TOMBSTONES) * TOMBSTONE.size for i in range(TOMBSTONE_PROBES)]
+
+    # instante da revogação dos tokens do cliente, ou None se não tiver lápide
+    def revoked_at(self, client_id):
+        key = client_key(client_id)
+        for offset in self.tombstone_offsets(key):
+            tombstone = self.read_locked(TOMBSTONE, offset)
+            if tombstone is None or tombstone[1] == 0:
+                return None
+            if tombstone[1] == key:
+                return tombstone[2]
+        return None
+
+    # o token do slot foi guardado antes de os tokens do seu cliente serem revogados
+    def revoked(self, slot):
+        revoked_at = self.revoked_at(slot[4])
+        return revoked_at is not None and slot[5] <= revoked_at
+
+    # Escreve a lápide de um cliente (chamada com o lock da geração). Quando as posições estão todas
+    # ocupadas por outros clientes é substituída a lápide mais antiga, depois de apagar os tokens que escondia.
+    def write_tombstone(self, key, revoked_at):
+        oldest = None
+        for offset in self.tombstone_offsets(key):
+            _, other, other_at = TOMBSTONE.unpack_from(self.mm, offset)
+            if other == 0 or other == key:
+                self.write_tombstone_at(offset, key, revoked_at)
+                return
+            if oldest is None or other_at < oldest[2]:
+                oldest = (offset, other, other_at)
+        offset, other, other_at = oldest
+        self.purge(lambda slot: slot[5] <= other_at and client_key(slot[4]) == other)
+        self.write_tombstone_at(offset, key, revoked_at)
+
+    def write_tombstone_at(self, offset, key, revoked_at):
+        seq = ((SEQ.unpack_from(self.mm, offset)[0] + 1) | 1) & 0xffffffff
+        SEQ.pack_into(self.mm, offset, seq)
+        TOMBSTONE.pack_into(self.mm, offset, seq, key, revoked_at)
+        SEQ.pack_into(self.mm, offset, (seq + 1) & 0xffffffff)
+
+    # gerador com todos os tokens em cache (sem os revogados): (digest, epoch, expires, mask, client_id)
+    def entries(self):
+        for index in range(self.slots):
+            slot = self.read_slot(self.offset(index))
+            if slot is not None and not self.revoked(slot):
+                yield slot[:5]
+
+    def clear(self):
+        with self.meta_lock():
+            self.next_generation()
+            self.purge(lambda slot: True)
+            # só depois de a tabela estar vazia, para nenhum token revogado voltar a aparecer
+            for index in range(TOMBSTONES):
+                self.write_tombstone_at(self.tombstones_base + index * TOMBSTONE.size, 0, 0)
+
+    # Guarda os tokens não expirados num snapshot, junto com o cursor do feed de revogações
+    # (os eventos até esse cursor já foram aplicados à cache). O ficheiro é escrito num ficheiro
+    # temporário e depois renomeado, para nunca ficar um snapshot incompleto.
+    def save_snapshot(self, path, cursor, now):
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        count = 0
+        with open(tmp, 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, cursor, 0, now))
+            for digest, epoch, expires, mask, client_id in self.entries():
+                if expires > now:
+                    client_id = client_id.encode('utf-8')
+                    f.write(SNAPSHOT_RECORD.pack(epoch, digest, expires, mask, len(client_id), client_id))
+                    count += 1
+            f.seek(0)
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, cursor, count, now))
+        os.replace(tmp, path)
+        return count
+
+    # Carrega um snapshot para a cache, ignorando os tokens já expirados.
+    # Devolve o cursor do feed de revogações guardado no snapshot, ou None se não existir snapshot válido.
+    def load_snapshot(self, path, now):
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size < SNAPSHOT_HEADER.size:
+                return None
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                magic, cursor, count, saved_at = SNAPSHOT_HEADER.unpack_from(mm, 0)
+                if magic != SNAPSHOT_MAGIC or size < SNAPSHOT_HEADER.size + count * SNAPSHOT_RECORD.size:
+                    return None
+                for i in range(count):
+                    epoch, digest, expires, mask, length, client_id = SNAPSHOT_RECORD.unpack_from(mm, SNAPSHOT_HEADER.size + i * SNAPSHOT_RECORD.size)
+                    if expires > now:
+                        self.put(digest, epoch, expires, mask, client_id[:length].decode('utf-8'))
+        return cursor
+
+    # lock do grupo a que pertence o slot no offset dado
+    def stripe(self, offset):
+        return StripeLock(self, ((offset - HEADER_SIZE) // SLOT.size) % STRIPES)
+
+    # lock da geração e das lápides
+    def meta_lock(self):
+        return StripeLock(self, META_LOCK)
+
+
+# hash estável (igual em todos os processos) do client_id, nunca 0 (0 marca uma lápide vazia)
+def client_key(client_id):
+    return int.from_bytes(hashlib.blake2b(client_id.encode('utf-8'), digest_size=8).digest(), 'little') | 1
+
+
+class StripeLock:
+
+    def __init__(self, cache, stripe):
+        self.cache = cache
+        self.lock = cache.locks[stripe]
+        self.byte = STRIPE_LOCK_BASE + stripe
+
+    def __enter__(self):
+        self.lock.acquire()
+        fcntl.lockf(self.cache.fd, fcntl.LOCK_EX, 1, self.byte)
+
+    def __exit__(self, *args):
+        fcntl.lockf(self.cache.fd, fcntl.LOCK_UN, 1, self.byte)
+        self.lock.release()
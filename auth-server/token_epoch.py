@@ -0,0 +1,75 @@
+#! python3
+
+## Gerações (epochs) dos tokens de acesso.
+# Em vez de apagar a coleção de tokens sempre que o servidor arranca, existe um único
+# documento com a geração atual (oauth.settings, _id "token_epoch"). Cada token guarda a
+# geração em que foi emitido e só é válido se for igual à geração atual. Para invalidar todos
+# os tokens basta incrementar a geração, o que é feito uma vez por deploy:
+#
+#   python token_epoch.py
+#
+# O incremento é publicado no feed de revogações (evento "epoch"), para que os resource servers
+# que verificam os JWT localmente deixem de aceitar os tokens das gerações anteriores.
+#
+# Os tokens das gerações antigas são apagados mais tarde por uma thread em segundo plano,
+# que também vai lendo a geração atual para os workers acompanharem um novo deploy.
+
+import os
+import threading
+import time
+from pymongo import MongoClient, ReturnDocument
+
+from revocations import RevocationFeed
+
+EPOCH_ID = 'token_epoch'
+
+
+# devolve a geração atual (0 se ainda não existir).
+def read_epoch(db):
+    doc = db['settings'].find_one({'_id': EPOCH_ID})
+    if doc is None:
+        return 0
+    return doc['epoch']
+
+
+# incrementa a geração, invalidando todos os tokens emitidos até agora.
+def bump_epoch(db):
+    doc = db['settings'].find_one_and_update({'_id': EPOCH_ID}, {'$inc': {'epoch': 1}}, upsert=True, return_document=ReturnDocument.AFTER)
+    return doc['epoch']
+
+
+# apaga os tokens de gerações anteriores (e os antigos, sem geração).
+# tokens é a coleção dos tokens (ou o store com os shards, ver token_store.py).
+def drop_old_generations(tokens, epoch):
+    return tokens.delete_many({'$or': [{'epoch': {'$lt': epoch}}, {'epoch': {'$exists': False}}]}).deleted_count
+
+
+# thread em segundo plano: a cada "interval" segundos lê a geração atual, chama on_epoch
+# com o valor lido e apaga os tokens das gerações anteriores (da coleção devolvida por get_tokens,
+# por omissão a coleção tokens da mesma base de dados).
+def start_epoch_watcher(get_db, on_epoch, interval, get_tokens=None):
+    def run():
+        while True:
+            try:
+                db = get_db()
+                epoch = read_epoch(db)
+                on_epoch(epoch)
+                deleted = drop_old_generations(get_tokens() if get_tokens is not None else db['tokens'], epoch)
+                if deleted:
+                    print("Deleted %d tokens from old generations" % deleted)
+            except Exception as e:
+                print("Token epoch watcher error: %s" % e)
+            time.sleep(interval)
+    thread = threading.Thread(target=run, name='token-epoch-watcher', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    client = MongoClient(host=os.environ.get("ME_CONFIG_MONGODB_SERVER"), port=int(os.environ.get("ME_CONFIG_MONGODB_PORT")),
+                         username=os.environ.get("ME_CONFIG_MONGODB_ADMINUSERNAME"), password=os.environ.get("ME_CONFIG_MONGODB_ADMINPASSWORD"))
+    db = client['oauth']
+    epoch = bump_epoch(db)
+    RevocationFeed(lambda: db).revoke_epoch(epoch, 'deploy')
+    print("Token epoch is now %d" % epoch)
+    client.close()
@@ -0,0 +1,78 @@
+#! python3
+
+## Reutilização de tokens de acesso em pedidos repetidos ao /token (opcional, TOKEN_REUSE=1).
+# Muitas aplicações pedem um token novo em cada arranque ou ciclo de pedidos. Em vez de assinar e
+# guardar um token novo de cada vez, o servidor devolve o último token emitido ao mesmo cliente
+# para os mesmos scopes, desde que ainda falte mais de "min_lifetime" segundos para expirar.
+#
+# O índice fica em memória (por processo), indexado por (client_id, scopes canónicos). Os tokens
+# revogados (feed de revogações), de outra geração ou perto de expirar nunca são devolvidos.
+
+import json
+import threading
+
+# intervalo (segundos) entre duas limpezas das entradas expiradas
+PRUNE_INTERVAL = 60
+
+
+# Representação canónica dos scopes pedidos: a ordem das aplicações em cada lista, a ordem dos
+# campos de cada aplicação e as listas vazias não contam.
+def canonical_scopes(scopes):
+    canonical = {}
+    for name, apps in scopes.items():
+        if apps:
+            canonical[name] = sorted(json.dumps(app, sort_keys=True) for app in apps)
+    return json.dumps(canonical, sort_keys=True)
+
+
+class TokenReuseIndex:
+
+    def __init__(self, min_lifetime=600):
+        self.min_lifetime = min_lifetime
+        # (client_id, scopes canónicos) -> (token, digest, expires, epoch)
+        self.entries = {}
+        # digest -> (client_id, scopes canónicos), para as revogações
+        self.by_digest = {}
+        self.pruned_at = 0
+        self.lock = threading.Lock()
+
+    # Devolve (token, expires) de um token reutilizável, ou None.
+    def get(self, client_id, scope_key, epoch, now):
+        entry = self.entries.get((client_id, scope_key))
+        if entry is None or entry[3] != epoch or entry[2] - now <= self.min_lifetime:
+            return None
+        return entry[0], entry[2]
+
+    def put(self, client_id, scope_key, token, digest, expires, epoch, now):
+        with self.lock:
+            old = self.entries.get((client_id, scope_key))
+            if old is not None:
+                self.by_digest.pop(old[1], None)
+            self.entries[(client_id, scope_key)] = (token, digest, expires, epoch)
+            self.by_digest[digest] = (client_id, scope_key)
+            if now - self.pruned_at > PRUNE_INTERVAL:
+                self.prune(now)
+
+    def discard_token(self, digest):
+        with self.lock:
+            key = self.by_digest.pop(digest, None)
+            if key is not None:
+                self.entries.pop(key, None)
+
+    def discard_client(self, client_id):
+        self.discard_clients({client_id})
+
+    def discard_clients(self, client_ids):
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if key[0] in client_ids:
+                    del self.entries[key]
+                    self.by_digest.pop(entry[1], None)
+
+    # apaga as entradas que já não podem ser reutilizadas (chamada com o lock)
+    def prune(self, now):
+        self.pruned_at = now
+        for key, entry in list(self.entries.items()):
+            if entry[2] - now <= self.min_lifetime:
+                del self.entries[key]
+                self.by_digest.pop(entry[1], None)
@@ -0,0 +1,161 @@
+#! python3
+
+## Armazenamento dos tokens de acesso repartido por vários MongoDB (shards).
+# Cada token é guardado num só shard, escolhido pelo seu digest num anel de hashing consistente
+# (HashRing) com "vnodes" nós virtuais por shard, para que a carga fique equilibrada e, quando se
+# acrescenta ou retira um shard, só mude de shard a fração dos tokens que lhe corresponde.
+# Os clientes não são repartidos: ficam na base de dados principal, lida por todas as instâncias.
+#
+# Rebalanceamento online: quando o anel muda, o store recebe também o anel anterior. Enquanto
+# este existir, as pesquisas e remoções que não encontram o token no shard novo vão ao shard
+# antigo, e uma thread (em apenas uma instância, ver start_rebalance) copia para o shard novo os
+# tokens que mudaram de dono, apagando-os do antigo. No fim o anel anterior pode ser retirado.
+#
+# O store só conhece os nomes dos shards e uma função que devolve a coleção dos tokens de cada
+# um (uma coleção do pymongo ou, nos testes, a MemoryCollection de tests/conftest.py):
+#   dbs = {'a': MemoryDatabase(), 'b': MemoryDatabase()}
+#   store = ShardedTokenStore(dbs, lambda name, operation: dbs[name]['tokens'])
+
+import bisect
+import hashlib
+import itertools
+import threading
+import time
+
+VNODES = 160
+# nome do shard que corresponde à base de dados principal
+MAIN_SHARD = 'main'
+
+
+class HashRing:
+
+    def __init__(self, nodes, vnodes=VNODES):
+        self.nodes = list(nodes)
+        if not self.nodes:
+            raise ValueError('A hash ring needs at least one node')
+        points = []
+        for node in self.nodes:
+            for i in range(vnodes):
+                points.append((ring_position(('%s#%d' % (node, i)).encode('utf-8')), node))
+        points.sort()
+        self.positions = [position for position, _ in points]
+        self.owners = [node for _, node in points]
+
+    # shard do token com este digest (o primeiro nó virtual a seguir à sua posição no anel)
+    def node(self, digest):
+        index = bisect.bisect(self.positions, ring_position(digest, hashed=True))
+        return self.owners[index % len(self.owners)]
+
+
+# posição no anel (64 bits). Os digests dos tokens já são SHA-256 e são usados diretamente.
+def ring_position(key, hashed=False):
+    if not hashed:
+        key = hashlib.sha256(key).digest()
+    return int.from_bytes(key[:8], 'big')
+
+
+class ShardedTokenStore:
+
+    # shards: nomes de todos os shards
+    # get_collection(nome, operação) devolve a coleção dos tokens do shard para uma operação
+    # ("read" ou "write"), por exemplo com os modos de durabilidade (ver durability.py)
+    # ring / previous_ring: nomes dos shards no anel atual e no anterior (durante um rebalanceamento)
+    def __init__(self, shards, get_collection, ring=None, previous_ring=None, vnodes=VNODES):
+        self.shards = list(shards)
+        self.get_collection = get_collection
+        self.ring = HashRing(ring or self.shards, vnodes)
+        self.previous_ring = HashRing(previous_ring, vnodes) if previous_ring else None
+        for name in itertools.chain(self.ring.nodes, self.previous_ring.nodes if self.previous_ring else []):
+            if name not in shards:
+                raise ValueError('Unknown token shard: %s' % name)
+        self.moved = 0
+
+    def collection(self, name, operation):
+        return self.get_collection(name, operation)
+
+    # shards onde o token pode estar: o dono atual e, durante um rebalanceamento, o anterior
+    def owners(self, digest):
+        owner = self.ring.node(digest)
+        if self.previous_ring is not None:
+            previous = self.previous_ring.node(digest)
+            if previous != owner:
+                return [owner, previous]
+        return [owner]
+
+    def insert_one(self, doc):
+        return self.collection(self.ring.node(doc['token_digest']), 'write').insert_one(doc)
+
+    def find_one(self, digest):
+        for name in self.owners(digest):
+            doc = self.collection(name, 'read').find_one({'token_digest': digest})
+            if doc is not None:
+                return doc
+        return None
+
+    def delete_one(self, digest):
+        deleted = 0
+        for name in self.owners(digest):
+            deleted += self.collection(name, 'write').delete_one({'token_digest': digest}).deleted_count
+        return deleted
+
+    # operações sobre todos os shards (por exemplo os tokens de um cliente ou de uma geração)
+    def delete_many(self, query):
+        return DeleteResult(sum(self.collection(name, 'write').delete_many(query).deleted_count for name in self.shards))
+
+    def create_index(self, *args, **kwargs):
+        for name in self.shards:
+            self.collection(name, 'write').create_index(*args, **kwargs)
+
+    # Move para o shard certo os tokens que estão no shard do anel anterior. Devolve o número
+    # de tokens movidos. Só pode correr numa instância de cada vez.
+    def rebalance(self, pause=0):
+        moved = 0
+        for name in self.shards:
+            source = self.collection(name, 'write')
+            for doc in source.find({}):
+                owner = self.ring.node(doc['token_digest'])
+                if owner == name:
+                    continue
+                self.collection(owner, 'write').replace_one({'_id': doc['_id']}, doc, upsert=True)
+                # se o token foi apagado entretanto (revogado) a cópia também é apagada
+                if source.delete_one({'_id': doc['_id']}).deleted_count == 0:
+                    self.collection(owner, 'write').delete_one({'_id': doc['_id']})
+                else:
+                    moved += 1
+                if pause:
+                    time.sleep(pause)
+        self.moved += moved
+        return moved
+
+    # Corre o rebalanceamento numa thread. No fim, o anel anterior deixa de ser consultado.
+    def start_rebalance(self, pause=0):
+        def run():
+            try:
+                moved = self.rebalance(pause)
+                self.previous_ring = None
+                print("Token shards rebalanced (%d tokens moved)" % moved)
+            except Exception as e:
+                print("Token shard rebalance error: %s" % e)
+        thread = threading.Thread(target=run, name='token-rebalance', daemon=True)
+        thread.start()
+        return thread
+
+
+class DeleteResult:
+
+    def __init__(self, deleted_count):
+        self.deleted_count = deleted_count
+
+
+# Lê a configuração dos shards no formato "nome=uri,nome=uri" (por exemplo TOKEN_SHARDS).
+def parse_shards(value):
+    shards = {}
+    for item in (value or '').split(','):
+        if item.strip():
+            name, _, uri = item.partition('=')
+            shards[name.strip()] = uri.strip()
+    return shards
+
+
+def parse_ring(value):
+    return [name.strip() for name in (value or '').split(',') if name.strip()] or None
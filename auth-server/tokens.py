@@ -0,0 +1,27 @@
+#! python3
+
+## Funções auxiliares para os formatos de token de acesso.
+# Além dos JWT, o servidor pode emitir "reference tokens": 128 bits aleatórios codificados
+# em base64url (22 caracteres). Estes tokens não têm qualquer informação, por isso são
+# sempre validados no servidor de autorização. Na base de dados nunca é guardado nenhum
+# token (JWT ou reference), apenas o seu digest SHA-256 (32 bytes), que é usado como chave
+# de pesquisa. Assim os índices têm tamanho fixo e uma cópia da base de dados não expõe
+# tokens válidos.
+
+import hashlib
+import secrets
+
+TOKEN_FORMAT_JWT = 'jwt'
+TOKEN_FORMAT_REFERENCE = 'reference'
+TOKEN_FORMATS = (TOKEN_FORMAT_JWT, TOKEN_FORMAT_REFERENCE)
+
+
+# cria um novo reference token com 128 bits aleatórios.
+def new_reference_token():
+    return secrets.token_urlsafe(16)
+
+
+# devolve o digest SHA-256 do token, em binário, tal como é guardado na base de dados.
+def token_digest(token):
+    return hashlib.sha256(token.encode('utf-8')).digest()
+
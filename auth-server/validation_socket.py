@@ -0,0 +1,105 @@
+#! python3
+
+## Validação de tokens por um Unix domain socket, para sidecars no mesmo host.
+# Evita o HTTP, o routing do Flask e a ligação TCP em cada validação. O protocolo é binário,
+# com mensagens precedidas pelo seu tamanho (2 bytes, big-endian):
+#
+#   pedido:   [tamanho u16][token em ASCII]
+#   resposta: [tamanho u16][estado u8][exp u64][scope mask u32][tamanho do client_id u8][client_id]
+#
+# estado: 0 = válido, 1 = inválido, 2 = erro no servidor (por exemplo sem base de dados).
+# Podem ser enviados vários pedidos seguidos sem esperar pelas respostas (pipelining); as
+# respostas são enviadas pela mesma ordem, todas as que estiverem prontas num só envio.
+# A validação é feita pela mesma função do endpoint /validate (mesmas caches e base de dados).
+
+import os
+import socket
+import socketserver
+import struct
+import threading
+
+LENGTH = struct.Struct('>H')
+RESPONSE = struct.Struct('>BQIB')
+
+STATUS_VALID = 0
+STATUS_INVALID = 1
+STATUS_ERROR = 2
+
+
+class ValidationServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    # token_info(token) devolve o documento do token (client_id, scope, expires) ou None
+    # scope_mask(scope) converte o scope do token na máscara de bits enviada na resposta
+    def __init__(self, path, token_info, scope_mask):
+        self.token_info = token_info
+        self.scope_mask = scope_mask
+        super().__init__(path, ValidationHandler)
+
+    def encode_response(self, token):
+        try:
+            info = self.token_info(token)
+        except Exception as e:
+            print("Validation socket error: %s" % e)
+            payload = RESPONSE.pack(STATUS_ERROR, 0, 0, 0)
+        else:
+            if info is None:
+                payload = RESPONSE.pack(STATUS_INVALID, 0, 0, 0)
+            else:
+                client_id = info['client_id'].encode('utf-8')[:255]
+                payload = RESPONSE.pack(STATUS_VALID, int(info['expires']), self.scope_mask(info.get('scope')), len(client_id)) + client_id
+        return LENGTH.pack(len(payload)) + payload
+
+
+class ValidationHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        buffer = bytearray()
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                return
+            buffer += data
+            responses = []
+            offset = 0
+            # responde a todos os pedidos completos que já chegaram
+            while len(buffer) - offset >= LENGTH.size:
+                (length,) = LENGTH.unpack_from(buffer, offset)
+                if len(buffer) - offset - LENGTH.size < length:
+                    break
+                start = offset + LENGTH.size
+                token = bytes(buffer[start:start + length]).decode('ascii', 'replace')
+                offset = start + length
+                responses.append(self.server.encode_response(token))
+            del buffer[:offset]
+            if responses:
+                self.request.sendall(b''.join(responses))
+
+
+# Inicia o servidor numa thread. O ficheiro do socket é recriado e fica com as permissões "mode".
+def start_validation_socket(path, token_info, scope_mask, mode=0o660):
+    if os.path.exists(path):
+        os.unlink(path)
+    server = ValidationServer(path, token_info, scope_mask)
+    os.chmod(path, mode)
+    thread = threading.Thread(target=server.serve_forever, name='validation-socket', daemon=True)
+    thread.start()
+    print("Validation socket listening on %s" % path)
+    return server
+
+
+# Cliente: valida uma lista de tokens num só envio (pipelining).
+# Devolve uma lista de (estado, exp, scope mask, client_id), pela mesma ordem dos tokens.
+def validate_tokens(path, tokens):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(b''.join(LENGTH.pack(len(token)) + token.encode('ascii') for token in tokens))
+        reader = sock.makefile('rb')
+        results = []
+        for _ in tokens:
+            (length,) = LENGTH.unpack(reader.read(LENGTH.size))
+            payload = reader.read(length)
+            status, exp, mask, client_id_length = RESPONSE.unpack_from(payload)
+            client_id = payload[RESPONSE.size:RESPONSE.size + client_id_length].decode('utf-8')
+            results.append((status, exp, mask, client_id))
+        return results
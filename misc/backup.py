@@ -0,0 +1,175 @@
+#! python3
+
+## Cópia de segurança e reposição do registo de clientes e dos tokens ativos.
+# Os documentos são lidos da base de dados com um cursor e escritos num ficheiro em "frames",
+# cada uma com um lote de documentos BSON comprimido com zlib e um checksum CRC32. A reposição
+# lê o ficheiro frame a frame e escreve cada lote com um bulk_write. Em nenhum dos casos o
+# ficheiro ou a coleção inteira ficam em memória.
+#
+# Formato do ficheiro:
+#   MAGIC, seguido de frames [tipo u8][tamanho u32][crc32 u32][payload]
+#   tipo 1: início de uma coleção, payload JSON {"db": ..., "collection": ...}
+#   tipo 2: lote de documentos, payload zlib(BSON concatenado)
+#   tipo 3: fim de uma coleção, payload JSON {"count": ...}
+#   tipo 0: fim do ficheiro
+#
+# Uso (com as mesmas variáveis de ambiente do docker compose):
+#   python backup.py export backup.oabk [oauth.clients openid.tokens ...]
+#   python backup.py restore backup.oabk [--unexpired]
+# --unexpired repõe apenas os tokens que ainda não expiraram.
+#
+# Os documentos de oauth.settings são contadores (geração dos tokens, sequência do feed de
+# revogações, versão do registo de clientes) e nunca andam para trás: a reposição só os aumenta
+# ($max). Voltar a escrever uma sequência mais antiga faria o feed reutilizar números de eventos
+# já publicados, e uma geração mais antiga tornaria válidos tokens invalidados depois da cópia.
+# No fim, se foram repostos clientes, a versão do registo é incrementada para os servidores os
+# voltarem a carregar.
+
+import json
+import os
+import struct
+import sys
+import time
+import zlib
+
+import bson
+from pymongo import MongoClient, ReplaceOne, UpdateOne
+
+MAGIC = b'OABK0001'
+FRAME = struct.Struct('>BII')
+FRAME_END, FRAME_COLLECTION, FRAME_DOCUMENTS, FRAME_COLLECTION_END = 0, 1, 2, 3
+
+# as chaves de assinatura e as settings (geração dos tokens) são necessárias para os tokens
+# repostos continuarem a ser válidos
+COLLECTIONS = ['oauth.clients', 'oauth.tokens', 'oauth.signing_keys', 'oauth.settings',
+               'openid.tokens', 'openid.refresh_tokens', 'openid.signing_keys']
+
+# coleção dos contadores, reposta com $max
+SETTINGS = 'oauth.settings'
+# documento da versão do registo de clientes (ver client_registry.py)
+CLIENT_REGISTRY_VERSION = 'client_registry'
+
+# número máximo de documentos e de bytes (BSON, antes de comprimir) por lote
+BATCH_DOCUMENTS = 1000
+BATCH_BYTES = 4 * 1024 * 1024
+
+
+class BackupError(Exception):
+    pass
+
+
+def write_frame(f, kind, payload):
+    f.write(FRAME.pack(kind, len(payload), zlib.crc32(payload)))
+    f.write(payload)
+
+
+def read_frames(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise BackupError('Not a backup file')
+    while True:
+        header = f.read(FRAME.size)
+        if len(header) < FRAME.size:
+            raise BackupError('Truncated backup file')
+        kind, length, crc = FRAME.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length:
+            raise BackupError('Truncated backup file')
+        if zlib.crc32(payload) != crc:
+            raise BackupError('Checksum mismatch')
+        if kind == FRAME_END:
+            return
+        yield kind, payload
+
+
+# gerador de lotes de documentos (BSON) de um cursor
+def batches(cursor):
+    batch = []
+    size = 0
+    for doc in cursor:
+        data = bson.encode(doc)
+        batch.append(data)
+        size += len(data)
+        if len(batch) >= BATCH_DOCUMENTS or size >= BATCH_BYTES:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+
+def export(client, path, collections):
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        for name in collections:
+            db, collection = name.split('.', 1)
+            write_frame(f, FRAME_COLLECTION, json.dumps({'db': db, 'collection': collection}).encode('utf-8'))
+            count = 0
+            for batch in batches(client[db][collection].find(batch_size=BATCH_DOCUMENTS)):
+                write_frame(f, FRAME_DOCUMENTS, zlib.compress(b''.join(batch)))
+                count += len(batch)
+            write_frame(f, FRAME_COLLECTION_END, json.dumps({'count': count}).encode('utf-8'))
+            print("%s: %d documents exported" % (name, count))
+        write_frame(f, FRAME_END, b'')
+
+
+# escrita de um documento reposto: substituição pelo _id, ou para os contadores apenas os valores maiores
+def restore_operation(name, doc):
+    if name == SETTINGS:
+        counters = {k: v for k, v in doc.items() if k != '_id' and isinstance(v, (int, float))}
+        others = {k: v for k, v in doc.items() if k != '_id' and k not in counters}
+        update = {'$max': counters}
+        if others:
+            update['$setOnInsert'] = others
+        return UpdateOne({'_id': doc['_id']}, update, upsert=True)
+    # upsert pelo _id, para a reposição poder ser repetida sem duplicar documentos
+    return ReplaceOne({'_id': doc['_id']}, doc, upsert=True)
+
+
+def restore(client, path, unexpired_only):
+    now = time.time()
+    clients_restored = 0
+    with open(path, 'rb') as f:
+        collection = None
+        name = None
+        count = 0
+        for kind, payload in read_frames(f):
+            if kind == FRAME_COLLECTION:
+                info = json.loads(payload)
+                name = '%s.%s' % (info['db'], info['collection'])
+                collection = client[info['db']][info['collection']]
+                count = 0
+            elif kind == FRAME_DOCUMENTS:
+                docs = bson.decode_all(zlib.decompress(payload))
+                if unexpired_only and name.endswith('tokens'):
+                    docs = [doc for doc in docs if doc.get('expires', now + 1) > now]
+                if docs:
+                    collection.bulk_write([restore_operation(name, doc) for doc in docs], ordered=False)
+                    count += len(docs)
+            elif kind == FRAME_COLLECTION_END:
+                print("%s: %d documents restored" % (name, count))
+                if name == 'oauth.clients':
+                    clients_restored += count
+    if clients_restored:
+        client['oauth']['settings'].update_one({'_id': CLIENT_REGISTRY_VERSION}, {'$inc': {'version': 1}}, upsert=True)
+
+
+def main(args):
+    if len(args) < 2 or args[0] not in ('export', 'restore'):
+        print("usage: python backup.py export <file> [db.collection ...]\n       python backup.py restore <file> [--unexpired]", file=sys.stderr)
+        sys.exit(1)
+    client = MongoClient(host=os.environ.get("ME_CONFIG_MONGODB_SERVER"), port=int(os.environ.get("ME_CONFIG_MONGODB_PORT")),
+                         username=os.environ.get("ME_CONFIG_MONGODB_ADMINUSERNAME"), password=os.environ.get("ME_CONFIG_MONGODB_ADMINPASSWORD"))
+    try:
+        if args[0] == 'export':
+            export(client, args[1], args[2:] or COLLECTIONS)
+        else:
+            restore(client, args[1], '--unexpired' in args[2:])
+    except BackupError as e:
+        print("Error: %s" % e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,320 @@
+#! python3
+
+## Simulador de capacidade do armazenamento dos clientes e tokens do servidor de autorização.
+# Gera uma população sintética de N aplicações MEC com M serviços cada (scopes como os do
+# /register, ver scopes.json) e reproduz em tempo acelerado o ciclo de vida dos tokens: cada
+# instância pede um token a cada "request_interval" segundos e valida-o várias vezes enquanto o
+# usa. São usados os mesmos caminhos do auth_server (ShardedTokenStore, token_digest, scope_set,
+# canonical_scopes, TokenReuseIndex, drop_old_generations) sobre as coleções em memória de
+# token_store.py, por isso nenhum MongoDB é necessário.
+#
+# No fim mostra o número de documentos (ao longo do tempo e no pico), o tamanho estimado dos
+# documentos e dos índices, a memória usada em cada processo (registo de clientes e índice de
+# reutilização), as operações por segundo na base de dados e o custo de CPU de cada operação.
+#
+# Os tamanhos são estimativas do BSON sem compressão (o WiredTiger comprime os dados e usa
+# compressão de prefixo nos índices), úteis para dimensionar a cache do WiredTiger e o disco.
+#
+# Uso:
+#   python capacity_simulator.py --apps 500 --services 4 --ttl 3600 --hours 24
+#   python capacity_simulator.py --apps 500 --services 4 --request-interval 300 --reuse
+#   python capacity_simulator.py --apps 500 --services 4 --epoch-hours 6 --shards 3
+
+import argparse
+import heapq
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'auth-server'))
+# bases de dados em memória dos testes do OAuth-server
+sys.path.insert(0, os.path.join(ROOT, 'auth-server', 'tests'))
+
+from client_registry import ClientRegistry
+from conftest import MemoryDatabase
+from token_epoch import drop_old_generations
+from token_reuse import TokenReuseIndex, canonical_scopes
+from token_store import ShardedTokenStore
+from tokens import new_reference_token, token_digest
+
+# bytes por entrada de um índice, além da chave: record id e estrutura da página (aproximado)
+INDEX_ENTRY_OVERHEAD = 16
+# tamanho de um ObjectId (_id dos documentos no MongoDB)
+OBJECT_ID_SIZE = 12
+# hash bcrypt guardado em client_secret
+BCRYPT_HASH = b'$2b$12$' + b'x' * 53
+PROTOCOLS = ('http', 'https', 'grpc', 'mqtt')
+
+
+# tamanho em BSON de um valor (sem o tipo e o nome do campo)
+def bson_value_size(value):
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, int):
+        return 4 if -2 ** 31 <= value < 2 ** 31 else 8
+    if isinstance(value, float):
+        return 8
+    if isinstance(value, str):
+        return 4 + len(value.encode('utf-8')) + 1
+    if isinstance(value, bytes):
+        return 4 + 1 + len(value)
+    if isinstance(value, dict):
+        return bson_size(value)
+    if isinstance(value, (list, tuple)):
+        return bson_size({str(i): item for i, item in enumerate(value)})
+    if value is None:
+        return 0
+    raise TypeError('Unsupported type: %s' % type(value).__name__)
+
+
+# tamanho em BSON de um documento; o _id conta sempre como ObjectId
+def bson_size(doc, top_level=False):
+    size = 4 + 1
+    if top_level:
+        size += 1 + len('_id') + 1 + OBJECT_ID_SIZE
+    for key, value in doc.items():
+        if top_level and key == '_id':
+            continue
+        size += 1 + len(key.encode('utf-8')) + 1 + bson_value_size(value)
+    return size
+
+
+# tamanho de um índice sobre os documentos (chave em BSON mais o overhead de cada entrada)
+def index_size(docs, field):
+    if field == '_id':
+        return len(docs) * (OBJECT_ID_SIZE + INDEX_ENTRY_OVERHEAD)
+    return sum(bson_value_size(doc.get(field)) + INDEX_ENTRY_OVERHEAD for doc in docs)
+
+
+# tamanho aproximado de um objeto em memória, com o conteúdo dos dicionários, listas e conjuntos
+def deep_size(value, seen=None):
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in value)
+    return size
+
+
+# População sintética: cada aplicação produz "services" serviços e requer "required" serviços
+# (e metade disso como opcionais) produzidos por outras aplicações.
+def generate_clients(rng, apps, services, required):
+    produced = []
+    for app in range(apps):
+        produced.append([{'name': 'app%d-svc%d' % (app, i), 'type': 'n', 'protocol': rng.choice(PROTOCOLS),
+                          'version': '%d.%d' % (rng.randint(1, 3), rng.randint(0, 9)), 'security': 'alpha'}
+                         for i in range(services)])
+    clients = []
+    for app in range(apps):
+        others = [svc for other in rng.sample(range(apps), min(apps, required * 2 + 1)) if other != app for svc in produced[other]]
+        picked = rng.sample(others, min(len(others), required + required // 2))
+        scopes = {
+            'appServiceRequired': [{'name': svc['name'], 'version': svc['version']} for svc in picked[:required]],
+            'appServiceOptional': [{'name': svc['name'], 'version': svc['version']} for svc in picked[required:]],
+            'appServiceProduced': produced[app],
+        }
+        # mesmo formato do client_document do auth_server
+        clients.append({'client_id': new_reference_token(), 'client_secret': BCRYPT_HASH, 'scopes': scopes, 'token_format': 'jwt'})
+    return clients
+
+
+class Simulation:
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.dbs = {'shard%d' % i: MemoryDatabase() for i in range(args.shards)}
+        self.store = ShardedTokenStore(list(self.dbs), lambda name, operation: self.dbs[name]['tokens'])
+        self.store.create_index('token_digest', unique=True, sparse=True)
+        self.store.create_index('epoch')
+        self.clients = MemoryDatabase()['clients']
+        self.clients.create_index('client_id', unique=True)
+        self.reuse = TokenReuseIndex(args.reuse_min_lifetime) if args.reuse else None
+        self.epoch = 1
+        self.events = []
+        self.sequence = 0
+        # operações na base de dados por tipo e custo de CPU (segundos) por operação do servidor
+        self.db_ops = {'insert': 0, 'find': 0, 'delete': 0, 'delete_many': 0}
+        self.cost = {}
+        self.samples = []
+
+    def schedule(self, at, kind, *data):
+        self.sequence += 1
+        heapq.heappush(self.events, (at, self.sequence, kind, data))
+
+    def timed(self, operation, fn, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        total, count = self.cost.get(operation, (0, 0))
+        self.cost[operation] = (total + time.perf_counter() - start, count + 1)
+        return result
+
+    def run(self):
+        args = self.args
+        docs = generate_clients(self.rng, args.apps, args.services, args.required)
+        for doc in docs:
+            self.timed('register', self.clients.insert_one, dict(doc))
+        self.registry = {doc['client_id']: ClientRegistry.prepare(doc) for doc in docs}
+        duration = args.hours * 3600
+        for doc in docs:
+            for instance in range(args.instances):
+                # as instâncias arrancam espalhadas pelo primeiro intervalo
+                self.schedule(self.rng.uniform(0, args.request_interval), 'request', doc['client_id'])
+        for hour in range(1, int(args.hours) + 1):
+            self.schedule(hour * 3600, 'sample')
+        if args.epoch_hours:
+            at = args.epoch_hours * 3600
+            while at < duration:
+                self.schedule(at, 'epoch')
+                at += args.epoch_hours * 3600
+        while self.events and self.events[0][0] <= duration:
+            now, _, kind, data = heapq.heappop(self.events)
+            getattr(self, 'on_' + kind)(now, *data)
+
+    # pedido ao /token: scopes pedidos, reutilização e emissão de um token novo
+    def on_request(self, now, client_id):
+        client = self.registry[client_id]
+        requested = {name: list(apps) for name, apps in client['scopes'].items() if name != 'appServiceProduced'}
+        token = None
+        if self.reuse is not None:
+            scope_key = self.timed('scopes', canonical_scopes, requested)
+            reused = self.reuse.get(client_id, scope_key, self.epoch, now)
+            if reused is not None:
+                token, expires = reused
+                self.db_ops['find'] += 1
+        if token is None:
+            token = new_reference_token()
+            expires = now + self.args.ttl
+            digest = self.timed('digest', token_digest, token)
+            self.timed('issue', self.store.insert_one, {'token_digest': digest, 'client_id': client_id, 'scope': 'read',
+                                                        'expires': expires, 'epoch': self.epoch})
+            self.db_ops['insert'] += 1
+            if self.reuse is not None:
+                self.reuse.put(client_id, scope_key, token, digest, expires, self.epoch, now)
+        # validações do token enquanto a instância o usa
+        until = now + self.args.request_interval
+        for _ in range(self.args.validations):
+            self.schedule(self.rng.uniform(now, until), 'validate', token)
+        self.schedule(until, 'request', client_id)
+
+    # validação como no token_info: pesquisa pelo digest e remoção dos tokens expirados
+    def on_validate(self, now, token):
+        digest = token_digest(token)
+        doc = self.timed('validate', self.store.find_one, digest)
+        self.db_ops['find'] += 1
+        if doc is not None and doc['expires'] < now:
+            self.timed('delete', self.store.delete_one, digest)
+            self.db_ops['delete'] += 1
+            if self.reuse is not None:
+                self.reuse.discard_token(digest)
+
+    # novo deploy: nova geração e limpeza das anteriores (thread do token_epoch)
+    def on_epoch(self, now):
+        self.epoch += 1
+        self.timed('drop_generations', drop_old_generations, self.store, self.epoch)
+        self.db_ops['delete_many'] += len(self.dbs)
+
+    def on_sample(self, now):
+        docs = self.token_docs()
+        live = sum(1 for doc in docs if doc['expires'] >= now and doc['epoch'] == self.epoch)
+        self.samples.append((now / 3600, len(docs), live))
+
+    def token_docs(self):
+        return [doc for db in self.dbs.values() for doc in db['tokens'].docs.values()]
+
+
+def human(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024 or unit == 'GiB':
+            return '%.1f %s' % (size, unit)
+        size /= 1024
+
+
+def report(simulation):
+    args = simulation.args
+    duration = args.hours * 3600
+    tokens = simulation.token_docs()
+    client_docs = list(simulation.clients.docs.values())
+    peak = max(simulation.samples, key=lambda sample: sample[1]) if simulation.samples else (args.hours, len(tokens), 0)
+
+    print("Population: %d apps x %d services, %d instances each, token TTL %ds, request every %ds, %d validations per token%s" % (
+        args.apps, args.services, args.instances, args.ttl, args.request_interval, args.validations,
+        ', token reuse' if args.reuse else ''))
+    print()
+    print("Documents over time (hour, stored tokens, live tokens):")
+    for hour, stored, live in simulation.samples:
+        print("  %5.1f h  %10d  %10d" % (hour, stored, live))
+    if simulation.samples and simulation.samples[-1][1] > 2 * max(1, simulation.samples[-1][2]):
+        print("  note: expired tokens are only deleted when validated after expiring or when the token epoch changes")
+    print()
+
+    token_bytes = sum(bson_size(doc, top_level=True) for doc in tokens)
+    client_bytes = sum(bson_size(doc, top_level=True) for doc in client_docs)
+    token_avg = token_bytes / len(tokens) if tokens else 0
+    token_indexes = {field: index_size(tokens, field) for field in ('_id', 'token_digest', 'epoch')}
+    client_indexes = {field: index_size(client_docs, field) for field in ('_id', 'client_id')}
+    print("Storage at the end (%d shards, uncompressed BSON estimate):" % args.shards)
+    print("  clients: %d documents, %s (avg %d B), indexes %s" % (
+        len(client_docs), human(client_bytes), client_bytes / max(1, len(client_docs)), human(sum(client_indexes.values()))))
+    print("  tokens:  %d documents, %s (avg %d B), indexes %s (%s)" % (
+        len(tokens), human(token_bytes), token_avg, human(sum(token_indexes.values())),
+        ', '.join('%s %s' % (field, human(size)) for field, size in token_indexes.items())))
+    per_shard = [len(db['tokens'].docs) for db in simulation.dbs.values()]
+    if len(per_shard) > 1:
+        print("  tokens per shard: %s" % ', '.join(str(count) for count in per_shard))
+    print("  peak: %d token documents at hour %.0f, about %s with indexes" % (
+        peak[1], peak[0], human(peak[1] * (token_avg + sum(token_indexes.values()) / max(1, len(tokens))))))
+    print()
+
+    registry_bytes = deep_size(simulation.registry)
+    print("Memory per server process:")
+    print("  client registry: %s (%d clients)" % (human(registry_bytes), len(simulation.registry)))
+    if simulation.reuse is not None:
+        print("  token reuse index: %s (%d entries)" % (human(deep_size(simulation.reuse.entries) + deep_size(simulation.reuse.by_digest)),
+                                                       len(simulation.reuse.entries)))
+    print()
+
+    print("Database operations (average per second of simulated time):")
+    for operation, count in simulation.db_ops.items():
+        print("  %-12s %10d  %8.2f/s" % (operation, count, count / duration))
+    print()
+    print("CPU cost per server operation (memory backend):")
+    for operation, (total, count) in sorted(simulation.cost.items()):
+        print("  %-16s %10d calls  %8.1f us" % (operation, count, total / count * 1e6))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Capacity simulation of the authorization server storage.')
+    parser.add_argument('--apps', type=int, default=100, help='number of MEC apps (clients)')
+    parser.add_argument('--services', type=int, default=3, help='services produced by each app')
+    parser.add_argument('--required', type=int, default=3, help='services required by each app (plus half as optional)')
+    parser.add_argument('--instances', type=int, default=1, help='instances of each app requesting tokens')
+    parser.add_argument('--ttl', type=int, default=3600, help='token lifetime in seconds')
+    parser.add_argument('--request-interval', type=int, default=None, help='seconds between token requests of an instance (default 90%% of the TTL)')
+    parser.add_argument('--validations', type=int, default=10, help='validations of each token while it is used')
+    parser.add_argument('--hours', type=float, default=24, help='simulated time')
+    parser.add_argument('--shards', type=int, default=1, help='token shards')
+    parser.add_argument('--epoch-hours', type=float, default=0, help='hours between token epoch bumps (deploys), 0 for none')
+    parser.add_argument('--reuse', action='store_true', help='simulate TOKEN_REUSE=1')
+    parser.add_argument('--reuse-min-lifetime', type=int, default=600, help='TOKEN_REUSE_MIN_LIFETIME')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    if args.request_interval is None:
+        args.request_interval = max(1, int(args.ttl * 0.9))
+
+    start = time.perf_counter()
+    simulation = Simulation(args)
+    simulation.run()
+    report(simulation)
+    print()
+    print("Simulated %.0f h in %.1f s" % (args.hours, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,12 +1,18 @@
 #! python3
 
 import json
-import requests
+import os
+import sys
 import jwt
 from flask import (Flask, make_response, render_template, redirect, request,
                    url_for)
 
+# validação dos tokens com o SDK em resource-sdk/ (cache, verificação local e ligações keep-alive)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'resource-sdk'))
+from oauth_validator import TokenValidator, bearer_token, require_token
+
 app = Flask(__name__)
+validator = TokenValidator('http://localhost:5001')
 
 with open('public.pem', mode='rb') as publicfile:
     public_key = publicfile.read()
@@ -45,18 +51,14 @@ clients_app_2 = [{"first_name": "Ebba",
 }]
 
 @app.route('/recurso1')
+@require_token(validator)
 def recurso1():
-    token = request.headers.get('Authorization')
-    print("token: ", token)
-    if validate_token(token):
-        return json.dumps(clients_app_1)
-    else:
-        return make_response('Token inválido', 401)
+    return json.dumps(clients_app_1)
 
 @app.route('/recurso2')
 def recurso2():
     token = request.args.get('token')
-    if validate_token(token):
+    if validator.validate(token) is not None:
         return json.dumps(clients_app_2)
     else:
         return make_response('Token inválido', 402)
@@ -70,16 +72,5 @@ def recurso4():
     return make_response('Recurso Indisponivel', 404)
 
 
-#validates access token sent from client, and to do that, it sends the token to the authorization server
-def validate_token(token):
-
-    url = 'http://localhost:5001/validate_token'
-    response = requests.post(url, data={'access_token': token})
-    if response.status_code == 200:
-        return True
-    else:
-        return False
-
-
 
 app.run(port = 5002, debug = True)
\ No newline at end of file
@@ -0,0 +1,88 @@
+#! python3
+
+## Mede o tempo de arranque dos servidores: import do módulo e create_app.
+# Cada medição é feita num processo Python novo (como no arranque de um container), com
+# "-X importtime" para mostrar os módulos que mais contribuem para o tempo de import.
+# Nenhuma ligação à base de dados é aberta (o create_app não contacta a base de dados).
+#
+# Uso:
+#   python startup_benchmark.py [auth|openid] [repetições]
+# Exemplo de resultado:
+#   auth_server: import 182.4 ms (min 176.0), create_app 1.9 ms (min 1.7)
+
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    'auth': ('auth-server', 'auth_server', "Config(token_cache_path='')"),
+    'openid': ('openid-server', 'openid', "Config()"),
+}
+
+# código executado em cada processo: escreve no stdout os tempos (em segundos) do import e do create_app
+PROBE = '''
+import time
+start = time.perf_counter()
+import %(module)s
+imported = time.perf_counter()
+from config import Config
+%(module)s.create_app(%(config)s)
+created = time.perf_counter()
+print(imported - start, created - imported)
+'''
+
+# número de módulos mais lentos mostrados
+TOP_IMPORTS = 10
+
+
+def measure(directory, module, config):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE % {'module': module, 'config': config}],
+                            cwd=os.path.join(ROOT, directory), capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    import_time, create_time = (float(value) for value in result.stdout.split()[-2:])
+    return import_time, create_time, parse_importtime(result.stderr, module)
+
+
+# linhas do -X importtime: "import time: self [us] | cumulative | imported package", com os módulos
+# indentados pelo nível na árvore de imports e listados antes do módulo que os importou.
+# Devolve os módulos importados diretamente pelo módulo do servidor, do mais lento para o mais rápido.
+def parse_importtime(output, module):
+    children = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        if level == 1:
+            children.append((int(cumulative), name.strip()))
+        elif level == 0:
+            if name.strip() == module:
+                return sorted(children, reverse=True)[:TOP_IMPORTS]
+            children = []
+    return []
+
+
+def main(args):
+    names = [args[0]] if args and args[0] in SERVERS else list(SERVERS)
+    runs = int(args[-1]) if args and args[-1].isdigit() else 10
+    for name in names:
+        directory, module, config = SERVERS[name]
+        try:
+            samples = [measure(directory, module, config) for _ in range(runs)]
+        except RuntimeError as e:
+            print("%s: %s" % (module, e))
+            continue
+        imports = [sample[0] * 1000 for sample in samples]
+        creates = [sample[1] * 1000 for sample in samples]
+        print("%s: import %.1f ms (min %.1f), create_app %.1f ms (min %.1f)" % (
+            module, statistics.median(imports), min(imports), statistics.median(creates), min(creates)))
+        for cumulative, imported in samples[-1][2]:
+            print("  %8.1f ms  %s" % (cumulative / 1000, imported))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,96 @@
+#! python3
+
+## Controlo de admissão: limite de pedidos em simultâneo por classe de endpoints.
+# Em sobrecarga o servidor aceitava todos os pedidos e o tempo em fila crescia até os clientes
+# desistirem (e repetirem o pedido, piorando a situação). Com o controlo de admissão cada classe
+# (por exemplo "validate", barata, e "issue", com bcrypt e escritas) tem um limite de pedidos em
+# curso; acima do limite o pedido é rejeitado logo com 503 e Retry-After, sem esperar. Como as
+# classes têm limites separados, as validações continuam a responder com a emissão saturada.
+#
+# O limite de cada classe adapta-se à latência observada (AIMD): enquanto a latência dos pedidos
+# fica abaixo de "target_latency" e o limite está a ser usado, sobe cerca de 1 por cada "limit"
+# pedidos; quando um pedido demora mais do que o alvo o limite é multiplicado por "backoff" (no
+# máximo uma vez por "target_latency" segundos, para uma rajada de pedidos lentos contar uma só
+# vez). O limite fica sempre entre "minimum" e "maximum".
+
+import math
+import threading
+import time
+
+
+class AdaptiveLimit:
+
+    def __init__(self, initial, minimum, maximum, target_latency, backoff=0.9):
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        # média móvel da latência (segundos)
+        self.latency = None
+        self.decreased_at = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.in_flight >= int(self.limit):
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+
+    def release(self, latency, now):
+        with self.lock:
+            # in_flight antes de este pedido terminar, para saber se o limite estava a ser usado
+            in_flight = self.in_flight
+            self.in_flight -= 1
+            self.latency = latency if self.latency is None else self.latency * 0.9 + latency * 0.1
+            if latency > self.target_latency:
+                if now - self.decreased_at >= self.target_latency:
+                    self.limit = max(self.minimum, self.limit * self.backoff)
+                    self.decreased_at = now
+            elif in_flight * 2 >= self.limit:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    # segundos sugeridos ao cliente antes de repetir o pedido (pelo menos 1)
+    def retry_after(self):
+        return max(1, int(math.ceil(self.latency or 0)))
+
+    def stats(self):
+        return {'limit': int(self.limit), 'in_flight': self.in_flight, 'admitted': self.admitted, 'rejected': self.rejected,
+                'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None}
+
+
+# Lê a configuração de uma classe no formato "inicial/mínimo/máximo/latência alvo (segundos)",
+# por exemplo "32/4/256/0.05".
+def parse_admission(value):
+    initial, minimum, maximum, target = value.split('/')
+    return int(initial), int(minimum), int(maximum), float(target)
+
+
+class AdmissionController:
+
+    # limits: classe -> AdaptiveLimit
+    def __init__(self, limits):
+        self.limits = limits
+
+    # Devolve True se o pedido da classe pode ser servido (tem de ser seguido de release).
+    # Classes sem limite são sempre aceites.
+    def acquire(self, name):
+        limit = self.limits.get(name)
+        return limit is None or limit.acquire()
+
+    def release(self, name, latency, now=None):
+        limit = self.limits.get(name)
+        if limit is not None:
+            limit.release(latency, time.monotonic() if now is None else now)
+
+    def retry_after(self, name):
+        return self.limits[name].retry_after()
+
+    def stats(self):
+        return {name: limit.stats() for name, limit in self.limits.items()}
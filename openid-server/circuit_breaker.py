@@ -0,0 +1,74 @@
+#! python3
+
+## Circuit breaker para o acesso à base de dados dos tokens.
+# Quando o MongoDB está lento ou inacessível, cada validação ficava bloqueada no find_one até ao
+# timeout e depois falhava, atrasando todos os pedidos. Com o breaker, depois de
+# "failure_threshold" falhas seguidas (ou chamadas mais lentas do que "slow_call" segundos) o
+# circuito abre e as chamadas seguintes falham logo com CircuitOpenError, sem esperar pela base
+# de dados. Os servidores passam então a um modo degradado (tokens em cache aceites até ao seu
+# exp e, se a configuração o permitir, JWT verificados apenas pela assinatura).
+#
+# Enquanto o circuito está aberto, uma thread chama a função "probe" a cada "probe_interval"
+# segundos; quando esta não lança exceção o circuito volta a fechar.
+
+import threading
+import time
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+
+    def __init__(self, name, probe, failure_threshold=5, slow_call=None, probe_interval=2):
+        self.name = name
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.slow_call = slow_call
+        self.probe_interval = probe_interval
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    # Chama fn(*args). Lança CircuitOpenError se o circuito estiver aberto, ou a exceção de fn.
+    def call(self, fn, *args, **kwargs):
+        if self.opened_at is not None:
+            raise CircuitOpenError('%s unavailable' % self.name)
+        start = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        if self.slow_call is not None and time.monotonic() - start > self.slow_call:
+            self.record_failure()
+        elif self.failures:
+            self.failures = 0
+        return result
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures < self.failure_threshold or self.opened_at is not None:
+                return
+            self.opened_at = time.time()
+        print("Circuit breaker %s open after %d failures" % (self.name, self.failures))
+        threading.Thread(target=self.run_probe, name='breaker-%s' % self.name, daemon=True).start()
+
+    def run_probe(self):
+        while True:
+            time.sleep(self.probe_interval)
+            try:
+                self.probe()
+            except Exception:
+                continue
+            with self.lock:
+                self.failures = 0
+                self.opened_at = None
+            print("Circuit breaker %s closed" % self.name)
+            return
@@ -0,0 +1,96 @@
+#! python3
+
+## Configuration of the openid server.
+# Every environment variable (see docker compose and README) is read here, once, into a Config
+# object that is passed to create_app in openid.py. Scripts and tests can build a Config with
+# other values without touching the environment:
+#   app = create_app(Config(mongodb_addr='localhost', osm_hostname='192.168.86.210'))
+
+import os
+
+from admission import parse_admission
+from ratelimit import parse_limit
+
+
+class Config:
+
+    def __init__(self, environ=None, **overrides):
+        env = os.environ if environ is None else environ
+
+        # dados predefinidos no docker compose
+        self.mongodb_addr = env.get("ME_CONFIG_MONGODB_SERVER")
+        self.mongodb_port = int(env.get("ME_CONFIG_MONGODB_PORT", "27017"))
+        self.mongodb_username = env.get("ME_CONFIG_MONGODB_ADMINUSERNAME")
+        self.mongodb_password = env.get("ME_CONFIG_MONGODB_ADMINPASSWORD")
+        self.osm_hostname = env.get("OSM_HOSTNAME")
+
+        # HTTP server. The debug reloader starts a second process that imports everything again,
+        # which inside a container only delays the start
+        self.host = env.get("HOST", "0.0.0.0")
+        self.port = int(env.get("PORT", "5000"))
+        self.debug = env.get("DEBUG", "1") == "1"
+        self.reloader = env.get("RELOADER", "0") == "1"
+
+        # durability modes per collection and operation (see durability.py)
+        self.durability = env.get("DURABILITY", "")
+        self.durability_default = env.get("DURABILITY_DEFAULT", "default")
+
+        # request limits (see ratelimit.py)
+        self.login_limit = parse_limit(env.get("RATE_LIMIT_LOGIN", "5/0.2"))
+        self.rate_limit_backend = env.get("RATE_LIMIT_BACKEND", "memory")
+
+        # signing keys (see signing_keys.py)
+        self.signing_algorithm = env.get("SIGNING_ALGORITHM", "HS256")
+        self.key_rotation_interval = int(env.get("KEY_ROTATION_INTERVAL", "86400"))
+        self.key_grace = int(env.get("KEY_GRACE", "7200"))
+        self.refresh_key_grace = int(env.get("REFRESH_KEY_GRACE", "46800"))
+        # old tokens without kid (signed with the constant key in the code) are accepted until this timestamp (0 = never)
+        self.legacy_secret_until = float(env.get("LEGACY_SECRET_UNTIL", "0"))
+
+        # revocation feed (see revocations.py)
+        self.revocation_buffer = int(env.get("REVOCATION_BUFFER", "10000"))
+
+        # timeout (seconds) of the shared MongoDB connection and circuit breaker on the token reads (see
+        # circuit_breaker.py): consecutive failures before opening, duration above which a read counts as a failure,
+        # probe interval, whether JWTs may be accepted on their signature alone while the circuit is open, and how
+        # many recently validated tokens are kept for degraded mode
+        self.store_timeout = float(env.get("STORE_TIMEOUT", "10"))
+        self.breaker_failures = int(env.get("BREAKER_FAILURES", "5"))
+        slow_call = env.get("BREAKER_SLOW_CALL", "1")
+        self.breaker_slow_call = float(slow_call) if slow_call else None
+        self.breaker_probe_interval = float(env.get("BREAKER_PROBE_INTERVAL", "2"))
+        self.degraded_signature_only = env.get("DEGRADED_SIGNATURE_ONLY", "0") == "1"
+        self.known_tokens_size = int(env.get("KNOWN_TOKENS_SIZE", "10000"))
+
+        # /healthz and /readyz probes (see health.py): check interval, timeout of the Mongo ping and of the
+        # connection to the OSM NBI, and requests in flight above which the process is not ready (0 = no limit)
+        self.health_interval = float(env.get("HEALTH_INTERVAL", "2"))
+        self.health_timeout = float(env.get("HEALTH_TIMEOUT", "2"))
+        self.ready_max_in_flight = int(env.get("READY_MAX_IN_FLIGHT", "64"))
+        self.osm_nbi_port = int(env.get("OSM_NBI_PORT", "9999"))
+
+        # admission control (see admission.py), per class: "initial/minimum/maximum/target latency". Login waits
+        # for the OSM NBI, so its target latency is higher than the OAuth-server's
+        self.admission = env.get("ADMISSION", "1") == "1"
+        self.admission_validate = parse_admission(env.get("ADMISSION_VALIDATE", "32/4/256/0.05"))
+        self.admission_issue = parse_admission(env.get("ADMISSION_ISSUE", "8/2/64/5"))
+
+        # audit log (see audit.py), disabled with an empty AUDIT_LOG_PATH. The path may contain {pid}.
+        # AUDIT_OVERFLOW: "drop" (drops and counts events when the queue is full) or "block" (waits up to
+        # AUDIT_BLOCK_TIMEOUT seconds for room); AUDIT_FSYNC: "always", "interval" or "never"
+        self.audit_log_path = env.get("AUDIT_LOG_PATH", "")
+        self.audit_queue_size = int(env.get("AUDIT_QUEUE_SIZE", "100000"))
+        self.audit_overflow = env.get("AUDIT_OVERFLOW", "drop")
+        self.audit_block_timeout = float(env.get("AUDIT_BLOCK_TIMEOUT", "0.1"))
+        self.audit_batch_size = int(env.get("AUDIT_BATCH_SIZE", "1000"))
+        self.audit_flush_interval = float(env.get("AUDIT_FLUSH_INTERVAL", "1"))
+        self.audit_fsync = env.get("AUDIT_FSYNC", "interval")
+        self.audit_fsync_interval = float(env.get("AUDIT_FSYNC_INTERVAL", "1"))
+        self.audit_max_bytes = int(env.get("AUDIT_MAX_BYTES", str(64 * 1024 * 1024)))
+        self.audit_backups = int(env.get("AUDIT_BACKUPS", "10"))
+        self.audit_compress = env.get("AUDIT_COMPRESS", "0") == "1"
+
+        for name, value in overrides.items():
+            if not hasattr(self, name):
+                raise TypeError('Unknown setting: %s' % name)
+            setattr(self, name, value)
@@ -0,0 +1,63 @@
+#! python3
+
+## Modos de durabilidade das operações na base de dados.
+# Cada coleção e tipo de operação (read ou write) usa um modo com nome:
+#   default: as opções da ligação (comportamento anterior)
+#   fast:    escritas com w=1 sem journal, leituras do membro mais próximo do replica set (nearest)
+#   safe:    escritas com w=majority e journal, leituras do primário
+#
+# A configuração (DURABILITY) é uma lista "coleção[.operação]=modo" separada por vírgulas, em que
+# a coleção "*" se aplica a todas as outras. Por exemplo, num nó de edge com muitas validações:
+#   DURABILITY="tokens=fast,clients=safe"
+#   DURABILITY="*=safe,tokens.read=fast"
+# As regras mais específicas ganham: coleção.operação, coleção, *.operação, *.
+#
+# Nota: com leituras "fast" um token acabado de emitir pode ainda não ter chegado ao secundário
+# mais próximo, e a primeira validação pode falhar durante o atraso de replicação.
+
+from pymongo import ReadPreference
+from pymongo.write_concern import WriteConcern
+
+OPERATIONS = ('read', 'write')
+
+MODES = {
+    'default': {'read': None, 'write': None},
+    'fast': {'read': ReadPreference.NEAREST, 'write': WriteConcern(w=1, j=False)},
+    'safe': {'read': ReadPreference.PRIMARY, 'write': WriteConcern(w='majority', j=True)},
+}
+
+
+class DurabilityPolicy:
+
+    def __init__(self, spec='', default='default'):
+        if default not in MODES:
+            raise ValueError('Unknown durability mode: %s' % default)
+        self.default = default
+        # (coleção, operação ou None) -> modo
+        self.rules = {}
+        for item in (spec or '').split(','):
+            if not item.strip():
+                continue
+            target, _, mode = item.partition('=')
+            target, mode = target.strip(), mode.strip()
+            collection, _, operation = target.partition('.')
+            if mode not in MODES:
+                raise ValueError('Unknown durability mode: %s' % mode)
+            if operation and operation not in OPERATIONS:
+                raise ValueError('Unknown operation: %s' % operation)
+            self.rules[(collection, operation or None)] = mode
+
+    def mode(self, name, operation):
+        for key in ((name, operation), (name, None), ('*', operation), ('*', None)):
+            if key in self.rules:
+                return self.rules[key]
+        return self.default
+
+    # Devolve a coleção "name" da base de dados com as opções do modo configurado para a operação.
+    def collection(self, db, name, operation):
+        option = MODES[self.mode(name, operation)][operation]
+        if option is None:
+            return db[name]
+        if operation == 'read':
+            return db.get_collection(name, read_preference=option)
+        return db.get_collection(name, write_concern=option)
@@ -0,0 +1,97 @@
+#! python3
+
+## Estado das dependências do servidor, para as sondas de liveness (/healthz) e readiness (/readyz).
+# As verificações (ping ao MongoDB, chaves carregadas, cache preparada, ...) correm numa thread
+# em segundo plano, a cada "interval" segundos, e os endpoints apenas leem o último resultado:
+# uma sonda nunca abre ligações nem espera por uma dependência.
+#
+# Cada verificação é uma função sem argumentos que devolve um dicionário com detalhes (ou None)
+# e lança uma exceção quando a dependência não está disponível. O tempo de cada verificação é
+# guardado em "latency_ms".
+#
+# O processo está vivo enquanto a thread não ficar bloqueada mais de stall_timeout segundos numa
+# verificação. Está pronto quando todas as verificações obrigatórias passaram na última ronda, essa
+# ronda terminou há menos de stale_after segundos e o número de pedidos em curso não ultrapassa
+# max_in_flight (um processo saturado sai de rotação até recuperar).
+
+import threading
+import time
+
+
+class HealthMonitor:
+
+    def __init__(self, interval=2, max_in_flight=0, stale_after=10, stall_timeout=60):
+        self.interval = interval
+        self.max_in_flight = max_in_flight
+        self.stale_after = stale_after
+        self.stall_timeout = stall_timeout
+        self.checks = []
+        # nome da verificação -> {'ok': ..., 'latency_ms': ..., 'error' ou detalhes}
+        self.status = {}
+        self.refreshed_at = 0
+        # último instante em que a thread começou ou acabou uma verificação
+        self.progress_at = 0
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add_check(self, name, check, required=True):
+        self.checks.append((name, check, required))
+
+    # Inicia a thread (apenas uma vez).
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.progress_at = time.time()
+            self.thread = threading.Thread(target=self.run, name='health-monitor', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            self.refresh()
+            time.sleep(self.interval)
+
+    # Corre todas as verificações e substitui o estado de uma só vez.
+    def refresh(self):
+        status = {}
+        for name, check, required in self.checks:
+            self.progress_at = time.time()
+            start = time.monotonic()
+            try:
+                result = {'ok': True}
+                result.update(check() or {})
+            except Exception as e:
+                result = {'ok': False, 'error': str(e)}
+            result['latency_ms'] = round((time.monotonic() - start) * 1000, 1)
+            result['required'] = required
+            status[name] = result
+        self.status = status
+        self.refreshed_at = self.progress_at = time.time()
+
+    # contagem dos pedidos em curso (before_request / teardown_request)
+    def request_started(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def request_finished(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    # antes de a thread ser iniciada o processo ainda está a arrancar, e está vivo
+    def alive(self, now):
+        return self.thread is None or now - self.progress_at < self.stall_timeout
+
+    def saturated(self):
+        return self.max_in_flight > 0 and self.in_flight > self.max_in_flight
+
+    def ready(self, now):
+        return now - self.refreshed_at < self.stale_after and not self.saturated() and all(
+            result['ok'] for result in self.status.values() if result['required'])
+
+    def report(self, now):
+        return {
+            'checks': self.status,
+            'age': round(now - self.refreshed_at, 1) if self.refreshed_at else None,
+            'in_flight': self.in_flight,
+        }
@@ -0,0 +1,61 @@
+#! python3
+
+## Migração das coleções de tokens para o formato com digest.
+# Os documentos antigos guardam o token completo (access_token / refresh_token). Este script
+# substitui esses campos pelo digest SHA-256 (token_digest / access_token_digest), em lotes,
+# e cria os índices usados pelos servidores. Pode ser corrido várias vezes: os documentos já
+# migrados são ignorados.
+#
+# Uso (com as mesmas variáveis de ambiente do docker compose):
+#   python migrate_tokens.py            -> migra as coleções do openid
+# (as coleções do oauth são migradas pelo script do auth-server, que conhece a geração dos tokens)
+
+import os
+import sys
+from pymongo import MongoClient, UpdateOne
+from tokens import token_digest
+
+# para cada coleção: campo antigo -> campo novo
+COLLECTIONS = {
+    'openid': {
+        'tokens': {'access_token': 'token_digest'},
+        'refresh_tokens': {'refresh_token': 'token_digest', 'access_token': 'access_token_digest'},
+    },
+}
+
+BATCH_SIZE = 1000
+
+
+def migrate_collection(collection, fields):
+    migrated = 0
+    batch = []
+    # apenas os documentos que ainda têm algum dos campos antigos
+    query = {'$or': [{old: {'$type': 'string'}} for old in fields]}
+    for doc in collection.find(query, projection=list(fields)):
+        new_values = {new: token_digest(doc[old]) for old, new in fields.items() if isinstance(doc.get(old), str)}
+        batch.append(UpdateOne({'_id': doc['_id']}, {'$set': new_values, '$unset': {old: '' for old in fields}}))
+        if len(batch) >= BATCH_SIZE:
+            migrated += collection.bulk_write(batch, ordered=False).modified_count
+            batch = []
+    if batch:
+        migrated += collection.bulk_write(batch, ordered=False).modified_count
+
+    # as mesmas opções do índice criado pelos servidores (sparse: ignora documentos sem digest)
+    collection.create_index('token_digest', unique=True, sparse=True)
+    if 'access_token_digest' in fields.values():
+        collection.create_index('access_token_digest')
+    return migrated
+
+
+def main(databases):
+    client = MongoClient(host=os.environ.get("ME_CONFIG_MONGODB_SERVER"), port=int(os.environ.get("ME_CONFIG_MONGODB_PORT")),
+                         username=os.environ.get("ME_CONFIG_MONGODB_ADMINUSERNAME"), password=os.environ.get("ME_CONFIG_MONGODB_ADMINPASSWORD"))
+    for database in databases:
+        for name, fields in COLLECTIONS[database].items():
+            migrated = migrate_collection(client[database][name], fields)
+            print("%s.%s: %d documents migrated" % (database, name, migrated))
+    client.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or list(COLLECTIONS))
@@ -1,31 +1,50 @@
 #! python3
 
-from flask import (Flask, make_response, render_template, redirect, request,url_for)
+from flask import (Flask, Response, g, make_response, render_template, redirect, request,url_for)
+import atexit
+import signal
+import sys
 import time
 import json
-import os
 import jwt
 from flask_cors import CORS
 from pymongo import MongoClient
 import secrets
-from osmclient import client
-import requests
-
-
-
+import socket
+import threading
+from collections import OrderedDict
+from pymongo.errors import PyMongoError
+from admission import AdaptiveLimit, AdmissionController
+from audit import AuditLog
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from config import Config
+from durability import DurabilityPolicy
+from health import HealthMonitor
+from ratelimit import RateLimiter, MemoryBackend, MongoBackend
+from tokens import token_digest
+from signing_keys import KeyRing, UnknownKeyError
+from revocations import RevocationFeed
+
+
+
+# the app is set up by create_app (end of this file) from a Config object (see config.py).
+# importing this module reads no environment and opens nothing; osmclient (a large package tree)
+# is only imported by the first login. To measure the start time: python ../misc/startup_benchmark.py
 app = Flask(__name__)
 app.debug = True
+config = None
+# old fixed keys, now only used to verify tokens without kid (new tokens are signed by the keyrings below)
 SECRET_KEY = 'secret-key-of-the-portuguese-empire'
 SECRET_KEY2 = 'another-very-secret-key'
 COR = CORS(app, origins=['*','http://localhost:3000'])
 
 
-# dados predefinidos no docker compose
-mongodb_addr = os.environ.get("ME_CONFIG_MONGODB_SERVER")
-mongodb_port = int (os.environ.get("ME_CONFIG_MONGODB_PORT"))
-mongodb_username = os.environ.get("ME_CONFIG_MONGODB_ADMINUSERNAME")
-mongodb_password = os.environ.get("ME_CONFIG_MONGODB_ADMINPASSWORD")
-osm_hostname = os.environ.get("OSM_HOSTNAME")
+# dados predefinidos no docker compose (see config.py)
+mongodb_addr = None
+mongodb_port = None
+mongodb_username = None
+mongodb_password = None
+osm_hostname = None
 
 ### Para testes locais
 #mongodb_addr = "mongodb://localhost:27017"
@@ -33,6 +52,180 @@ osm_hostname = os.environ.get("OSM_HOSTNAME")
 #mongodb_username = ""
 #mongodb_password = ""
 
+# write concern and read preference per collection and operation (see durability.py),
+# set with DURABILITY and DURABILITY_DEFAULT
+durability = DurabilityPolicy()
+
+# limite de pedidos ao /login (RATE_LIMIT_LOGIN), por username e endereço remoto.
+# evita que um script a tentar passwords chegue ao OSM NBI. RATE_LIMIT_BACKEND=mongo partilha os limites entre workers.
+login_limiter = None
+
+# shared database connection for the features used in every request (rate limits, signing keys)
+shared_client = None
+
+def get_shared_db():
+    global shared_client
+    if shared_client is None:
+        timeout = int(config.store_timeout * 1000)
+        shared_client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password,
+                                    serverSelectionTimeoutMS=timeout, connectTimeoutMS=timeout, socketTimeoutMS=timeout)
+    return shared_client['openid']
+
+def get_rate_limit_collection():
+    return get_shared_db()['rate_limits']
+
+# signing keys with rotation (see signing_keys.py), one keyring for access tokens and another for refresh tokens.
+# KEY_GRACE must be at least the lifetime of the tokens signed by a key (1h access, 12h refresh)
+access_keys = None
+refresh_keys = None
+
+# revocation feed for the resource servers (see revocations.py)
+revocation_feed = None
+
+# circuit breaker on the token reads (see circuit_breaker.py). While it is open, validation is degraded:
+# tokens validated recently by this process (known_tokens) are accepted until their exp and, with
+# DEGRADED_SIGNATURE_ONLY=1, other tokens are accepted on their signature alone (a revoked token may then be
+# accepted until it expires). Anything else gets a 503
+token_store_breaker = None
+
+class TokenStoreUnavailable(Exception):
+    pass
+
+# last known good tokens: digest -> (username, scope, expires), most recently used last. Only read in degraded mode;
+# tokens are dropped on logout and on revocation events from other processes
+known_tokens = OrderedDict()
+known_tokens_lock = threading.Lock()
+
+def remember_token(digest, token):
+    if config.known_tokens_size <= 0:
+        return
+    with known_tokens_lock:
+        known_tokens[digest] = (token['username'], token.get('scope'), token['expires'])
+        known_tokens.move_to_end(digest)
+        while len(known_tokens) > config.known_tokens_size:
+            known_tokens.popitem(last=False)
+
+def forget_token(digest):
+    with known_tokens_lock:
+        known_tokens.pop(digest, None)
+
+def invalidate_known_tokens(event):
+    if event['type'] == 'token':
+        forget_token(bytes.fromhex(event['token_digest']))
+    elif event['type'] == 'client':
+        with known_tokens_lock:
+            for digest, entry in list(known_tokens.items()):
+                if entry[0] == event['client_id']:
+                    del known_tokens[digest]
+
+# audit log of the token events (see audit.py), enabled with AUDIT_LOG_PATH.
+# a background thread writes it: requests only append the event to an in-memory queue
+audit_log = None
+
+def audit_event(event, **fields):
+    if audit_log is not None:
+        audit_log.record(event, **fields)
+
+def check_audit_log():
+    return audit_log.stats()
+
+def check_token_store():
+    if token_store_breaker.is_open:
+        raise TokenStoreUnavailable('circuit open, degraded validation')
+
+# dependency status for the /healthz and /readyz probes (see health.py), refreshed in the background.
+# the thread is started by the first probe, and its first round prepares the server (reset_mongo),
+# so the process only enters rotation with the database, the keys and the OSM NBI available
+health = None
+# connection only used by the probe ping, with a short timeout
+probe_client = None
+
+def check_mongo():
+    global probe_client
+    if probe_client is None:
+        timeout = int(config.health_timeout * 1000)
+        probe_client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password,
+                                   serverSelectionTimeoutMS=timeout, connectTimeoutMS=timeout, socketTimeoutMS=timeout)
+    probe_client['openid'].command('ping')
+
+# the NBI needs credentials for any real call, so only the TCP connection is checked
+def check_osm_nbi():
+    with socket.create_connection((osm_hostname, config.osm_nbi_port), timeout=config.health_timeout):
+        pass
+    return {'host': osm_hostname, 'port': config.osm_nbi_port}
+
+def check_startup():
+    reset_mongo()
+    return {'revocation_cursor': revocation_feed.cursor()}
+
+def check_signing_keys():
+    return {'access_kid': access_keys.signing_key()[0], 'refresh_kid': refresh_keys.signing_key()[0]}
+
+# requests that do not count towards saturation: the probes and the long revocation feed connections
+UNCOUNTED_ENDPOINTS = ('healthz', 'readyz', 'revocations')
+
+@app.before_request
+def count_request():
+    if health is not None and request.endpoint not in UNCOUNTED_ENDPOINTS:
+        health.request_started()
+
+@app.teardown_request
+def uncount_request(exc):
+    if health is not None and request.endpoint not in UNCOUNTED_ENDPOINTS:
+        health.request_finished()
+
+# admission control (see admission.py): adaptive limit of requests in flight per endpoint class.
+# validation is cheap and has its own limit, so it keeps answering while login (OSM NBI) is saturated.
+# above the limit requests get an immediate 503 with Retry-After. Endpoints outside the classes are not limited.
+# registered after count_request: a rejected request was already counted, and uncount_request always runs
+admission = None
+
+ADMISSION_CLASSES = {
+    'validate': 'validate',
+    'ext_authz': 'validate',
+    'login': 'issue',
+    'refresh': 'issue',
+    'logout': 'issue',
+}
+
+@app.before_request
+def admit_request():
+    name = ADMISSION_CLASSES.get(request.endpoint)
+    if admission is None or name is None:
+        return None
+    if not admission.acquire(name):
+        return overloaded(name)
+    g.admission = (name, time.monotonic())
+
+@app.teardown_request
+def release_request(exc):
+    admitted = g.pop('admission', None)
+    if admitted is not None:
+        admission.release(admitted[0], time.monotonic() - admitted[1])
+
+def check_admission():
+    return admission.stats()
+
+# response when the class of the request already has the limit of requests in flight
+def overloaded(name):
+    response = make_response('Server overloaded', 503)
+    response.headers['Retry-After'] = str(admission.retry_after(name))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+# probe response, only reads the status already computed by the thread
+def probe_response(ok, body):
+    response = make_response(json.dumps(dict(body, status='ok' if ok else 'unavailable')), 200 if ok else 503)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+# response sent when the request limit is exceeded
+def too_many_requests(retry_after):
+    response = make_response('Too many requests', 429)
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
 
 
 # receives username and password from the client ( and then tests login on OSM client)
@@ -43,6 +236,13 @@ def login():
     password = request.json.get('password')
     project = request.json.get('project')
 
+    # reject before calling OSM if the remote address, or this username from that address, exceeded the limit.
+    # the username bucket is per address, so failed logins from elsewhere cannot lock a user out
+    if login_limiter is not None:
+        retry_after = login_limiter.hit('addr:%s' % request.remote_addr, 'user:%s:%s' % (request.remote_addr, username))
+        if retry_after:
+            return too_many_requests(retry_after)
+
     app.logger.debug("username: %s" %username)
     app.logger.debug("password: %s" %password)
     app.logger.debug("project: %s" %project)
@@ -53,7 +253,8 @@ def login():
     ####### OSM CLIENT ########
     result = []
     try:
-        
+        from osmclient import client
+
         #myclient = client.Client(host="192.168.86.210", sol005=True)
         #myclient = client.Client(host="192.168.86.210", sol005=True, user="test", password="netedge!T3st", project="test", debug=True)
         myclient = client.Client(host=osm_hostname, sol005=True, user=username, password=password, project=project, debug=True)
@@ -63,6 +264,7 @@ def login():
     except Exception as e:
         if "401" in str(e):
             app.logger.debug("Exception: %s", e)
+            audit_event('login_failed', username=username, remote_addr=request.remote_addr)
             return make_response('Login failed: Invalid credentials --- Unauthorized', 401)
         else:
             return make_response('error: %s' %e, 500)
@@ -73,11 +275,11 @@ def login():
     # add a random nonce to the token
     expires = round(time.time() + 3600)
     nonce = secrets.token_urlsafe(16)
-    access_token = jwt.encode({'client_id': username, 'exp': expires, 'nonce': nonce}, SECRET_KEY, algorithm = 'HS256')
+    access_token = access_keys.sign({'client_id': username, 'exp': expires, 'nonce': nonce})
     # create a refresh token, must be different from access token
     expires2 = round(time.time() + 43200)
     nonce2 = secrets.token_urlsafe(16)                                 
-    refresh_token = jwt.encode({'client_id': username, 'exp': expires2, 'nonce': nonce2}, SECRET_KEY2, algorithm = 'HS256')
+    refresh_token = refresh_keys.sign({'client_id': username, 'exp': expires2, 'nonce': nonce2})
     
     #print("access_token: ", access_token)
     #print("refresh_token: ", refresh_token)
@@ -87,6 +289,8 @@ def login():
     # save token in database
     add_token(access_token, username, scope, expires, nonce)
     add_refresh_token(refresh_token, access_token, username, expires2, nonce2)
+    audit_event('token_issued', username=username, token_digest=token_digest(access_token).hex(), expires=expires,
+                remote_addr=request.remote_addr)
     # tenho que adicionar o refresh tokem a bd
     return json.dumps({
         'access_token': access_token,
@@ -110,7 +314,11 @@ def validate():
     if access_token == None:
         return make_response('No token provided correctly', 401)
 
-    if validate_token(access_token):
+    try:
+        valid = validate_token(access_token, request.remote_addr)
+    except TokenStoreUnavailable:
+        return store_unavailable()
+    if valid:
         return make_response('Valid access token', 200)
     else:
         return make_response('Invalid access token', 402)
@@ -136,15 +344,17 @@ def refresh():
         # create a new access token
         expires = round(time.time() + 3600)
         nonce = secrets.token_urlsafe(16)
-        access_token = jwt.encode({'client_id': username, 'exp': expires, 'nonce' : nonce}, SECRET_KEY, algorithm = 'HS256')
+        access_token = access_keys.sign({'client_id': username, 'exp': expires, 'nonce' : nonce})
 
         expires2 = round(time.time() + 43200)
         nonce2 = secrets.token_urlsafe(16)                                 
-        new_refresh_token = jwt.encode({'client_id': username, 'exp': expires2, 'nonce': nonce2}, SECRET_KEY2, algorithm = 'HS256')
+        new_refresh_token = refresh_keys.sign({'client_id': username, 'exp': expires2, 'nonce': nonce2})
         # save token in database
         scope = {} # por agora está assim.... [EM FALTA]
         add_token(access_token, username, scope, expires, nonce)
         delete_refresh_token(refresh_token)
+        audit_event('token_refreshed', username=username, token_digest=token_digest(access_token).hex(), expires=expires,
+                    refresh_token_digest=token_digest(refresh_token).hex(), remote_addr=request.remote_addr)
         # return new access token
         return json.dumps({
             'access_token': access_token,
@@ -153,6 +363,7 @@ def refresh():
             'expires': expires,
         })
     else:
+        audit_event('refresh_denied', refresh_token_digest=token_digest(refresh_token).hex(), remote_addr=request.remote_addr)
         return make_response('Invalid refresh token', 402)
 
 
@@ -186,14 +397,124 @@ def logout():
 
 
 
+# authorization endpoint compatible with Envoy's ext_authz (HTTP service).
+# the proxy sends the original method and headers to /ext_authz/<original path>. valid tokens get 200
+# with the identity headers (x-client-id, x-scopes) to be copied upstream (allowed_upstream_headers),
+# invalid ones get 401, returned by the proxy to the client. Cache-Control lets the proxy keep the verdict
+@app.route('/ext_authz', defaults={'path': ''}, methods = ['GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'HEAD', 'OPTIONS'])
+@app.route('/ext_authz/<path:path>', methods = ['GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'HEAD', 'OPTIONS'])
+def ext_authz(path):
+    data = request.headers.get('Authorization', '')
+    parts = data.split(" ")
+    info = None
+    if len(parts) == 2 and parts[0].lower() == 'bearer':
+        try:
+            info = checked_token_info(parts[1], 'ext_authz', request.remote_addr)
+        except TokenStoreUnavailable:
+            return store_unavailable()
+    if info is None:
+        response = make_response('Invalid access token', 401)
+        response.headers['WWW-Authenticate'] = 'Bearer error="invalid_token"'
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    scope = info.get('scope')
+    response = make_response('', 200)
+    response.headers['x-client-id'] = info['username']
+    response.headers['x-scopes'] = scope if isinstance(scope, str) else ' '.join(scope or [])
+    response.headers['Cache-Control'] = 'private, max-age=%d' % max(0, min(60, int(info['expires'] - time.time())))
+    return response
+
+
+# response when a token cannot be validated because the database is unavailable
+def store_unavailable():
+    response = make_response('Token store unavailable', 503)
+    response.headers['Retry-After'] = str(int(config.breaker_probe_interval))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+# liveness: the process answers and the check thread is not stuck
+@app.route('/healthz', methods = ['GET'])
+def healthz():
+    health.start()
+    now = time.time()
+    return probe_response(health.alive(now), {'age': health.report(now)['age']})
+
+
+# readiness: every dependency was available in the last check and the process is not saturated
+@app.route('/readyz', methods = ['GET'])
+def readyz():
+    health.start()
+    now = time.time()
+    return probe_response(health.ready(now), health.report(now))
+
+
+# public keys used to sign the access tokens (only with SIGNING_ALGORITHM ES256 or RS256),
+# so the resource servers can verify tokens locally
+@app.route('/jwks', methods = ['GET'])
+def jwks():
+    response = make_response(json.dumps({'keys': access_keys.public_jwks()}), 200)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Cache-Control'] = 'max-age=300'
+    return response
+
+
+# feed of revoked tokens, so resource servers can keep a local denylist.
+# cursor (or the Last-Event-ID header) is the last event received. With "Accept: text/event-stream"
+# the response is a stream of server-sent events, otherwise JSON (long-poll up to "wait" seconds)
+@app.route('/revocations', methods = ['GET'])
+def revocations():
+    try:
+        cursor = int(request.headers.get('Last-Event-ID') or request.args.get('cursor', 0))
+        wait = min(float(request.args.get('wait', 0)), 60)
+    except ValueError:
+        return make_response('Invalid cursor', 400)
+
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        return Response(revocation_feed.stream(cursor), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    if wait > 0:
+        events, reset = revocation_feed.wait(cursor, wait)
+    else:
+        events, reset = revocation_feed.since(cursor)
+    return json.dumps({
+        'events': events,
+        'reset': reset,
+        'cursor': events[-1]['seq'] if events else cursor
+    })
+
+
+
+
 ###### QUERIES DA BASE DE DADOS ######
 
 # Se o servidor for reiniciado, então todos os tokens são apagados da base de dados.
+# also called by the first readiness check, so it only runs once
+startup_lock = threading.Lock()
+started = False
+
 @app.before_first_request
 def reset_mongo():
+    global started
+    with startup_lock:
+        if started:
+            return
+        setup_mongo()
+        started = True
+
+def setup_mongo():
     print("GOING TO RESET MONGO")
     client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
     print("Connected to database successfully!")
+    # tokens are only stored and searched by their SHA-256 digest
+    # the unique indexes are sparse: legacy documents without token_digest (see migrate_tokens.py)
+    # are left out instead of colliding on null and failing the index build with E11000
+    db = client['openid']
+    db['tokens'].create_index('token_digest', unique=True, sparse=True)
+    db['refresh_tokens'].create_index('token_digest', unique=True, sparse=True)
+    db['refresh_tokens'].create_index('access_token_digest')
+    revocation_feed.start()
     # delete token collection
     #db = client['openid']
     #tokens = db['tokens']
@@ -209,11 +530,12 @@ def reset_mongo():
     client.close()
 
 # Função que adiciona tokens a base de dados
+# o token não é guardado, apenas o seu digest SHA-256 (ver tokens.py)
 def add_token(access_token, username, scope, expires, nonce):
     client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
     db = client['openid']
-    tokens = db['tokens']
-    tokens.insert_one({'username': username, 'access_token': access_token, 'scope': scope, 'expires': expires, 'nonce': nonce})
+    tokens = durability.collection(db, 'tokens', 'write')
+    tokens.insert_one({'username': username, 'token_digest': token_digest(access_token), 'scope': scope, 'expires': expires, 'nonce': nonce})
     print("Token added successfully!")
     client.close()
 
@@ -221,9 +543,9 @@ def add_token(access_token, username, scope, expires, nonce):
 def add_refresh_token(refresh_token, access_token, username, expires, nonce):
     client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
     db = client['openid']
-    refresh_tokens = db['refresh_tokens']
+    refresh_tokens = durability.collection(db, 'refresh_tokens', 'write')
     # there will be a list with all the access tokens that were generated with the same refresh token
-    refresh_tokens.insert_one({'username': username, 'refresh_token': refresh_token, 'access_token': access_token, 'expires': expires, 'nonce': nonce})
+    refresh_tokens.insert_one({'username': username, 'token_digest': token_digest(refresh_token), 'access_token_digest': token_digest(access_token), 'expires': expires, 'nonce': nonce})
     print("Refresh token added successfully!")
     client.close()
 
@@ -231,9 +553,9 @@ def add_refresh_token(refresh_token, access_token, username, expires, nonce):
 def add_access_token_to_refresh(refresh_token, access_token):
     client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
     db = client['openid']
-    refresh_tokens = db['refresh_tokens']
+    refresh_tokens = durability.collection(db, 'refresh_tokens', 'write')
     # there will be a list with all the access tokens that were generated with the same refresh token
-    refresh_tokens.update_one({'refresh_token': refresh_token}, {'$push': {'access_token': access_token}})
+    refresh_tokens.update_one({'token_digest': token_digest(refresh_token)}, {'$push': {'access_token_digest': token_digest(access_token)}})
     print("Access token added successfully!")
     client.close()
 
@@ -242,8 +564,8 @@ def add_access_token_to_refresh(refresh_token, access_token):
 def delete_token(access_token):
     client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
     db = client['openid']
-    tokens = db['tokens']
-    tokens.delete_one({'access_token': access_token})
+    tokens = durability.collection(db, 'tokens', 'write')
+    tokens.delete_one({'token_digest': token_digest(access_token)})
     client.close()
 
 
@@ -251,48 +573,111 @@ def delete_token(access_token):
 def delete_token_r(access_token):
     client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
     db = client['openid']
-    tokens = db['tokens']
-    tokens.delete_one({'access_token': access_token})
-    tokens = db['refresh_tokens']
-    tokens.delete_one({'access_token': access_token})
+    digest = token_digest(access_token)
+    forget_token(digest)
+    tokens = durability.collection(db, 'tokens', 'write')
+    token = tokens.find_one_and_delete({'token_digest': digest})
+    tokens = durability.collection(db, 'refresh_tokens', 'write')
+    tokens.delete_one({'access_token_digest': digest})
     client.close()
+    # the resource servers are told that the token is no longer valid
+    if token is not None:
+        revocation_feed.revoke_token(digest, token['expires'], 'logout')
+        audit_event('token_revoked', username=token['username'], token_digest=digest.hex(), reason='logout')
 
 
 # Função que elimina um refresh token da base de dados
 def delete_refresh_token(refresh_token):
     client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
     db = client['openid']
-    tokens = db['refresh_tokens']
-    tokens.delete_one({'refresh_token': refresh_token})
+    tokens = durability.collection(db, 'refresh_tokens', 'write')
+    tokens.delete_one({'token_digest': token_digest(refresh_token)})
     client.close()
 
 
 # Função que valida um token da base de dados
-def validate_token(access_token):
-    client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
-    db = client['openid']
-    tokens = db['tokens']
-    token = tokens.find_one({'access_token': access_token})
+def validate_token(access_token, remote_addr=None):
+    return checked_token_info(access_token, 'validate', remote_addr) is not None
+
+# token_info for the validation requests (/validate and /ext_authz), with the failures in the audit log
+def checked_token_info(access_token, source, remote_addr=None):
+    info = token_info(access_token)
+    if info is None:
+        audit_event('validation_failed', source=source, token_digest=token_digest(access_token).hex(), remote_addr=remote_addr)
+    return info
+
+# returns the document of a valid token (username, scope, expires) or None
+# used by /validate and /ext_authz, with the shared database connection.
+# raises TokenStoreUnavailable when the database is down and the token cannot be validated without it
+def token_info(access_token):
+    # tokens with an invalid signature (or expired) are rejected without going to the database
+    try:
+        access_keys.decode(access_token)
+    except jwt.ExpiredSignatureError:
+        # expired tokens go on to the database, where they are deleted
+        pass
+    except jwt.InvalidTokenError:
+        return None
+    digest = token_digest(access_token)
+    try:
+        tokens = durability.collection(get_shared_db(), 'tokens', 'read')
+        token = token_store_breaker.call(tokens.find_one, {'token_digest': digest})
+    except (PyMongoError, CircuitOpenError) as e:
+        return degraded_token_info(access_token, digest, e)
     if token is None:
-        client.close()
-        return False
+        forget_token(digest)
+        return None
     # verifica-se se o token expirou
     else:
         if token['expires'] < time.time():
         # como já expirou, então é apagado da base de dados.
-            delete_token(access_token)
-            client.close()
-            return False
-
-    client.close()
-    return True
+            forget_token(digest)
+            try:
+                # the delete goes through the write mode: the read mode may be a secondary read preference
+                # with no write concern of its own
+                tokens = durability.collection(get_shared_db(), 'tokens', 'write')
+                if tokens.delete_one({'token_digest': token['token_digest']}).deleted_count:
+                    revocation_feed.revoke_token(token['token_digest'], token['expires'], 'expired')
+                    audit_event('token_revoked', username=token['username'], token_digest=digest.hex(), reason='expired')
+            except PyMongoError as e:
+                # deleted on the next validation
+                print("Could not delete expired token: %s" % e)
+            return None
+
+    remember_token(digest, token)
+    return token
+
+# validation without the database (degraded mode): last known good tokens until their exp, then,
+# if DEGRADED_SIGNATURE_ONLY=1, any token with a valid signature
+def degraded_token_info(access_token, digest, error):
+    known = known_tokens.get(digest)
+    if known is not None:
+        if known[2] < time.time():
+            forget_token(digest)
+            return None
+        return {'username': known[0], 'scope': known[1], 'expires': known[2], 'degraded': True}
+    if config.degraded_signature_only:
+        # only keys already in memory: tokens without kid (old, public key) are never accepted without the database
+        try:
+            claims = access_keys.decode(access_token, require_kid=True, reload=False)
+        except UnknownKeyError as e:
+            # key that would have to be read from the database
+            raise TokenStoreUnavailable(str(e))
+        except jwt.InvalidTokenError:
+            return None
+        return {'username': claims['client_id'], 'scope': None, 'expires': claims['exp'], 'degraded': True}
+    raise TokenStoreUnavailable(str(error))
 
 # Função que valida um refresh token da base de dados
 def validate_refresh_token(refresh_token):
+    try:
+        refresh_keys.decode(refresh_token)
+    except jwt.InvalidTokenError:
+        return False
     client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
     db = client['openid']
-    tokens = db['refresh_tokens']
-    token = tokens.find_one({'refresh_token': refresh_token})
+    tokens = durability.collection(db, 'refresh_tokens', 'read')
+    token = tokens.find_one({'token_digest': token_digest(refresh_token)})
     if token is None:
         client.close()
         return False
@@ -311,8 +696,8 @@ def validate_refresh_token(refresh_token):
 def get_username_from_refresh_token(refresh_token):
     client = MongoClient(host=mongodb_addr, port=mongodb_port, username=mongodb_username, password=mongodb_password)
     db = client['openid']
-    tokens = db['refresh_tokens']
-    token = tokens.find_one({'refresh_token': refresh_token})
+    tokens = durability.collection(db, 'refresh_tokens', 'read')
+    token = tokens.find_one({'token_digest': token_digest(refresh_token)})
     if token is None:
         client.close()
         return None
@@ -324,7 +709,76 @@ def get_username_from_refresh_token(refresh_token):
 
 
 
-app.run(host='0.0.0.0', port = 5000, debug = True)
-
-
+###### ARRANQUE ######
+
+# creates the app with the given configuration (read from the environment by default).
+# only objects are created here: connections, keys and background threads start on the first request
+def create_app(app_config=None):
+    global config, mongodb_addr, mongodb_port, mongodb_username, mongodb_password, osm_hostname, shared_client
+    global login_limiter, access_keys, refresh_keys, revocation_feed, health, probe_client, durability, token_store_breaker
+    global audit_log, admission
+    config = app_config if app_config is not None else Config()
+    mongodb_addr = config.mongodb_addr
+    mongodb_port = config.mongodb_port
+    mongodb_username = config.mongodb_username
+    mongodb_password = config.mongodb_password
+    osm_hostname = config.osm_hostname
+    shared_client = None
+    durability = DurabilityPolicy(config.durability, config.durability_default)
+
+    login_limiter = None
+    if config.login_limit is not None:
+        if config.rate_limit_backend == 'mongo':
+            login_limiter = RateLimiter(*config.login_limit, backend=MongoBackend(get_rate_limit_collection), prefix='login:')
+        else:
+            login_limiter = RateLimiter(*config.login_limit, backend=MemoryBackend(), prefix='login:')
+
+    access_keys = KeyRing(lambda: get_shared_db()['signing_keys'], 'access', algorithm=config.signing_algorithm,
+                          rotation_interval=config.key_rotation_interval, grace=config.key_grace, legacy_secret=SECRET_KEY,
+                          legacy_until=config.legacy_secret_until)
+    refresh_keys = KeyRing(lambda: get_shared_db()['signing_keys'], 'refresh', algorithm=config.signing_algorithm,
+                           rotation_interval=config.key_rotation_interval, grace=config.refresh_key_grace, legacy_secret=SECRET_KEY2,
+                           legacy_until=config.legacy_secret_until)
+
+    revocation_feed = RevocationFeed(get_shared_db, capacity=config.revocation_buffer)
+    revocation_feed.add_listener(invalidate_known_tokens)
+    known_tokens.clear()
+    token_store_breaker = CircuitBreaker('token-store', lambda: get_shared_db().command('ping'),
+                                         failure_threshold=config.breaker_failures, slow_call=config.breaker_slow_call,
+                                         probe_interval=config.breaker_probe_interval)
+
+    audit_log = None
+    if config.audit_log_path:
+        audit_log = AuditLog(config.audit_log_path, queue_size=config.audit_queue_size, overflow=config.audit_overflow,
+                             block_timeout=config.audit_block_timeout, batch_size=config.audit_batch_size,
+                             flush_interval=config.audit_flush_interval, fsync=config.audit_fsync, fsync_interval=config.audit_fsync_interval,
+                             max_bytes=config.audit_max_bytes, backups=config.audit_backups, compress=config.audit_compress)
+        atexit.register(audit_log.close)
+        # SIGTERM (docker stop) exits normally, so the queued events are written
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    admission = None
+    if config.admission:
+        admission = AdmissionController({
+            'validate': AdaptiveLimit(*config.admission_validate),
+            'issue': AdaptiveLimit(*config.admission_issue),
+        })
 
+    probe_client = None
+    health = HealthMonitor(config.health_interval, config.ready_max_in_flight)
+    health.add_check('mongo', check_mongo)
+    health.add_check('startup', check_startup)
+    health.add_check('signing_keys', check_signing_keys)
+    health.add_check('osm_nbi', check_osm_nbi)
+    # with the circuit open the process stays in rotation, in degraded mode
+    health.add_check('token_store', check_token_store, required=False)
+    if audit_log is not None:
+        health.add_check('audit_log', check_audit_log, required=False)
+    if admission is not None:
+        health.add_check('admission', check_admission, required=False)
+    return app
+
+
+if __name__ == '__main__':
+    create_app()
+    app.run(host=config.host, port=config.port, debug=config.debug, use_reloader=config.reloader)
@@ -0,0 +1,155 @@
+#! python3
+
+## Limitador de pedidos do tipo "token bucket".
+# Cada chave (client_id, username, endereço remoto, ...) tem um balde com uma capacidade
+# máxima de pedidos que é reabastecido a uma taxa constante (pedidos por segundo).
+# Um pedido só é aceite se existir pelo menos um "token" no balde, caso contrário é
+# devolvido o tempo (em segundos) até ao próximo token ficar disponível, para ser usado
+# no cabeçalho Retry-After da resposta 429.
+#
+# Existem dois backends:
+#  - MemoryBackend: os baldes ficam em memória no próprio processo.
+#  - MongoBackend: os baldes ficam numa coleção do MongoDB, para que o limite seja
+#    partilhado entre vários workers/instâncias do servidor. Cada balde tem um campo expire_at
+#    (o instante em que volta a estar cheio) com um índice TTL, para os baldes das chaves
+#    inativas serem apagados pelo MongoDB.
+#
+# Um pedido com várias chaves só consome tokens se todas tiverem tokens disponíveis: um pedido
+# rejeitado por uma das chaves não gasta o balde das outras.
+
+import math
+import threading
+import time
+
+from pymongo import ReturnDocument
+
+
+# Backend em memória. Os baldes são guardados num dicionário: chave -> (tokens, instante).
+class MemoryBackend:
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    # tokens disponíveis no balde, sem consumir
+    def peek(self, key, capacity, rate, now):
+        tokens, last = self.buckets.get(key, (capacity, now))
+        return min(capacity, tokens + (now - last) * rate)
+
+    def take(self, key, capacity, rate, now):
+        with self.lock:
+            tokens, last = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - last) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_keys:
+                self.prune(capacity, rate, now)
+            return allowed, tokens
+
+    # remove os baldes que já estariam cheios (chaves inativas), para a memória não crescer sem limite.
+    def prune(self, capacity, rate, now):
+        for key, (tokens, last) in list(self.buckets.items()):
+            if tokens + (now - last) * rate >= capacity:
+                del self.buckets[key]
+
+
+# Backend partilhado no MongoDB. A atualização do balde é feita de forma atómica no servidor
+# com uma "update pipeline", por isso vários workers podem usar a mesma coleção sem corridas.
+class MongoBackend:
+
+    def __init__(self, get_collection):
+        # get_collection é uma função que devolve a coleção onde os baldes são guardados.
+        self.get_collection = get_collection
+        self.indexed = False
+
+    def collection(self):
+        collection = self.get_collection()
+        if not self.indexed:
+            collection.create_index('expire_at', expireAfterSeconds=0)
+            self.indexed = True
+        return collection
+
+    def peek(self, key, capacity, rate, now):
+        bucket = self.collection().find_one({'_id': key})
+        if bucket is None:
+            return capacity
+        return min(capacity, bucket['tokens'] + (now - bucket['ts']) * rate)
+
+    def take(self, key, capacity, rate, now):
+        bucket = self.collection().find_one_and_update(
+            {'_id': key},
+            [
+                {'$set': {'tokens': {'$min': [capacity, {'$add': [
+                    {'$ifNull': ['$tokens', capacity]},
+                    {'$multiply': [{'$subtract': [now, {'$ifNull': ['$ts', now]}]}, rate]}
+                ]}]}, 'ts': now}},
+                {'$set': {'allowed': {'$gte': ['$tokens', 1]}}},
+                {'$set': {'tokens': {'$cond': ['$allowed', {'$subtract': ['$tokens', 1]}, '$tokens']}}},
+                # o balde volta a estar cheio (e pode ser apagado) daqui a (capacidade - tokens) / taxa segundos
+                {'$set': {'expire_at': {'$toDate': {'$multiply': [
+                    {'$add': [now, {'$divide': [{'$subtract': [capacity, '$tokens']}, rate]}]}, 1000
+                ]}}}},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return bucket['allowed'], bucket['tokens']
+
+
+class RateLimiter:
+
+    # capacity: número máximo de pedidos seguidos (rajada)
+    # rate: pedidos por segundo repostos no balde
+    def __init__(self, capacity, rate, backend=None, prefix=''):
+        self.capacity = capacity
+        self.rate = rate
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.prefix = prefix
+
+    # Verifica, sem consumir, se todas as chaves têm tokens disponíveis. Serve para rejeitar um pedido
+    # antes de trabalho caro (por exemplo o bcrypt) e só o contar com hit depois de este correr bem.
+    # Devolve 0 se o pedido seria aceite, ou o número de segundos a esperar (Retry-After) caso contrário.
+    def check(self, *keys):
+        return self.check_keys(self.keys(keys), time.time())
+
+    # Tenta consumir um token para cada uma das chaves. Primeiro verifica todas as chaves e só
+    # consome se todas tiverem tokens, para um pedido rejeitado não gastar os baldes das outras.
+    # Devolve 0 se o pedido for aceite, ou o número de segundos a esperar (Retry-After) caso contrário.
+    def hit(self, *keys):
+        now = time.time()
+        keys = self.keys(keys)
+        retry_after = self.check_keys(keys, now)
+        if retry_after:
+            return retry_after
+        for key in keys:
+            # outro pedido pode ter gasto o último token entre a verificação e o consumo
+            allowed, tokens = self.backend.take(key, self.capacity, self.rate, now)
+            if not allowed:
+                retry_after = max(retry_after, self.wait_time(tokens))
+        return retry_after
+
+    def keys(self, keys):
+        return [self.prefix + str(key) for key in keys if key is not None]
+
+    def check_keys(self, keys, now):
+        retry_after = 0
+        for key in keys:
+            tokens = self.backend.peek(key, self.capacity, self.rate, now)
+            if tokens < 1:
+                retry_after = max(retry_after, self.wait_time(tokens))
+        return retry_after
+
+    def wait_time(self, tokens):
+        return math.ceil((1 - tokens) / self.rate)
+
+
+# Lê a configuração de um limitador no formato "capacidade/taxa", por exemplo "10/0.5"
+# (rajada de 10 pedidos, repondo um pedido a cada 2 segundos). Devolve None se estiver vazio.
+def parse_limit(value):
+    if not value:
+        return None
+    capacity, rate = value.split('/')
+    return float(capacity), float(rate)
@@ -0,0 +1,13 @@
+#! python3
+
+## Funções auxiliares dos tokens.
+# Na base de dados nunca é guardado nenhum token, apenas o seu digest SHA-256 (32 bytes), que é
+# usado como chave de pesquisa. Assim os índices têm tamanho fixo e uma cópia da base de dados
+# não expõe tokens válidos. (Os reference tokens só existem no OAuth-server, ver auth-server/tokens.py.)
+
+import hashlib
+
+
+# devolve o digest SHA-256 do token, em binário, tal como é guardado na base de dados.
+def token_digest(token):
+    return hashlib.sha256(token.encode('utf-8')).digest()
@@ -0,0 +1,20 @@
+#! python3
+
+## Validação de tokens de acesso para resource servers Flask e ASGI.
+# Exemplo (Flask):
+#
+#   from oauth_validator import TokenValidator, require_token
+#   validator = TokenValidator('http://localhost:5001')
+#
+#   @app.route('/recurso1')
+#   @require_token(validator)
+#   def recurso1():
+#       client_id = g.token_claims.get('client_id')
+#
+# Exemplo (ASGI):
+#
+#   app = TokenMiddleware(app, TokenValidator('http://localhost:5001'))
+
+from .validator import TokenValidator, bearer_token
+from .flask_ext import require_token
+from .asgi import TokenMiddleware
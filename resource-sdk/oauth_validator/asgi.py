@@ -0,0 +1,48 @@
+#! python3
+
+## Middleware ASGI que protege todos os pedidos HTTP com um TokenValidator.
+# As claims do token ficam em scope['state']['token_claims'].
+# Os resultados em cache são usados diretamente; as validações que precisam de ir ao
+# servidor de autorização correm num thread pool, para não bloquear o event loop.
+
+import asyncio
+
+from .validator import bearer_token
+
+
+class TokenMiddleware:
+
+    def __init__(self, app, validator, exempt_paths=()):
+        self.app = app
+        self.validator = validator
+        self.exempt_paths = set(exempt_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] in self.exempt_paths:
+            return await self.app(scope, receive, send)
+
+        header = None
+        for name, value in scope['headers']:
+            if name == b'authorization':
+                header = value.decode('latin-1')
+                break
+        claims = await self.validate(bearer_token(header))
+        if claims is None:
+            await send({
+                'type': 'http.response.start',
+                'status': 401,
+                'headers': [(b'content-type', b'text/plain'), (b'www-authenticate', b'Bearer error="invalid_token"')],
+            })
+            await send({'type': 'http.response.body', 'body': b'Invalid access token'})
+            return
+
+        scope.setdefault('state', {})['token_claims'] = claims
+        return await self.app(scope, receive, send)
+
+    async def validate(self, token):
+        if not token:
+            return None
+        found, claims = self.validator.cached(self.validator.digest(token))
+        if found:
+            return claims
+        return await asyncio.get_running_loop().run_in_executor(None, self.validator.validate, token)
@@ -0,0 +1,26 @@
+#! python3
+
+## Decorador para proteger endpoints Flask com um TokenValidator.
+# As claims do token ficam disponíveis em flask.g.token_claims.
+# O flask só é importado quando o decorador é usado, para o pacote servir também a aplicações ASGI.
+
+import functools
+
+from .validator import bearer_token
+
+
+def require_token(validator):
+    from flask import g, make_response, request
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            claims = validator.validate(bearer_token(request.headers.get('Authorization')))
+            if claims is None:
+                response = make_response('Invalid access token', 401)
+                response.headers['WWW-Authenticate'] = 'Bearer error="invalid_token"'
+                return response
+            g.token_claims = claims
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,278 @@
+#! python3
+
+## Validação de tokens de acesso nos resource servers.
+# Em vez de fazer um pedido novo ao servidor de autorização em cada pedido protegido, o
+# TokenValidator:
+#  1. verifica os JWT localmente com as chaves públicas do servidor (/jwks), quando este usa
+#     ES256 ou RS256. As chaves ficam em cache e só são lidas de novo quando aparece um kid
+#     desconhecido;
+#  2. guarda em cache (com TTL) o resultado das validações feitas no servidor (/validate),
+#     tanto positivas como negativas;
+#  3. junta os pedidos simultâneos para o mesmo token numa só chamada ao servidor;
+#  4. usa uma requests.Session com um pool de ligações keep-alive para as chamadas ao servidor;
+#  5. opcionalmente segue o feed /revocations numa thread, mantendo uma denylist local.
+#     Só com o feed ativo é que um JWT verificado localmente é aceite sem ir ao servidor,
+#     porque de outra forma um token revogado continuaria a ser aceite até expirar.
+
+import collections
+import hashlib
+import threading
+import time
+
+import jwt
+import requests
+from requests.adapters import HTTPAdapter
+
+ASYMMETRIC_ALGORITHMS = ('ES256', 'RS256')
+# algoritmo das chaves publicadas sem "alg", pelo tipo da chave
+KEY_TYPE_ALGORITHMS = {'EC': 'ES256', 'RSA': 'RS256'}
+
+# tempo mínimo entre duas leituras do /jwks causadas por um kid desconhecido
+JWKS_REFRESH_INTERVAL = 30
+
+# respostas do /validate que querem dizer que o token não é válido (as únicas guardadas em cache como negativas)
+NEGATIVE_STATUS = (401, 402)
+
+
+class TokenValidator:
+
+    # auth_url: endereço do servidor de autorização, por exemplo http://localhost:5001
+    # cache_ttl / negative_ttl: tempo (segundos) durante o qual um resultado positivo / negativo fica em cache
+    # follow_revocations: segue o feed /revocations e aceita os JWT verificados localmente
+    def __init__(self, auth_url, cache_ttl=60, negative_ttl=5, max_entries=100000, pool_size=10, timeout=2, follow_revocations=False):
+        self.auth_url = auth_url.rstrip('/')
+        self.cache_ttl = cache_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # digest do token -> (claims ou None, válido até)
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # digest do token -> threading.Event, para os pedidos em curso no servidor
+        self.in_flight = {}
+
+        # kid -> (chave pública, algoritmo da chave)
+        self.jwks = {}
+        self.jwks_loaded_at = 0
+
+        # denylist mantida pelo feed de revogações
+        self.denied_tokens = {}
+        self.denied_clients = set()
+        # client_id -> (issued_before, expires): tokens do cliente emitidos antes de issued_before já não são válidos
+        self.client_cutoffs = {}
+        # geração mínima dos tokens (evento "epoch" do feed): os JWT de gerações anteriores já não são válidos
+        self.min_epoch = 0
+        self.denylist_pruned_at = 0
+        self.revocations_cursor = 0
+        self.follower = None
+        if follow_revocations:
+            self.follower = threading.Thread(target=self.follow_revocations, name='revocations-follower', daemon=True)
+            self.follower.start()
+
+    # Devolve as claims do token (um dicionário) se for válido, ou None.
+    def validate(self, token):
+        if not token:
+            return None
+        digest = self.digest(token)
+        if digest in self.denied_tokens:
+            return None
+
+        found, claims = self.cached(digest)
+        if found:
+            return claims
+
+        if self.follower is not None and '.' in token:
+            try:
+                claims = self.verify_locally(token)
+            except jwt.InvalidTokenError:
+                self.store(digest, None)
+                return None
+            if claims is not None:
+                if claims.get('client_id') in self.denied_clients or claims.get('epoch', 0) < self.min_epoch:
+                    return None
+                cutoff = self.client_cutoffs.get(claims.get('client_id'))
+                if cutoff is not None and claims.get('iat', 0) < cutoff[0]:
+                    return None
+                self.store(digest, claims)
+                return claims
+
+        return self.introspect(token, digest)
+
+    # digest SHA-256 do token em hex, o mesmo usado no feed de revogações
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    # (True, claims) se existir um resultado em cache ainda válido, (False, None) caso contrário.
+    def cached(self, digest):
+        with self.lock:
+            entry = self.cache.get(digest)
+            if entry is None:
+                return False, None
+            claims, until = entry
+            if until < time.time():
+                del self.cache[digest]
+                return False, None
+            self.cache.move_to_end(digest)
+            return True, claims
+
+    def store(self, digest, claims):
+        now = time.time()
+        if claims is None:
+            until = now + self.negative_ttl
+        else:
+            until = now + self.cache_ttl
+            # um token nunca fica em cache depois de expirar
+            if 'exp' in claims:
+                until = min(until, claims['exp'])
+        with self.lock:
+            self.cache[digest] = (claims, until)
+            self.cache.move_to_end(digest)
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+
+    # Verifica um JWT com as chaves públicas do servidor. Devolve None se não houver chave
+    # local para o token (por exemplo com HS256), e lança jwt.InvalidTokenError se for inválido.
+    # O algoritmo é sempre o da chave publicada: o do cabeçalho vem do cliente e um token com
+    # outro algoritmo para o mesmo kid é inválido.
+    def verify_locally(self, token):
+        header = jwt.get_unverified_header(token)
+        if header.get('alg') not in ASYMMETRIC_ALGORITHMS:
+            return None
+        kid = header.get('kid')
+        if kid not in self.jwks and time.time() - self.jwks_loaded_at > JWKS_REFRESH_INTERVAL:
+            self.load_jwks()
+        entry = self.jwks.get(kid)
+        if entry is None:
+            return None
+        key, algorithm = entry
+        if header['alg'] != algorithm:
+            raise jwt.InvalidAlgorithmError('Token algorithm does not match the key')
+        return jwt.decode(token, key, algorithms=[algorithm])
+
+    def load_jwks(self):
+        self.jwks_loaded_at = time.time()
+        try:
+            response = self.session.get(self.auth_url + '/jwks', timeout=self.timeout)
+            response.raise_for_status()
+            jwks = {}
+            for jwk in response.json()['keys']:
+                algorithm = jwk.get('alg') or KEY_TYPE_ALGORITHMS.get(jwk.get('kty'))
+                if algorithm not in ASYMMETRIC_ALGORITHMS:
+                    continue
+                jwks[jwk['kid']] = (jwt.PyJWK(jwk, algorithm).key, algorithm)
+            self.jwks = jwks
+        except (requests.RequestException, ValueError, KeyError, jwt.PyJWKError) as e:
+            print("Could not load JWKS: %s" % e)
+
+    # Valida o token no servidor de autorização. Se já existir um pedido em curso para o mesmo
+    # token, espera pelo resultado desse pedido em vez de fazer outro.
+    def introspect(self, token, digest):
+        with self.lock:
+            event = self.in_flight.get(digest)
+            leader = event is None
+            if leader:
+                event = self.in_flight[digest] = threading.Event()
+        if not leader:
+            event.wait(self.timeout)
+            found, claims = self.cached(digest)
+            return claims if found else None
+
+        try:
+            claims = None
+            try:
+                response = self.session.post(self.auth_url + '/validate', headers={'Authorization': 'Bearer ' + token}, timeout=self.timeout)
+            except requests.RequestException as e:
+                # sem resposta do servidor o token não é aceite, mas o resultado não fica em cache
+                print("Could not validate token: %s" % e)
+                return None
+            if response.status_code == 200:
+                claims = {'active': True}
+                if '.' in token:
+                    claims.update(jwt.decode(token, options={'verify_signature': False}))
+            elif response.status_code not in NEGATIVE_STATUS:
+                # 429, 503 (sobrecarga, base de dados indisponível) ou outro erro: não diz nada sobre o token,
+                # por isso é tratado como a falta de resposta (não é aceite, mas não fica em cache)
+                print("Could not validate token: status %d" % response.status_code)
+                return None
+            self.store(digest, claims)
+            return claims
+        finally:
+            with self.lock:
+                del self.in_flight[digest]
+            event.set()
+
+    # Thread que segue o feed /revocations (long-poll) e atualiza a denylist local.
+    def follow_revocations(self):
+        while True:
+            try:
+                response = self.session.get(self.auth_url + '/revocations', params={'cursor': self.revocations_cursor, 'wait': 30}, timeout=self.timeout + 30)
+                response.raise_for_status()
+                body = response.json()
+                if body['reset']:
+                    # faltam eventos: já não é possível confiar na cache
+                    with self.lock:
+                        self.cache.clear()
+                for event in body['events']:
+                    self.apply_revocation(event)
+                self.revocations_cursor = body['cursor']
+            except (requests.RequestException, ValueError, KeyError) as e:
+                print("Revocations feed error: %s" % e)
+                time.sleep(5)
+
+    def apply_revocation(self, event):
+        now = time.time()
+        if event['type'] == 'token':
+            with self.lock:
+                self.cache.pop(event['token_digest'], None)
+            if event.get('expires', now + 1) > now:
+                self.denied_tokens[event['token_digest']] = event['expires']
+        elif event['type'] == 'client':
+            self.denied_clients.add(event['client_id'])
+            self.drop_client_entries({event['client_id']})
+        elif event['type'] == 'client_tokens':
+            # os clientes continuam registados: só os tokens emitidos antes do evento deixam de ser válidos
+            client_ids = set(event['client_ids'])
+            if event['expires'] > now:
+                for client_id in client_ids:
+                    previous = self.client_cutoffs.get(client_id, (0, 0))
+                    self.client_cutoffs[client_id] = (max(previous[0], event['issued_before']), max(previous[1], event['expires']))
+            self.drop_client_entries(client_ids)
+        elif event['type'] == 'epoch':
+            # novo deploy: todos os tokens emitidos antes deixaram de ser válidos
+            self.min_epoch = max(self.min_epoch, event['epoch'])
+            with self.lock:
+                self.cache.clear()
+        # os tokens revogados que entretanto expiraram já não precisam de estar na denylist
+        if now - self.denylist_pruned_at > 60:
+            self.denylist_pruned_at = now
+            for digest, expires in list(self.denied_tokens.items()):
+                if expires < now:
+                    del self.denied_tokens[digest]
+            for client_id, (issued_before, expires) in list(self.client_cutoffs.items()):
+                if expires < now:
+                    del self.client_cutoffs[client_id]
+
+    # Retira da cache os resultados positivos dos tokens dos clientes. Os reference tokens validados no
+    # servidor não têm client_id nas claims, por isso também saem todos (voltam a ser validados no /validate).
+    def drop_client_entries(self, client_ids):
+        with self.lock:
+            for digest, (claims, until) in list(self.cache.items()):
+                if claims is not None and ('client_id' not in claims or claims['client_id'] in client_ids):
+                    del self.cache[digest]
+
+
+# extrai o token de um cabeçalho "Authorization: Bearer <token>" (ou None)
+def bearer_token(header):
+    if not header:
+        return None
+    parts = header.split(' ')
+    if len(parts) != 2 or parts[0].lower() != 'bearer':
+        return None
+    return parts[1]